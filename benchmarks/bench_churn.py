@@ -0,0 +1,490 @@
+#!/usr/bin/env python2
+""" Benchmarks how a ring copes with peers joining and leaving.
+
+Brings up a ring (see `bench_ring`), then issues lookups at a steady rate
+through three phases:
+
+    - warmup:   no churn, to measure what lookups normally look like
+    - churn:    peers join (with `join_ring`) and leave (with `leave_ring`, or
+                by dropping every connection as if they crashed) at random,
+                at a configurable rate
+    - cooldown: no churn again, to see how long the ring takes to recover
+
+It reports, over time and for each phase:
+
+    - the fraction of lookups that were answered, and that were answered with
+      the peer actually responsible for the value at the time
+    - lookup latency, and how much it inflates compared to the warmup
+    - how long it takes for the successor pointer that each join or leave
+      invalidated to be right again ("time to repair")
+    - the messages each peer sends per second, most of which is the control
+      traffic (stabilization, heartbeats, and so on) that keeps the ring
+      together, and how much that grows compared to the warmup
+
+```bash
+$ python2 benchmarks/bench_churn.py --nodes 32 --churn-rate 1 \\
+      --duration 60 --output churn.json
+```
+"""
+
+import os
+import sys
+import time
+import bisect
+import random
+import logging
+import argparse
+import threading
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from cicada.chordlib    import L
+from cicada.chordlib    import clock
+from cicada.chordlib    import routing
+from cicada.chordlib    import convergence
+
+import benchutils
+import bench_ring
+
+
+PHASES = ("warmup", "churn", "cooldown")
+EVENTS = (("join", "joins"), ("leave", "leaves"), ("crash", "crashes"))
+
+
+class Lookup(object):
+    """ A single lookup, and how it turned out.
+    """
+    def __init__(self, value, start):
+        self.value = value
+        self.start = start
+        self.latency = None     # seconds, once answered
+        self.hops = None
+        self.answered = False
+        self.correct = False
+
+
+class Event(object):
+    """ A peer joining or leaving, and when the ring was repaired around it.
+    """
+    def __init__(self, kind, start, hash=None):
+        self.kind = kind        # "join", "leave", or "crash"
+        self.start = start
+        self.hash = hash        # the peer's hash, once it's known
+        self.failed = False     # for joins that didn't go through
+        self.repaired = None    # seconds until repaired, once it is
+
+
+class ChurnBenchmark(object):
+    """ Churns a ring while looking things up in it.
+    """
+    MONITOR_INTERVAL = 0.25     # seconds between checks on the ring
+
+    def __init__(self, ring, rng, lookup_rate=20, churn_rate=0.5,
+                 joins=0.5, graceful=0.5, minimum=4, timeout=10):
+        """ Prepares the benchmark; nothing happens until `run()`.
+
+        :ring           the converged `bench_ring.Ring` to churn
+        :rng            the source of random choices
+        :lookup_rate[=20] the lookups to issue per second
+        :churn_rate[=0.5] the joins and leaves per second, during churn
+        :joins[=0.5]    the fraction of churn that is joins (the rest leave)
+        :graceful[=0.5] the fraction of leaves that are graceful (the rest
+                        crash)
+        :minimum[=4]    the fewest peers to leave in the ring
+        :timeout[=10]   the seconds after which a lookup fails
+        """
+        self.ring = ring
+        self.rng = rng
+        self.lookup_rate = lookup_rate
+        self.churn_rate = churn_rate
+        self.joins = joins
+        self.graceful = graceful
+        self.minimum = minimum
+        self.timeout = timeout
+
+        self.lookups = []
+        self.events = []
+        self.samples = []       # [ (time, messages, bytes, peers) ]
+        self.recovered = None   # seconds after churn until the ring converged
+        self.phases = {}        # { phase: (start, end) }
+
+        self._lock = threading.Lock()
+        self._phase = None
+        self._start = time.time()
+        self._hashes = []       # sorted ints of every live peer's hash
+        self._nodes = []        # the live peers' `LocalNode`s, in that order
+        self._churners = []
+        self._update_membership()
+
+    def run(self, warmup, duration, cooldown):
+        """ Runs each phase for the given number of seconds.
+        """
+        threads = [
+            threading.Thread(target=self._issue_lookups),
+            threading.Thread(target=self._monitor),
+            threading.Thread(target=self._churn),
+        ]
+        for thread in threads:
+            thread.daemon = True
+
+        self._start = time.time()
+        for phase, length in zip(PHASES, (warmup, duration, cooldown)):
+            start = self.now
+            with self._lock:
+                self._phase = phase
+            if not threads[0].is_alive():
+                for thread in threads: thread.start()
+
+            time.sleep(length)
+            self.phases[phase] = (start, self.now)
+
+        with self._lock:
+            self._phase = None
+        for thread in threads + self._churners:
+            thread.join(self.timeout + 5)
+
+        # Give the last lookups their chance to be answered, too.
+        while [ l for l in self.lookups
+                if not l.answered and self.now - l.start < self.timeout ]:
+            time.sleep(0.1)
+        self._check_repairs()
+
+    @property
+    def now(self):
+        return time.time() - self._start
+
+    def results(self, window=5):
+        """ Summarizes the run, overall and in windows of `window` seconds.
+        """
+        results = {}
+        for phase in PHASES:
+            if phase not in self.phases: continue
+            start, end = self.phases[phase]
+            results[phase] = self._summarize(start, end)
+
+        baseline = results.get("warmup", {})
+        for phase, stats in results.iteritems():
+            for key in ("latency_p50_ms", "latency_p99_ms",
+                        "messages_per_node_per_sec"):
+                if baseline.get(key) and stats.get(key) is not None:
+                    stats[key.replace("_ms", "") + "_inflation"] = \
+                        stats[key] / baseline[key]
+
+        repairs = [ e.repaired for e in self.events if e.repaired is not None ]
+        results["repair"] = {
+            "events":               len(self.events),
+            "joins":                self._count("join"),
+            "leaves":               self._count("leave"),
+            "crashes":              self._count("crash"),
+            "failed_joins":         len([ e for e in self.events if e.failed ]),
+            "unrepaired":           len([
+                e for e in self.events if e.repaired is None and not e.failed
+            ]),
+            "time_to_repair_s":     benchutils.summarize(repairs),
+            "repair_p99_s":         benchutils.percentile(repairs, 99),
+            "recovery_s":           self.recovered,
+        }
+
+        end = max([ e for _, e in self.phases.values() ] or [ 0 ])
+        results["timeline"] = [
+            self._summarize(t, min(t + window, end), events=True)
+            for t in xrange(0, int(end), window)
+        ]
+        return results
+
+    def _summarize(self, start, end, events=False):
+        lookups = [ l for l in self.lookups if start <= l.start < end ]
+        answered = [ l for l in lookups if l.answered ]
+        latencies = [ l.latency for l in answered ]
+        samples = [ s for s in self.samples if start <= s[0] <= end ]
+
+        stats = {
+            "start":            start,
+            "lookups":          len(lookups),
+            "success_rate":     _fraction(len(answered), len(lookups)),
+            "correct_rate":     _fraction(len([
+                l for l in answered if l.correct
+            ]), len(lookups)),
+            "latency_ms":       benchutils.summarize(latencies, 1000),
+            "hops":             benchutils.summarize([
+                l.hops for l in answered
+            ]),
+            "messages_per_node_per_sec": None,
+        }
+        stats["latency_p50_ms"] = stats["latency_ms"].get("p50")
+        stats["latency_p99_ms"] = stats["latency_ms"].get("p99")
+
+        if len(samples) > 1:
+            (t0, m0, b0, _), (t1, m1, b1, _) = samples[0], samples[-1]
+            peers = float(sum([ s[3] for s in samples ])) / len(samples)
+            stats["peers"] = peers
+            stats["messages_per_node_per_sec"] = (m1 - m0) / (t1 - t0) / peers
+            stats["bytes_per_node_per_sec"] = (b1 - b0) / (t1 - t0) / peers
+
+        if events:
+            for kind, key in EVENTS:
+                stats[key] = len([
+                    e for e in self.events
+                    if e.kind == kind and start <= e.start < end
+                ])
+        return stats
+
+    def _count(self, kind):
+        return len([ e for e in self.events if e.kind == kind ])
+
+    def _issue_lookups(self):
+        """ Looks up random values from random peers, at a steady rate.
+        """
+        issued = 0
+        while self._phase is not None:
+            delay = float(issued) / self.lookup_rate - self.now
+            if delay > 0: time.sleep(delay)
+            issued += 1
+
+            peer = self.rng.choice(self.ring.peers)
+            value = routing.Hash(value=str(self.rng.getrandbits(64)))
+            lookup = Lookup(value, self.now)
+            with self._lock:
+                self.lookups.append(lookup)
+
+            def on_result(result, response, lookup=lookup):
+                self._on_result(lookup, result, response)
+
+            try:
+                peer.peer.lookup(value, on_result, 0)
+            except Exception, e:    # the peer left in the meantime
+                L.debug("Lookup failed to start: %s", e)
+
+    def _on_result(self, lookup, result, response):
+        latency = self.now - lookup.start
+        if result is None or latency > self.timeout: return
+
+        lookup.latency = latency
+        lookup.hops = response.hops if response else 0
+        lookup.answered = True
+        with self._lock:
+            lookup.correct = int(result.hash) == self._owner(int(lookup.value))
+
+    def _churn(self):
+        """ Adds and removes peers at random while in the churn phase.
+        """
+        while self._phase is not None:
+            time.sleep(self.rng.expovariate(self.churn_rate))
+            if self._phase != "churn": continue
+
+            if self.rng.random() < self.joins:
+                event = Event("join", self.now)
+                target = self._join
+            else:
+                if len(self.ring.peers) <= self.minimum: continue
+                peer = self.rng.choice(self.ring.peers)
+                graceful = self.rng.random() < self.graceful
+                event = Event("leave" if graceful else "crash", self.now,
+                              int(peer.peer.hash))
+                target = lambda e, peer=peer, graceful=graceful: \
+                         self._leave(e, peer, graceful)
+
+            with self._lock:
+                self.events.append(event)
+
+            # Joins and leaves block, but shouldn't hold up the ones after.
+            thread = threading.Thread(target=target, args=(event, ))
+            thread.daemon = True
+            thread.start()
+            self._churners.append(thread)
+
+    def _join(self, event):
+        try:
+            peer = self.ring.add(self.timeout)
+        except Exception, e:
+            L.warning("A peer failed to join: %s", e)
+            event.failed = True
+            return
+
+        event.hash = int(peer.peer.hash)
+        self._update_membership()
+
+    def _leave(self, event, peer, graceful):
+        self.ring.remove(peer, graceful, 0)
+        self._update_membership()
+
+    def _update_membership(self):
+        nodes = sorted([ p.peer for p in self.ring.peers ],
+                       key=lambda n: int(n.hash))
+        with self._lock:
+            self._nodes = nodes
+            self._hashes = [ int(n.hash) for n in nodes ]
+
+    def _owner(self, value):
+        """ The hash of the live peer responsible for a value.
+        """
+        index = bisect.bisect_left(self._hashes, value)
+        return self._hashes[index % len(self._hashes)]
+
+    def _monitor(self):
+        """ Samples traffic and checks on repairs until the run ends.
+        """
+        churn_ended = None
+        while self._phase is not None:
+            messages, size = self.ring.traffic()
+            self.samples.append((self.now, messages, size,
+                                 len(self.ring.peers)))
+            self._check_repairs()
+
+            if self._phase == "cooldown" and self.recovered is None:
+                if churn_ended is None: churn_ended = self.now
+                if convergence.check_ring(self._nodes):
+                    self.recovered = self.now - churn_ended
+
+            time.sleep(self.MONITOR_INTERVAL)
+
+    def _check_repairs(self):
+        """ Marks every event whose successor pointer has been fixed.
+
+        Whether a peer joined or left at some spot on the ring, the pointer that
+        needs fixing is the successor of the live peer right before that spot.
+        """
+        with self._lock:
+            nodes, hashes = self._nodes, self._hashes
+            pending = [
+                e for e in self.events
+                if e.repaired is None and e.hash is not None and not e.failed
+            ]
+
+        for event in pending:
+            index = bisect.bisect_left(hashes, event.hash)
+            before = nodes[index - 1]
+            expected = hashes[index % len(hashes)]
+            if before.successor and int(before.successor.hash) == expected:
+                event.repaired = self.now - event.start
+
+
+def _fraction(part, whole):
+    return float(part) / whole if whole else None
+
+
+def main(args):
+    random.seed(args.seed)
+    clock.install(clock.SystemClock(args.seed))
+    rng = random.Random(args.seed)
+    L.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+
+    print "Starting %d peers over %s..." % (args.nodes, args.network)
+    ring = bench_ring.Ring(args.nodes, args.network, args.port, rng)
+    converged = ring.converge(args.converge_timeout)
+    if converged is None:
+        print "The ring didn't converge within %ds." % args.converge_timeout
+        return 2
+    print "Converged in %.1fs." % converged
+
+    bench = ChurnBenchmark(ring, rng, args.lookup_rate, args.churn_rate,
+                           args.joins, args.graceful,
+                           max(2, int(args.nodes * args.min_fraction)),
+                           args.timeout)
+    bench.run(args.warmup, args.duration, args.cooldown)
+    results = bench.results(args.window)
+    ring.stop()
+
+    print "%6s %5s %5s %5s %5s %7s %8s %8s %6s %9s" % (
+          "time", "peers", "joins", "quits", "crash", "success", "p50(ms)",
+          "p99(ms)", "hops", "msgs/s/pe")
+    for w in results["timeline"]:
+        print "%6d %5.0f %5d %5d %5d %7s %8s %8s %6s %9s" % (
+              w["start"], w.get("peers", 0), w["joins"], w["leaves"],
+              w["crashes"], _format(w["success_rate"], "%.1f%%", 100),
+              _format(w["latency_p50_ms"]), _format(w["latency_p99_ms"]),
+              _format(w["hops"].get("mean"), "%.2f"),
+              _format(w["messages_per_node_per_sec"]))
+
+    print
+    for phase in PHASES:
+        stats = results[phase]
+        print "%-8s success=%s correct=%s p50=%sms p99=%sms " \
+              "latency inflation=%sx overhead=%sx" % (phase,
+              _format(stats["success_rate"], "%.1f%%", 100),
+              _format(stats["correct_rate"], "%.1f%%", 100),
+              _format(stats["latency_p50_ms"]),
+              _format(stats["latency_p99_ms"]),
+              _format(stats.get("latency_p50_inflation"), "%.2f"),
+              _format(stats.get("messages_per_node_per_sec_inflation"),
+                      "%.2f"))
+
+    repair = results["repair"]
+    print "repairs  %d joins, %d leaves, %d crashes (%d failed joins, " \
+          "%d unrepaired); time to repair p50=%ss p99=%ss; recovered in %ss" % (
+          repair["joins"], repair["leaves"], repair["crashes"],
+          repair["failed_joins"], repair["unrepaired"],
+          _format(repair["time_to_repair_s"].get("p50"), "%.2f"),
+          _format(repair["repair_p99_s"], "%.2f"),
+          _format(repair["recovery_s"], "%.2f"))
+
+    if args.output:
+        benchutils.save(args.output, results, suite="churn",
+                        nodes=args.nodes, network=args.network,
+                        seed=args.seed, converged=converged,
+                        churn_rate=args.churn_rate,
+                        lookup_rate=args.lookup_rate)
+
+    if args.baseline:
+        current = dict((k, v) for k, v in results.iteritems()
+                       if k != "timeline")
+        regressions = benchutils.compare_all(
+            current, benchutils.load(args.baseline),
+            [ ("success_rate", True), ("latency_p99_ms", False),
+              ("repair_p99_s", False) ],
+            args.tolerance)
+        return benchutils.report_regressions(regressions, None)
+    return 0
+
+
+def _format(value, fmt="%.1f", scale=1):
+    return "-" if value is None else fmt % (value * scale)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks a ring of peers under churn.")
+
+    parser.add_argument("-n", "--nodes", default=16, type=int,
+                        help="the number of peers in the ring to start with")
+    parser.add_argument("--network", default="loopback",
+                        choices=("loopback", "tcp"),
+                        help="whether peers talk in memory or over TCP")
+    parser.add_argument("-p", "--port", default=0xC1CA, type=int,
+                        help="the first port to listen on, for TCP")
+    parser.add_argument("--churn-rate", default=0.5, type=float,
+                        help="the joins and leaves per second, during churn")
+    parser.add_argument("--joins", default=0.5, type=float,
+                        help="the fraction of churn that is joins")
+    parser.add_argument("--graceful", default=0.5, type=float,
+                        help="the fraction of leaves that are graceful (the "
+                             "rest crash)")
+    parser.add_argument("--min-fraction", default=0.5, type=float,
+                        help="never shrink the ring below this fraction of "
+                             "its starting size")
+    parser.add_argument("--lookup-rate", default=20, type=float,
+                        help="the lookups to issue per second")
+    parser.add_argument("--warmup", default=10, type=float,
+                        help="the seconds to run without churn first")
+    parser.add_argument("--duration", default=60, type=float,
+                        help="the seconds to churn for")
+    parser.add_argument("--cooldown", default=30, type=float,
+                        help="the seconds to run without churn afterwards")
+    parser.add_argument("--window", default=5, type=int,
+                        help="the seconds per row of the timeline")
+    parser.add_argument("--timeout", default=10, type=float,
+                        help="the seconds after which a lookup (or a join) "
+                             "fails")
+    parser.add_argument("--converge-timeout", default=300, type=float,
+                        help="the seconds to wait for the ring to converge")
+    parser.add_argument("--seed", default=0xC1CA, type=int,
+                        help="seeds every random choice")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the results to this JSON file")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare the results to an earlier run's")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="how much worse (as a fraction) a statistic can "
+                             "be before it's a regression")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="include DEBUG-level output in the log")
+    sys.exit(main(parser.parse_args()))
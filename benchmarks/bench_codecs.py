@@ -0,0 +1,264 @@
+#!/usr/bin/env python2
+""" Micro-benchmarks for the packet codecs.
+
+Covers hashing, packing and unpacking `MessageContainer`s (in both formats),
+every Chord and Cicada message type, and the `ReadQueue` framing that splits a
+stream back into messages. Each benchmark reports operations and bytes per
+second, along with allocation counts; see `benchutils` for details. Counting
+every allocation takes an interpreter built with `COUNT_ALLOCS`, so on a stock
+one, only the objects that each call leaves behind for the garbage collector
+("kept") are reported.
+
+```bash
+$ python2 benchmarks/bench_codecs.py --output codecs.json
+$ python2 benchmarks/bench_codecs.py --baseline codecs.json --filter hash
+```
+"""
+
+import os
+import sys
+import random
+import argparse
+import functools
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from cicada.chordlib   import routing
+from cicada.chordlib   import chordnode
+from cicada.chordlib   import peersocket
+from cicada.packetlib  import chord
+from cicada.packetlib  import message
+from cicada.packetlib  import compact
+from cicada.packetlib  import cicada as cicadapkt
+
+import benchutils
+
+
+PAYLOAD_SIZES = (0, 64, 1024, 16384)
+STREAM_SIZES = (64, 1024, 16384)    # per message, for framing
+STREAM_MESSAGES = 32                # messages per framed stream
+
+
+def payload(size):
+    return ''.join([ chr(random.getrandbits(8)) for _ in xrange(size) ])
+
+
+def node(i):
+    return chordnode.ChordNode(routing.Hash(value=str(i)),
+                               ("127.0.0.%d" % (i % 250 + 1), 0xC1CA + i))
+
+
+def hash_benchmarks():
+    h = routing.Hash(value="benchmark")
+    raw, parts = str(h), h.parts
+    yield "hash/from_value", lambda: routing.Hash(value="benchmark"), 0
+    yield "hash/from_string", lambda: routing.Hash(hashed=raw), len(raw)
+    yield "hash/from_parts", lambda: routing.Hash(hashed=parts), len(raw)
+    yield "hash/pack_hash", lambda: routing.Hash.pack_hash(raw), len(raw)
+    yield "hash/unpack_hash", lambda: routing.Hash.unpack_hash(parts), len(raw)
+    yield "hash/int", lambda: int(h), 0
+    yield "hash/pack_int", lambda: routing.Hash.pack_int(int(h)), 0
+
+
+def forward(packed, sender):
+    """ Does what a node that's only routing a lookup does with it.
+    """
+    msg = message.MessageContainer.unpack(packed, lazy=True)
+    payload = msg.payload
+    chord.LookupRequest.peek(payload)
+    return message.MessageContainer(msg.type, sender, data=payload.tobytes(),
+                                    compressed=msg.compressed).pack()
+
+
+def forward_unpacked(packed, sender):
+    """ Forwards a lookup the way it was before `LookupRequest.peek`.
+    """
+    msg = message.MessageContainer.unpack(packed, lazy=True)
+    req = chord.LookupRequest.unpack(msg.data)
+    return chord.LookupRequest.make_packet(sender, req.lookup, req.data,
+                                           req.origin).pack()
+
+
+def container_benchmarks():
+    sender, target = routing.Hash(value="sender"), routing.Hash(value="target")
+    for size in PAYLOAD_SIZES:
+        # Routed application data is the bulk of what's on the wire.
+        msg = chord.LookupRequest.make_packet(sender, target, payload(size))
+        packed = msg.pack()
+
+        yield "container/pack/%d" % size, msg.pack, len(packed)
+        yield "container/unpack/%d" % size, \
+              functools.partial(message.MessageContainer.unpack, packed), \
+              len(packed)
+        yield "container/unpack_lazy/%d" % size, \
+              functools.partial(message.MessageContainer.unpack, packed,
+                                lazy=True), len(packed)
+        yield "container/forward/%d" % size, \
+              functools.partial(forward, packed, sender), len(packed)
+        yield "container/forward_unpacked/%d" % size, \
+              functools.partial(forward_unpacked, packed, sender), len(packed)
+
+        # Both ends of a connection remember the nodes they've seen, so the
+        # steady state is a receiver that already knows the sender.
+        tx, rx = compact.Session(), compact.Session()
+        tx.enabled = rx.enabled = True
+        compact.unpack(compact.pack(msg, tx), rx)
+        compacted = compact.pack(msg, tx)
+
+        yield "compact/pack/%d" % size, \
+              functools.partial(compact.pack, msg, tx), len(compacted)
+        yield "compact/unpack/%d" % size, \
+              functools.partial(compact.unpack, compacted, rx), len(compacted)
+
+
+def chord_benchmarks():
+    sender = routing.Hash(value="sender")
+    me = node(0)
+    others = [ node(i) for i in xrange(1, 17) ]
+
+    def request(cls, *args):
+        return cls.make_packet(sender, *args)
+
+    def response(cls, req, *args):
+        req.pack()  # responses need the request's checksum
+        return cls.make_packet(sender, *args, original=req)
+
+    info = request(chord.InfoRequest)
+    join = request(chord.JoinRequest, ("127.0.0.1", 0xC1CA))
+    notify = request(chord.NotifyRequest, me, others[0], others[1])
+    lookup = request(chord.LookupRequest, others[0].hash, "x" * 64, me)
+    quit = request(chord.QuitRequest, me, others[0], others[1], others[:4])
+    ping = request(chord.PingMessage, 0xC1CADA)
+
+    messages = [
+        ("info_request",    chord.InfoRequest, info),
+        ("info_response",   chord.InfoResponse, response(
+            chord.InfoResponse, info, me, others[0], others[1], others[:4])),
+        ("join_request",    chord.JoinRequest, join),
+        ("join_response",   chord.JoinResponse, response(
+            chord.JoinResponse, join, me, me, others[0], others[1],
+            others[:4], others)),
+        ("notify_request",  chord.NotifyRequest, notify),
+        ("notify_response", chord.NotifyResponse, response(
+            chord.NotifyResponse, notify, True)),
+        ("lookup_request",  chord.LookupRequest, lookup),
+        ("lookup_response", chord.LookupResponse, response(
+            chord.LookupResponse, lookup, others[0].hash, others[1].hash,
+            others[1].chord_addr, 3)),
+        ("quit_request",    chord.QuitRequest, quit),
+        ("quit_response",   chord.QuitResponse, response(
+            chord.QuitResponse, quit)),
+        ("ping",            chord.PingMessage, ping),
+        ("pong",            chord.PongMessage, response(
+            chord.PongMessage, ping, 0xC1CADA)),
+    ]
+
+    for name, cls, pkt in messages:
+        raw = pkt.data
+        body = cls.unpack(raw)
+        yield "chord/%s/pack" % name, body.pack, len(raw)
+        yield "chord/%s/unpack" % name, \
+              functools.partial(cls.unpack, raw), len(raw)
+
+
+def cicada_benchmarks():
+    hashes = [ routing.Hash(value=str(i)) for i in xrange(16) ]
+    for size in PAYLOAD_SIZES[1:]:
+        data = payload(size)
+        messages = [
+            ("data", cicadapkt.DataMessage.make_packet(data)),
+            ("broadcast", cicadapkt.BroadcastMessage.make_packet(
+                data, hashes[:8], visited=hashes[8:])),
+            ("stream", cicadapkt.StreamMessage.make_packet(1, 42, data)),
+        ]
+
+        for name, pkt in messages:
+            packed = pkt.pack()
+            yield "cicada/%s/pack/%d" % (name, size), pkt.pack, len(packed)
+            yield "cicada/%s/unpack/%d" % (name, size), \
+                  functools.partial(type(pkt).unpack, packed), len(packed)
+
+    ack = cicadapkt.StreamAckMessage.make_packet(1, 42, 16)
+    packed = ack.pack()
+    yield "cicada/stream_ack/pack", ack.pack, len(packed)
+    yield "cicada/stream_ack/unpack", \
+          functools.partial(cicadapkt.StreamAckMessage.unpack, packed), \
+          len(packed)
+
+
+def framing_benchmarks():
+    sender = routing.Hash(value="sender")
+    read_size = peersocket.PeerSocket.READ_SIZE
+
+    def frame(chunks):
+        queue = peersocket.ReadQueue()
+        for chunk in chunks: queue.read(chunk)
+        while queue.ready: queue.pop()
+
+    for size in STREAM_SIZES:
+        stream = ''.join([
+            message.MessageContainer(message.MessageType.MSG_CH_LOOKUP, sender,
+                                     data=payload(size)).pack()
+            for _ in xrange(STREAM_MESSAGES)
+        ])
+
+        # Reads come in as large as the socket allows, or byte-by-byte-ish.
+        for label, step in (("bulk", read_size), ("fragmented", 61)):
+            chunks = [
+                stream[i : i + step] for i in xrange(0, len(stream), step)
+            ]
+            yield "framing/%s/%d" % (label, size), \
+                  functools.partial(frame, chunks), len(stream)
+
+
+SUITES = [
+    hash_benchmarks, container_benchmarks, chord_benchmarks,
+    cicada_benchmarks, framing_benchmarks,
+]
+
+
+def main(args):
+    random.seed(args.seed)
+    results = {}
+    if not benchutils.COUNTS_ALLOCS:
+        print "# allocs are only counted by interpreters built with " \
+              "COUNT_ALLOCS (shown as '-');"
+        print "# kept is the garbage-collected objects left behind per call."
+    for suite in SUITES:
+        for name, fn, size in suite():
+            if args.filter and args.filter not in name: continue
+
+            stats = benchutils.measure(fn, size, args.time)
+            results[name] = stats
+            print "%-36s %12.0f ops/s %10.2f MB/s %8s allocs %6.2f kept" % (
+                  name, stats["ops_per_sec"], stats["bytes_per_sec"] / 2**20,
+                  "-" if stats["allocs_per_op"] is None else
+                  "%.1f" % stats["allocs_per_op"], stats["retained_per_op"])
+
+    if args.output:
+        benchutils.save(args.output, results, suite="codecs")
+
+    if args.baseline:
+        regressions = benchutils.compare(results, benchutils.load(args.baseline),
+                                         tolerance=args.tolerance)
+        return benchutils.report_regressions(regressions)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the packet codecs.")
+
+    parser.add_argument("--filter", metavar="TEXT",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--time", default=0.3, type=float, metavar="SECONDS",
+                        help="roughly how long to spend on each benchmark")
+    parser.add_argument("--seed", default=0xC1CA, type=int,
+                        help="seeds the random payloads")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the results to this JSON file")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare the results to an earlier run's")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="how much slower (as a fraction) a benchmark can "
+                             "be than the baseline before it's a regression")
+    sys.exit(main(parser.parse_args()))
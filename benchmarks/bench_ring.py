@@ -0,0 +1,500 @@
+#!/usr/bin/env python2
+""" End-to-end benchmarks of a ring of peers on this machine.
+
+Brings up a ring over TCP (on localhost) or the in-process loopback transport,
+waits for it to converge, then runs one or more workloads against it:
+
+    - lookup:       lookups of uniformly random values, from random peers
+    - send:         `SwarmPeer.send`s between random pairs of peers
+    - broadcast:    `SwarmPeer.broadcast`s from random peers
+    - mixed:        all of the above, interleaved (see `MIX`)
+
+For each, it reports throughput, latency percentiles, hop counts (for lookups;
+sends and broadcasts don't report theirs, so they show "n/a"), the messages
+(and bytes) sent per operation beyond the ring's idle maintenance traffic, and
+the CPU time of the whole process divided by the number of nodes (every node,
+along with the benchmark itself, shares one process, so there's no telling
+which node used what). Everything random -- including the protocol's own
+choices -- is seeded, so runs with the same seed do the same work.
+
+Latencies are dominated by how peers read from their sockets rather than by
+any work they do: after each pass over its sockets, a `SocketProcessor` pauses
+for 0.1 seconds, so under load, every message can wait up to that long at each
+peer it passes through. That's where a median latency of ~110ms comes from.
+
+```bash
+$ python2 benchmarks/bench_ring.py --nodes 32 --workload lookup,send \\
+      --ops 2000 --rate 500 --output ring.json
+```
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import resource
+import threading
+import collections
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from cicada             import swarmlib
+from cicada.chordlib    import L
+from cicada.chordlib    import clock
+from cicada.chordlib    import routing
+from cicada.chordlib    import convergence
+from cicada.chordlib    import transport as chtransport
+
+import benchutils
+
+
+WORKLOADS = ("lookup", "send", "broadcast", "mixed")
+MIX = (("lookup", 0.6), ("send", 0.3), ("broadcast", 0.1))
+
+
+class Ring(object):
+    """ A ring of peers in this process, and the traffic between them.
+
+    Peers can be added and removed while the ring is running; `peers` only ever
+    holds the ones that have joined and haven't been removed yet.
+    """
+    RECV_POLL = 0.2     # seconds between checks on whether to stop receiving
+
+    def __init__(self, count, network="loopback", port=0xC1CA, rng=random):
+        """ Creates the peers and joins each through a random earlier one.
+
+        :count          the number of peers
+        :network[="loopback"] "tcp" or "loopback"
+        :port[=0xC1CA]  the first port to bind to, for TCP
+        :rng[=random]   the source of random choices
+        """
+        self.messages = self.bytes = 0
+        self.on_message = lambda peer, source, data: None
+        self.network = network
+        self.port = port
+        self.rng = rng
+        self.transport = chtransport.TCP if network == "tcp" else \
+                         chtransport.LoopbackTransport()
+
+        self.peers = []
+        self._lock = threading.Lock()
+        self._running = True
+        self._created = 0
+        self._receivers = []
+        for _ in xrange(count):
+            self.add()
+
+    def add(self, timeout=10):
+        """ Creates a peer and joins it through a random existing one.
+
+        :timeout[=10]   the seconds to wait for the join to go through
+        :returns        the new `SwarmPeer`
+        :raises         whatever `SwarmPeer.connect()` does if the peer can't
+                        join; it's shut down before then
+        """
+        with self._lock:
+            address = self._address(self._created)
+            self._created += 1
+            via = self.rng.choice(self.peers).listener if self.peers else None
+
+        peer = swarmlib.SwarmPeer(hooks={ "send": self._on_send },
+                                  transport=self.transport)
+        peer.bind(*address)
+        try:
+            if via is not None: peer.connect(via[0], via[1], timeout)
+        except Exception:
+            self._halt([ peer ], 0)
+            raise
+
+        receiver = threading.Thread(target=self._receive, args=(peer, ))
+        receiver.daemon = True
+        with self._lock:
+            self.peers.append(peer)
+            self._receivers.append(receiver)
+        receiver.start()
+        return peer
+
+    def remove(self, peer, graceful=True, timeout=5):
+        """ Takes a peer out of the ring.
+
+        :peer           one of the `SwarmPeer`s in `peers`
+        :graceful[=True] whether the peer leaves properly (see
+                        `LocalNode.leave_ring`) or drops every connection
+                        without a word, as if it crashed
+        :timeout[=5]    the seconds to wait on each of its threads
+        """
+        with self._lock:
+            self.peers.remove(peer)
+
+        node = peer.peer
+        if graceful:
+            node.leave_ring()
+        else:
+            # Stop everything first, so nothing gets to react to the closes.
+            for thread in self._threads([ peer ]): thread.stop_running()
+            for sock in node.processor.sockets:
+                if sock.valid: sock.close()
+
+        node.listen_thread.stop_running()
+        node.listener.close()
+        self._halt([ peer ], timeout)
+
+    def converge(self, timeout):
+        """ Waits for the ring to converge.
+
+        :returns    the seconds it took, or `None` if it didn't
+        """
+        start = time.time()
+        state = convergence.wait_until_converged(
+            [ peer.peer for peer in self.peers ], timeout, 0.5)
+        return time.time() - start if state else None
+
+    def traffic(self):
+        """ The number of messages and bytes sent by every peer so far.
+        """
+        with self._lock:
+            return self.messages, self.bytes
+
+    def stop(self, timeout=5):
+        """ Stops every peer's threads.
+
+        Unlike calling `SwarmPeer.close()` on each peer in turn, this tells
+        every thread to stop before waiting on any of them, so stopping takes
+        about as long for a hundred peers as it does for one.
+        """
+        self._running = False
+        self._halt(self.peers, timeout)
+        for thread in self._receivers: thread.join(timeout)
+
+    def _address(self, index):
+        if self.network == "tcp":
+            return ("127.0.0.1", self.port + index)
+        index += 1
+        return ("10.%d.%d.%d" % (index >> 16 & 0xFF, index >> 8 & 0xFF,
+                                 index & 0xFF), 0xC1CA)
+
+    def _threads(self, peers):
+        threads = []
+        for peer in peers:
+            node = peer.peer
+            threads.extend([ node.stable, node.router, node.heartbeat,
+                             node.processor, node.listen_thread ])
+        return threads
+
+    def _halt(self, peers, timeout):
+        threads = self._threads(peers)
+        for thread in threads: thread.stop_running()
+        for peer in peers: peer.workers.stop(0)
+        for thread in threads: thread.join(timeout)
+        for peer in peers: peer.workers.stop(timeout)
+
+    def _on_send(self, sock, data):
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(data)
+
+    def _receive(self, peer):
+        while self._running and peer in self.peers:
+            for source, data in peer.recv_many(timeout=self.RECV_POLL):
+                self.on_message(peer, source, data)
+
+
+class Tracker(object):
+    """ Keeps track of outstanding operations and how they turned out.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = {}           # { op id: start time }
+        self.expected = {}          # { op id: deliveries still expected }
+        self.latencies = collections.defaultdict(list)  # { kind: [ seconds ] }
+        self.hops = []
+        self.failed = collections.Counter()             # { kind: count }
+        self.completed = collections.Counter()          # { kind: count }
+        self.deliveries = collections.Counter()         # { kind: count }
+        self.kinds = {}             # { op id: kind }
+
+    def start(self, op, kind, expected=1):
+        with self.lock:
+            self.started[op] = time.time()
+            self.expected[op] = expected
+            self.kinds[op] = kind
+
+    def finish(self, op, hops=None, ok=True):
+        """ Records a delivery (or a failure) for an operation.
+        """
+        now = time.time()
+        with self.lock:
+            if op not in self.expected: return     # late or duplicated
+            kind = self.kinds[op]
+            if not ok:
+                self.failed[kind] += 1
+                del self.expected[op]
+                return
+
+            self.latencies[kind].append(now - self.started[op])
+            self.deliveries[kind] += 1
+            if hops is not None: self.hops.append(hops)
+
+            self.expected[op] -= 1
+            if not self.expected[op]:
+                del self.expected[op]
+                self.completed[kind] += 1
+
+    @property
+    def outstanding(self):
+        with self.lock:
+            return len(self.expected)
+
+    def expire(self):
+        """ Counts everything that's still outstanding as failed.
+        """
+        with self.lock:
+            for op in self.expected:
+                self.failed[self.kinds[op]] += 1
+            self.expected.clear()
+
+
+class Workload(object):
+    """ Runs operations against a ring at a target rate.
+    """
+    def __init__(self, ring, rng, size=64, concurrency=8, op_timeout=10):
+        self.ring = ring
+        self.rng = rng
+        self.size = size
+        self.concurrency = concurrency
+        self.op_timeout = op_timeout
+        self.tracker = Tracker()
+        self._ops = 0
+        ring.on_message = self._on_message
+
+    def run(self, kind, count, rate=0):
+        """ Runs `count` operations of a kind, at `rate` per second (if set).
+
+        :returns    a dictionary of the results
+        """
+        # Decide on everything up front, so that the seed alone decides it.
+        plan = [ self._plan(self._pick(kind)) for _ in xrange(count) ]
+        self.tracker = Tracker()
+        messages, size = self.ring.traffic()
+        cpu, start = _cpu_time(), time.time()
+
+        queue = collections.deque(enumerate(plan))
+        def issue():
+            while True:
+                try:
+                    index, op = queue.popleft()
+                except IndexError:
+                    return
+
+                if rate:
+                    delay = start + float(index) / rate - time.time()
+                    if delay > 0: time.sleep(delay)
+                self._issue(*op)
+
+        threads = [
+            threading.Thread(target=issue) for _ in xrange(self.concurrency)
+        ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        deadline = time.time() + self.op_timeout
+        while self.tracker.outstanding and time.time() < deadline:
+            time.sleep(0.05)
+        self.tracker.expire()
+
+        duration = time.time() - start
+        messages, size = [
+            b - a for a, b in zip((messages, size), self.ring.traffic())
+        ]
+        return self._results(count, duration, messages, size,
+                             _cpu_time() - cpu)
+
+    def _pick(self, kind):
+        if kind != "mixed": return kind
+
+        roll = self.rng.random()
+        for choice, weight in MIX:
+            if roll < weight: return choice
+            roll -= weight
+        return MIX[-1][0]
+
+    def _plan(self, kind):
+        peers = self.ring.peers
+        self._ops += 1
+        src = self.rng.choice(peers)
+        if kind == "lookup":
+            target = routing.Hash(value=str(self.rng.getrandbits(64)))
+        elif kind == "send":
+            target = self.rng.choice([ p for p in peers if p is not src ])
+        else:
+            target = None
+        return self._ops, kind, src, target
+
+    def _issue(self, op, kind, src, target):
+        if kind == "lookup":
+            done = threading.Event()
+            def on_result(result, response):
+                self.tracker.finish(op, response.hops if response else 0,
+                                    result is not None)
+                done.set()
+
+            self.tracker.start(op, kind)
+            src.peer.lookup(target, on_result, 0)
+            done.wait(self.op_timeout)
+            return
+
+        data = ("%s:%d:" % (kind, op)).ljust(self.size, ".")
+        if kind == "send":
+            self.tracker.start(op, kind)
+            src.send(target, data)
+        else:
+            self.tracker.start(op, kind, len(self.ring.peers) - 1)
+            src.broadcast(data)
+
+    def _on_message(self, peer, source, data):
+        try:
+            _, op, _ = data.split(":", 2)
+            self.tracker.finish(int(op))
+        except ValueError:
+            pass
+
+    def _results(self, count, duration, messages, size, cpu):
+        tracker = self.tracker
+        latencies = sum(tracker.latencies.values(), [])
+        completed = sum(tracker.completed.values())
+        nodes = len(self.ring.peers)
+
+        results = {
+            "ops":              count,
+            "completed":        completed,
+            "failed":           sum(tracker.failed.values()),
+            "duration":         duration,
+            "ops_per_sec":      completed / duration if duration else 0,
+            "latency_ms":       benchutils.summarize(latencies, 1000),
+            "hops":             benchutils.summarize(tracker.hops),
+            "messages_per_op":  float(messages) / count if count else 0,
+            "bytes_per_op":     float(size) / count if count else 0,
+            "cpu_seconds":      cpu,
+            "process_cpu_per_node": cpu / nodes,    # see the module docstring
+            "by_kind":          dict((kind, {
+                "completed":    tracker.completed[kind],
+                "failed":       tracker.failed[kind],
+                "latency_ms":   benchutils.summarize(values, 1000),
+            }) for kind, values in tracker.latencies.iteritems()),
+        }
+
+        results["latency_p99_ms"] = results["latency_ms"].get("p99")
+        if tracker.deliveries["broadcast"]:
+            expected = (tracker.completed["broadcast"] +
+                        tracker.failed["broadcast"]) * (nodes - 1)
+            results["broadcast_coverage"] = \
+                float(tracker.deliveries["broadcast"]) / max(1, expected)
+
+        return results
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main(args):
+    # The protocol's own random choices come from the clock's generator.
+    random.seed(args.seed)
+    clock.install(clock.SystemClock(args.seed))
+    rng = random.Random(args.seed)
+    L.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+
+    print "Starting %d peers over %s..." % (args.nodes, args.network)
+    ring = Ring(args.nodes, args.network, args.port, rng)
+    converged = ring.converge(args.converge_timeout)
+    if converged is None:
+        print "The ring didn't converge within %ds." % args.converge_timeout
+        return 2
+    print "Converged in %.1fs." % converged
+
+    # Whatever the ring sends while idle isn't the workload's doing.
+    idle, _ = ring.traffic()
+    time.sleep(args.idle)
+    idle_rate = (ring.traffic()[0] - idle) / float(args.idle or 1)
+
+    workload = Workload(ring, rng, args.size, args.concurrency, args.timeout)
+    results = {}
+    for kind in args.workload.split(","):
+        stats = workload.run(kind, args.ops, args.rate)
+        stats["messages_per_op"] -= idle_rate * stats["duration"] / args.ops
+        results[kind] = stats
+
+        latency, hops = stats["latency_ms"], stats["hops"]
+        print "%-10s %8.1f ops/s  p50=%.1fms p95=%.1fms p99=%.1fms  " \
+              "hops=%s  msgs/op=%.1f  process cpu/node=%.3fs  failed=%d" % (
+              kind, stats["ops_per_sec"], latency.get("p50", 0),
+              latency.get("p95", 0), latency.get("p99", 0),
+              "%.2f" % hops["mean"] if hops["count"] else "n/a",
+              stats["messages_per_op"], stats["process_cpu_per_node"],
+              stats["failed"])
+
+    ring.stop()
+    if args.output:
+        benchutils.save(args.output, results, suite="ring",
+                        nodes=args.nodes, network=args.network,
+                        seed=args.seed, converged=converged,
+                        idle_messages_per_sec=idle_rate)
+
+    if args.baseline:
+        regressions = benchutils.compare_all(
+            results, benchutils.load(args.baseline),
+            [ ("ops_per_sec", True), ("latency_p99_ms", False) ],
+            args.tolerance)
+        return benchutils.report_regressions(regressions, None)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks a ring of peers on this machine.")
+
+    parser.add_argument("-n", "--nodes", default=16, type=int,
+                        help="the number of peers in the ring")
+    parser.add_argument("--network", default="loopback",
+                        choices=("loopback", "tcp"),
+                        help="whether peers talk in memory or over TCP")
+    parser.add_argument("-p", "--port", default=0xC1CA, type=int,
+                        help="the first port to listen on, for TCP")
+    parser.add_argument("-w", "--workload", default=",".join(WORKLOADS),
+                        help="a comma-separated list of workloads to run, "
+                             "out of: %s" % ", ".join(WORKLOADS))
+    parser.add_argument("--ops", default=1000, type=int,
+                        help="the number of operations per workload")
+    parser.add_argument("--rate", default=0, type=float,
+                        help="the operations to issue per second (by default, "
+                             "as fast as possible)")
+    parser.add_argument("--concurrency", default=8, type=int,
+                        help="the number of operations in flight at once")
+    parser.add_argument("--size", default=64, type=int,
+                        help="the bytes of data per send or broadcast")
+    parser.add_argument("--timeout", default=10, type=float,
+                        help="the seconds after which an operation fails")
+    parser.add_argument("--converge-timeout", default=300, type=float,
+                        help="the seconds to wait for the ring to converge")
+    parser.add_argument("--idle", default=2, type=float,
+                        help="the seconds to measure idle traffic for")
+    parser.add_argument("--seed", default=0xC1CA, type=int,
+                        help="seeds every random choice")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the results to this JSON file")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare the results to an earlier run's")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="how much worse (as a fraction) throughput or "
+                             "tail latency can be before it's a regression")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="include DEBUG-level output in the log")
+    args = parser.parse_args()
+
+    for kind in args.workload.split(","):
+        if kind not in WORKLOADS:
+            parser.error("unknown workload: %s" % kind)
+
+    sys.exit(main(args))
@@ -0,0 +1,206 @@
+""" Shared plumbing for the benchmarks: timing, statistics, and results.
+
+Results are written as JSON so that runs can be compared against each other:
+
+```bash
+$ python2 benchmarks/bench_codecs.py --output baseline.json
+  ... make some changes ...
+$ python2 benchmarks/bench_codecs.py --baseline baseline.json
+```
+
+Comparing prints every benchmark that got slower than the baseline by more than
+the tolerance, and exits with a non-zero status if there were any.
+"""
+
+import gc
+import sys
+import json
+import time
+import platform
+
+
+# Only interpreters built with `COUNT_ALLOCS` (never the stock ones) can count
+# every allocation; see `count_allocations()`.
+COUNTS_ALLOCS = hasattr(sys, "getcounts")
+
+
+def measure(fn, size=0, min_time=0.5, repeat=3):
+    """ Times how fast a callable runs.
+
+    The number of calls per run is scaled up until a run takes a reasonable
+    amount of time, and the best of several runs is kept (slower ones are just
+    noise from the rest of the system).
+
+    :fn             the callable to time, with no arguments
+    :size[=0]       the number of bytes each call processes, if any
+    :min_time[=0.5] roughly how many seconds to spend on measuring
+    :repeat[=3]     the number of runs to take the best of
+    :returns        a dictionary of "ops_per_sec", "bytes_per_sec",
+                    "allocs_per_op", and "retained_per_op"
+    """
+    n = 1
+    while True:
+        elapsed = _time_calls(fn, n)
+        if elapsed >= min_time / (repeat * 10) or n >= 10 ** 7: break
+        n *= 10
+
+    n = max(1, int(n * (min_time / repeat) / max(elapsed, 1e-9)))
+    best = min([ _time_calls(fn, n) for _ in xrange(repeat) ])
+    ops = n / max(best, 1e-9)
+
+    allocs, retained = count_allocations(fn, min(n, 1000))
+    return {
+        "ops_per_sec":      ops,
+        "bytes_per_sec":    ops * size,
+        "allocs_per_op":    allocs,
+        "retained_per_op":  retained,
+    }
+
+
+def count_allocations(fn, n):
+    """ Counts the objects that a callable allocates, on average.
+
+    Only interpreters built with `COUNT_ALLOCS` keep track of every allocation,
+    so elsewhere (including stock CPython), `allocs` is `None`. Python 2 has no
+    other way to see allocations that are freed again: there's no `tracemalloc`
+    and no `gc` callbacks. What can always be counted is how many
+    garbage-collected objects (lists, dicts, instances, and so on) each call
+    leaves behind, which is what drives the cost of collections.
+
+    :returns    a 2-tuple of the allocations and the retained objects per call
+    """
+    allocs = None
+    counts = sys.getcounts if COUNTS_ALLOCS else None
+    if counts is not None:
+        before = sum([ c[1] for c in counts() ])
+
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in xrange(n): fn()
+        retained = gc.get_count()[0]
+    finally:
+        if enabled: gc.enable()
+
+    if counts is not None:
+        allocs = float(sum([ c[1] for c in counts() ]) - before) / n
+    return allocs, float(retained) / n
+
+
+def _time_calls(fn, n):
+    start = time.time()
+    for _ in xrange(n): fn()
+    return time.time() - start
+
+
+def percentile(values, p):
+    """ Finds the `p`th percentile (from 0 to 100) of some values.
+    """
+    if not values: return None
+    ordered = sorted(values)
+    index = int(round((p / 100.0) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(values, scale=1):
+    """ Describes the distribution of some values (like latencies).
+
+    :scale[=1]  multiplies every statistic, e.g. by 1000 to go from seconds
+                to milliseconds
+    """
+    if not values:
+        return { "count": 0 }
+
+    return {
+        "count":    len(values),
+        "mean":     scale * float(sum(values)) / len(values),
+        "p50":      scale * percentile(values, 50),
+        "p95":      scale * percentile(values, 95),
+        "p99":      scale * percentile(values, 99),
+        "max":      scale * max(values),
+    }
+
+
+def environment():
+    """ Describes what the benchmarks ran on, to tell incomparable runs apart.
+    """
+    return {
+        "python":   platform.python_version(),
+        "platform": platform.platform(),
+        "time":     time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save(path, results, **meta):
+    """ Writes results (and where they came from) to a JSON file.
+    """
+    meta.update(environment())
+    with open(path, "w") as f:
+        json.dump({ "meta": meta, "results": results }, f, indent=2,
+                  sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(results, baseline, key="ops_per_sec", tolerance=0.1,
+            higher_is_better=True):
+    """ Finds the benchmarks that regressed compared to a baseline.
+
+    :results        the current results, as { name: { key: value } }
+    :baseline       results from an earlier run, in the same format
+    :key[="ops_per_sec"]    the statistic to compare
+    :tolerance[=0.1]        the fraction that a statistic can get worse by
+                            before it's considered a regression
+    :higher_is_better[=True] the direction in which `key` improves
+    :returns        a list of (name, baseline value, current value) tuples
+    """
+    regressions = []
+    for name, stats in sorted(results.iteritems()):
+        old = baseline.get(name, {}).get(key)
+        new = stats.get(key)
+        if old is None or new is None: continue
+
+        if higher_is_better:
+            worse = new < old * (1 - tolerance)
+        else:
+            worse = new > old * (1 + tolerance)
+
+        if worse: regressions.append((name, old, new))
+
+    return regressions
+
+
+def compare_all(results, baseline, keys, tolerance=0.1):
+    """ Compares several statistics at once (see `compare()`).
+
+    :keys       a list of (key, higher_is_better) pairs
+    :returns    a list of ("name/key", baseline value, current value) tuples
+    """
+    regressions = []
+    for key, higher_is_better in keys:
+        regressions.extend([
+            ("%s/%s" % (name, key), old, new)
+            for name, old, new in compare(results, baseline, key, tolerance,
+                                          higher_is_better)
+        ])
+    return regressions
+
+
+def report_regressions(regressions, key="ops_per_sec"):
+    """ Prints regressions, returning an appropriate exit status.
+
+    :key[="ops_per_sec"]    the statistic that was compared, or `None` if the
+                            names already say (as with `compare_all()`)
+    """
+    for name, old, new in regressions:
+        change = 100.0 * (new - old) / old if old else float("inf")
+        print "REGRESSION %s: %s%.4g -> %.4g (%+.1f%%)" % (
+              name, "%s " % key if key else "", old, new, change)
+
+    if not regressions:
+        print "No regressions."
+    return 1 if regressions else 0
@@ -3,11 +3,11 @@
 
 import threading
 import socket
-import random
 import time
 import enum
 
 from ..chordlib import L
+from ..chordlib import clock
 from ..chordlib import routing
 from ..chordlib import utils as chutils
 
@@ -15,7 +15,7 @@ from ..chordlib import utils as chutils
 def sleeper(a, b):
     """ Returns a function that, when called, sleeps between `a` & `b` seconds.
     """
-    return lambda: random.randint(a, b)
+    return lambda: clock.rng().randint(a, b)
 
 
 class Stabilizer(chutils.InfiniteThread):
@@ -49,6 +49,10 @@ class ChordNode(object):
     computed locally. All other properties may involve network communication, so
     we don't define those.
     """
+    # Peers hold onto each other's successor lists, so there are a lot of these.
+    __slots__ = ("hash", "chord_addr", "_predecessor", "_successor",
+                 "successor_list")
+
     def __init__(self, node_hash, listener_addr):
         """ Initializes internal structures.
 
@@ -68,6 +72,9 @@ class ChordNode(object):
         self._predecessor = None
         self._successor = None
 
+        # The nearest successors of the node (nearest first), if known.
+        self.successor_list = []
+
     @property
     def is_valid(self):
         raise NotImplementedError()
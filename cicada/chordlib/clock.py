@@ -0,0 +1,157 @@
+""" Provides the notion of time (and randomness) that the Chord layer runs on.
+
+Everything that sleeps, times out, or timestamps something goes through the
+clock that's currently installed. By default, that's the system's wall clock.
+
+A `VirtualClock` instead keeps its own time, which only moves forward once
+every thread running on it is asleep. It then jumps straight to the next
+thread's wake-up time, so periods of idling (stabilization intervals,
+heartbeats, and so on) take no real time at all. Random choices are drawn from
+a seeded generator, so they're reproducible. (The order in which threads run is
+still up to the OS, so runs aren't _entirely_ deterministic.)
+
+Install a clock before creating any nodes:
+
+```python
+    from cicada.chordlib import clock
+    clock.install(clock.VirtualClock(seed=42))
+```
+"""
+
+import time as systime
+import heapq
+import random as sysrandom
+import itertools
+import threading
+
+
+class SystemClock(object):
+    """ The real wall clock.
+    """
+    def __init__(self, seed=None):
+        self.random = sysrandom.Random(seed)
+
+    def time(self):
+        return systime.time()
+
+    def sleep(self, seconds):
+        systime.sleep(seconds)
+
+    def wait(self, event, timeout=None):
+        """ Waits for a `threading.Event` to be set.
+
+        :returns    whether or not the event was set before the timeout
+        """
+        return event.wait(timeout)
+
+    def io_timeout(self, timeout):
+        """ Returns how long to block on I/O (like `select()`), in real time.
+        """
+        return timeout
+
+    def enter(self, thread=None):
+        """ Marks a thread (by default, the current one) as holding up time.
+
+        While a thread on the clock is awake, time stands still, so this can
+        also be used to set things up without any time passing.
+        """
+
+    def leave(self, thread=None):
+        """ Marks a thread (by default, the current one) as no longer running.
+        """
+
+
+class VirtualClock(SystemClock):
+    """ A clock that skips ahead whenever everything is waiting on it.
+
+    Threads that `enter()` the clock hold time still while they're awake.
+    Other threads can sleep on it too, but time doesn't wait for them.
+    """
+    QUANTUM = 0.01  # virtual seconds between checks when waiting on an event
+
+    def __init__(self, seed=None, start=0):
+        """ Starts the clock.
+
+        :seed[=None]    seeds the random choices made on this clock
+        :start[=0]      the initial time
+        """
+        super(VirtualClock, self).__init__(seed)
+        self._now = start
+        self._lock = threading.Lock()
+        self._order = itertools.count()     # breaks ties in wake-up times
+        self._sleepers = []     # heap: [ (wake-up time, order, Event, Thread) ]
+        self._threads = set()   # the threads that time waits on
+        self._asleep = set()    # ... and which of those are sleeping
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        if seconds <= 0: return
+
+        me = threading.current_thread()
+        wakeup = threading.Event()
+        with self._lock:
+            heapq.heappush(self._sleepers, (self._now + seconds,
+                                            next(self._order), wakeup, me))
+            if me in self._threads: self._asleep.add(me)
+            self._advance()
+
+        wakeup.wait()
+
+    def wait(self, event, timeout=None):
+        deadline = None if timeout is None else self._now + timeout
+        while not event.is_set():
+            if deadline is not None and self._now >= deadline:
+                return False
+            self.sleep(self.QUANTUM)
+        return True
+
+    def io_timeout(self, timeout):
+        return 0    # threads pace themselves with (virtual) sleeps instead
+
+    def enter(self, thread=None):
+        with self._lock:
+            self._threads.add(thread or threading.current_thread())
+
+    def leave(self, thread=None):
+        thread = thread or threading.current_thread()
+        with self._lock:
+            self._threads.discard(thread)
+            self._asleep.discard(thread)
+            self._advance()
+
+    def _advance(self):
+        """ Wakes up the next sleepers, if nobody else is awake.
+        """
+        if len(self._asleep) < len(self._threads) or not self._sleepers:
+            return
+
+        self._now = max(self._now, self._sleepers[0][0])
+        while self._sleepers and self._sleepers[0][0] <= self._now:
+            _, _, wakeup, thread = heapq.heappop(self._sleepers)
+            self._asleep.discard(thread)
+            wakeup.set()
+
+
+_clock = SystemClock()
+
+
+def install(clock):
+    """ Makes a clock the one that everything runs on.
+
+    :returns    the previously-installed clock
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def get():
+    return _clock
+
+def time():                         return _clock.time()
+def sleep(seconds):                 return _clock.sleep(seconds)
+def wait(event, timeout=None):      return _clock.wait(event, timeout)
+def io_timeout(timeout):            return _clock.io_timeout(timeout)
+def rng():                          return _clock.random
@@ -2,16 +2,19 @@ import threading
 import select
 import socket
 import struct
-import random
 import time
 import sys
 
 from ..chordlib  import utils as chutils
+from ..chordlib  import clock
+from ..chordlib  import metrics as chmetrics
 from ..packetlib import chord as chordpkt
 
 from   ..chordlib  import L
 from   ..chordlib  import peersocket
+from   ..chordlib  import transport as chtransport
 from   ..packetlib import message
+from   ..packetlib import compression
 
 
 class ListenerThread(chutils.InfiniteThread):
@@ -35,8 +38,12 @@ class ListenerThread(chutils.InfiniteThread):
         self.listener = sock
 
     def _loop_method(self):
-        rd, _, er = select.select([self.listener], [], [self.listener],
-                                  self.timeout)
+        self.poll(clock.io_timeout(self.timeout))
+
+    def poll(self, timeout):
+        """ Accepts a pending connection, waiting up to `timeout` seconds.
+        """
+        rd, er = self.listener.transport.select([self.listener], timeout)
         if rd:
             client = self.listener.accept()
             L.info("Incoming peer: %s:%d", *client.remote)
@@ -71,11 +78,23 @@ class SocketProcessor(chutils.InfiniteThread):
         :message    the request we're sending
         :event      either a callback function or a `threading.Event` to trigger
                     when the response is received
+        :deadline[=None]    when (by `clock.time()`) to give up on the response,
+                            if ever
         """
-        def __init__(self, message, event):
+        __slots__ = ("request", "response", "response_socket", "event",
+                     "deadline")
+
+        def __init__(self, message, event, deadline=None):
             self.request = message
             self.response = None
             self.event = event
+            self.deadline = deadline
+
+        @property
+        def is_blocking(self):
+            """ Whether a caller is blocked waiting to look up the response.
+            """
+            return isinstance(self.event, threading.Event().__class__)
 
         def trigger(self, receiver, response):
             self.response_socket = receiver
@@ -83,7 +102,7 @@ class SocketProcessor(chutils.InfiniteThread):
 
             # For whatever reason, they made `Event` a function that returns an
             # _Event object, so...
-            if isinstance(self.event, threading.Event().__class__):
+            if self.is_blocking:
                 self.event.set()
             elif self.event is not None:
                 self.event(receiver, self.response)
@@ -92,6 +111,9 @@ class SocketProcessor(chutils.InfiniteThread):
     class MessageStream(object):
         """ A one-way series of messages with increasing sequence numbers.
         """
+        __slots__ = ("base_seq", "current", "generic_handler", "completed",
+                     "failed", "pending", "lock")
+
         def __init__(self, on_request, start_seq=None):
             """ Creates a stream.
 
@@ -106,12 +128,16 @@ class SocketProcessor(chutils.InfiniteThread):
             # We make the starting sequence a random value between [1, 2^31),
             # which lets us have a full 2^31 messages before overflowing in the
             # worst case.
-            self.base_seq = start_seq or random.randint(1, 2 ** 31)
+            self.base_seq = start_seq or clock.rng().randint(1, 2 ** 31)
             self.current  = self.base_seq
 
             self.generic_handler = on_request
+            # Only blocking requests look their responses up again, so these
+            # don't hold onto the (far more common) fire & forget ones.
             self.completed = chutils.FixedStack(24)
-            self.pending, self.failed = [], []       # [ RequestResponse() ]
+            self.failed = chutils.FixedStack(24)
+            self.pending = []                       # [ RequestResponse() ]
+            self.lock = threading.Lock()            # guards `pending`
 
         def finalize(self, msg):
             """ Given a full packet instance, inject the sequence number.
@@ -119,33 +145,70 @@ class SocketProcessor(chutils.InfiniteThread):
             msg.seq = self.current
             self.current += 1
 
-        def add_request(self, request, event):
+        def add_request(self, request, event, deadline=None):
             """ Triggers an event when a message receives a response.
             """
-            self.pending.append(SocketProcessor.RequestResponse(request, event))
+            pair = SocketProcessor.RequestResponse(request, event, deadline)
+            with self.lock:
+                self.pending.append(pair)
 
         def complete(self, pair, responder, response):
             """ Signifies that a request-response pair is complete.
+
+            :returns    whether or not it was still pending; it may have
+                        expired (or been dropped) in the meantime
             """
-            if pair not in self.pending:
-                raise ValueError("expected valid pair, not found! %s" % pair)
+            with self.lock:
+                if pair not in self.pending: return False
+                if pair.is_blocking: self.completed.append(pair)
+                self.pending.remove(pair)
 
-            self.completed.append(pair)
-            self.pending.remove(pair)
             pair.trigger(responder, response)
+            return True
 
         def fail(self, pair, responder):
             """ Signifies that a request-response pair has failed.
+
+            :returns    see `complete()`
             """
-            if pair not in self.pending:
-                raise ValueError("expected valid pair, not found! %s" % pair)
+            with self.lock:
+                if pair not in self.pending: return False
+                if pair.is_blocking: self.failed.append(pair)
+                self.pending.remove(pair)
 
-            self.failed.append(pair)
-            self.pending.remove(pair)
             pair.trigger(responder, None)
+            return True
 
+        def drop(self, seq):
+            """ Forgets about a pending request without triggering it.
+            """
+            with self.lock:
+                self.pending = filter(lambda p: p.request.seq != seq,
+                                      self.pending)
 
-    def __init__(self, on_shutdown, on_error):
+        def expired(self, now):
+            """ Finds the pending requests whose deadlines have passed.
+
+            :returns    a 2-tuple of a list of them and the earliest deadline
+                        of the rest (or `None`, if none of them have one)
+            """
+            expired, upcoming = [], None
+            with self.lock:
+                for pair in self.pending:
+                    if pair.deadline is None: continue
+                    if pair.deadline <= now:
+                        expired.append(pair)
+                    elif upcoming is None or pair.deadline < upcoming:
+                        upcoming = pair.deadline
+
+            return expired, upcoming
+
+
+    def __init__(self, on_shutdown, on_error,
+                 on_message=lambda *args: None,
+                 on_outgoing=lambda *args: None,
+                 transport=chtransport.TCP,
+                 metrics=None):
         """ Creates a socket processing thread.
 
         This manages a set of `PeerSocket`s with particular _generic_ request
@@ -181,12 +244,56 @@ class SocketProcessor(chutils.InfiniteThread):
         :on_error       a handler to be called when a socket goes down
                         unexpectedly, such as because of an exception, called
                         like so: `on_error(PeerSocket)`
+
+        :on_message[=n/a]   a handler called for every message we receive,
+                            before it's dispatched:
+                                `on_message(PeerSocket, msg)`
+
+        :on_outgoing[=n/a]  a handler called for every message right before we
+                            send it, so it can still be modified (for example,
+                            to add extensions): `on_outgoing(PeerSocket, msg)`
+
+        :transport[=TCP]    the `transport.Transport` that the sockets we'll
+                            manage were created on, which polls them
+
+        :metrics[=None]     the `metrics.Registry` to record traffic, pending
+                            requests, and timeouts in; by default, we keep
+                            our own
         """
         super(SocketProcessor, self).__init__(pause=0.1)
 
         self._peer_streams = {}   # dict -> { PeerSocket: MessageStream }
+        self._next_expiry = None  # the earliest deadline of any request
+        self._expiry_lock = threading.Lock()
         self.on_shutdown = on_shutdown
         self.on_error = on_error
+        self.on_message = on_message
+        self.on_outgoing = on_outgoing
+        self.transport = transport
+
+        self.metrics = chmetrics.Registry() if metrics is None else metrics
+        self.traffic = peersocket.TrafficMetrics(self.metrics)
+        self.timeouts = self.metrics.counter("request_timeouts_total",
+            "Requests that didn't get a response in time.")
+        self.metrics.gauge("requests_pending",
+            "Requests still waiting on a response.",
+            fn=lambda: sum([
+                len(s.pending) for s in self._peer_streams.values()
+            ]))
+        self.metrics.gauge("sockets", "Connections being processed.",
+                           fn=lambda: self.connections)
+
+    @property
+    def connections(self):
+        """ The number of sockets that are being processed.
+        """
+        return len(self._peer_streams)
+
+    @property
+    def sockets(self):
+        """ A list of the sockets that are being processed.
+        """
+        return self._peer_streams.keys()
 
     def add_socket(self, peer, on_request):
         """ Adds a new socket to manage.
@@ -213,6 +320,7 @@ class SocketProcessor(chutils.InfiniteThread):
                 repr(peer.remote), len(self._peer_streams) + 1)
 
         self._peer_streams[peer] = SocketProcessor.MessageStream(on_request)
+        peer.metrics = self.traffic
 
     def shutdown_socket(self, peer):
         """ Cleanly shuts down an existing socket.
@@ -234,7 +342,7 @@ class SocketProcessor(chutils.InfiniteThread):
         peer.shutdown()
         return True
 
-    def prepare_request(self, receiver, message, event):
+    def prepare_request(self, receiver, message, event, deadline=None):
         """ Adds an event to wait for a response to the given message.
 
         A request may fail to prepare if the socket doesn't exist in this
@@ -249,6 +357,7 @@ class SocketProcessor(chutils.InfiniteThread):
             stream state. A packet with a matching sequence number is considered
             the response.
         :event      the threading event object to signal on receipt
+        :deadline[=None]    when to give up on the response, if ever
 
         :returns    whether or not the request was successfully prepared
         """
@@ -258,7 +367,7 @@ class SocketProcessor(chutils.InfiniteThread):
 
         stream = self._peer_streams[receiver]
         stream.finalize(message)    # injects sequence number
-        stream.add_request(message, event)
+        stream.add_request(message, event, deadline)
         return True
 
     def response(self, peer, response):
@@ -269,10 +378,18 @@ class SocketProcessor(chutils.InfiniteThread):
         """
         L.debug("Sending response to message: %s", response)
         assert response.is_response, "expected response, got %s" % response
-        self._peer_streams[peer].finalize(response)
-        return peer.write(response.pack())
 
-    def request(self, peer, msg, on_response, wait_time=None):
+        # The requester may have gone away while we worked on the answer.
+        stream = self._peer_streams.get(peer)
+        if stream is None:
+            L.warning("Socket not registered with this processor.")
+            return False
+
+        stream.finalize(response)
+        self.on_outgoing(peer, response)
+        return peer.write_message(response)
+
+    def request(self, peer, msg, on_response, wait_time=None, expires=None):
         """ Initiates a request.
 
         :peer               the `PeerSocket` to send the message from
@@ -285,9 +402,14 @@ class SocketProcessor(chutils.InfiniteThread):
             response. This is risky, since there's no way to cancel it. If set
             to 0, the request is fired off and `on_response` is executed when
             the response is received later, likely be in a separate thread.
+        :expires[=None]     for fire & forget requests, the most seconds to
+                            wait for the response before giving up on it (and
+                            calling `on_response` with `None`); by default, it
+                            waits as long as the socket stays up
 
         :returns        the return value of the response handler, if it's
-                        called. otherwise, `False` is returned on a timeout.
+                        called. otherwise, `False` is returned on a timeout
+                        or if the socket goes down first.
 
             If the request cannot be prepared (for ex, if the socket is
             invalid), this will throw a `ValueError`.
@@ -303,32 +425,39 @@ class SocketProcessor(chutils.InfiniteThread):
 
         # This is signaled when the response is ready.
         evt = on_response if wait_time == 0 else threading.Event()
+        deadline = None
+        if wait_time == 0 and expires is not None:
+            deadline = clock.time() + expires
 
         # Add this request to the current stream for the peer.
-        if not self.prepare_request(peer, msg, evt):
+        if not self.prepare_request(peer, msg, evt, deadline):
             peer.valid = False
             return False
+        stream = self._peer_streams[peer]
+        if deadline is not None: self._expires_by(deadline)
 
         # Send the request and wait for the response.
         here, there = peer.local, peer.remote
         L.debug("Sending message %s:%d -> %s:%d: %s",
                 here[0], here[1], there[0], there[1], msg)
         L.debug("    Sequence number: %d", msg.seq)
-        peer.write(msg.pack())
+        self.on_outgoing(peer, msg)
+        peer.write_message(msg)
 
         if wait_time == 0:
             L.debug("Triggered fire & forget event, response will be called "
                     "on a different thread.")
             return False
 
-        stream = self._peer_streams[peer]
-        if not evt.wait(timeout=wait_time):
+        if not clock.wait(evt, wait_time):
+            stream.drop(msg.seq)
             if wait_time:   # don't show a message if it's intentional
                 L.warning("Event expired (timeout=%s).", repr(wait_time))
+                self.timeouts.inc()
             return False    # still indicate it, though
 
-        # Find the matching request in the completed table.
-        for pair in stream.completed.list:
+        # Find the matching request in the completed (or failed) table.
+        for pair in stream.completed.list + stream.failed.list:
             if pair.request.seq == msg.seq:
                 result = pair.response
                 break
@@ -337,14 +466,24 @@ class SocketProcessor(chutils.InfiniteThread):
                        "in the completed section!")
             return False
 
-        L.debug("Received response for message: %s", repr(result))
+        if result is None:  # the socket went down first, like a timeout
+            L.warning("Request failed: its socket went down.")
+            return False
+
+        L.debug("Received response for message: %r", result)
         return on_response(peer, result) if on_response else result
 
     def _loop_method(self):
         """ Reads the sockets periodically and calls request handlers.
         """
-        valid_sockets = filter(lambda ps: ps.valid, self._peer_streams)
-        readers, _, errors = select.select(valid_sockets, [], valid_sockets, 1)
+        self.poll(clock.io_timeout(1))
+
+    def poll(self, timeout):
+        """ Processes whatever the sockets have received, waiting up to
+        `timeout` seconds for something to arrive.
+        """
+        valid_sockets = filter(lambda ps: ps.valid, self._peer_streams.keys())
+        readers, errors = self.transport.select(valid_sockets, timeout)
 
         for sock in errors:
             L.error("Socket[%d] errored out in select(): %s", sock.fileno())
@@ -356,29 +495,83 @@ class SocketProcessor(chutils.InfiniteThread):
 
             while peersock.has_messages:
                 msg = peersock.pop_message()
-                stream = self._peer_streams[peersock]
-                L.debug("Full message received: %s", repr(msg))
-
-                #
-                # For responses (they include an "original" member), we call the
-                # respective response handler if there's one pending. Otherwise,
-                # we call the generic handler.
-                #
-
-                if msg.original is None:                        # non-response
-                    stream.generic_handler(peersock, msg)
-                    continue
-
-                for pair in stream.pending:
-                    if pair.request.seq == msg.original.seq:    # expected!
-                        stream.complete(pair, peersock, msg)
-                        break
-                else:
-                    stream.generic_handler(peersock, msg)       # unexpected :(
+                try:
+                    self._dispatch(peersock, msg)
+
+                # Payloads are decoded (and decompressed) lazily, so this is
+                # where we find out that a message is corrupt.
+                except (message.UnpackException,
+                        compression.CompressionException), e:
+                    L.critical("Dropped a corrupt message (%s) from %s: %s",
+                               repr(msg), repr(peersock.remote), str(e))
 
             if not peersock.valid:      # notify higher layer on errors
                 L.error("PeerSocket (#%d) errored out." % peersock.fileno())
                 self.on_shutdown(peersock)
 
-        self._peer_streams = dict(filter(lambda pair: pair[0].valid,
-                                         self._peer_streams.iteritems()))
+        # Other threads add sockets while we run, so we can't replace the dict
+        # wholesale without losing them; drop the dead ones in-place instead.
+        for peer in filter(lambda ps: not ps.valid, self._peer_streams.keys()):
+            stream = self._peer_streams.pop(peer, None)
+            if stream is not None: self._fail_pending(peer, stream)
+
+        self._expire()
+
+    def _expire(self):
+        """ Fails the requests whose responses didn't arrive in time.
+
+        This runs on every poll, so it only looks through the pending requests
+        once the earliest deadline among them has passed.
+        """
+        now = clock.time()
+        with self._expiry_lock:
+            if self._next_expiry is None or now < self._next_expiry: return
+            self._next_expiry = None
+
+        for peer, stream in self._peer_streams.items():
+            expired, upcoming = stream.expired(now)
+            if upcoming is not None: self._expires_by(upcoming)
+
+            for pair in expired:
+                if stream.fail(pair, peer):
+                    L.warning("Request %s expired.", pair.request)
+                    self.timeouts.inc()
+
+    def _expires_by(self, deadline):
+        """ Makes sure that `_expire()` looks again by a certain time.
+        """
+        with self._expiry_lock:
+            if self._next_expiry is None or deadline < self._next_expiry:
+                self._next_expiry = deadline
+
+    def _fail_pending(self, peer, stream):
+        """ Fails every request still waiting on a socket that went down.
+        """
+        for pair in list(stream.pending):
+            L.debug("Request %s failed: its socket went down.", pair.request)
+            stream.fail(pair, peer)
+
+    def _dispatch(self, peersock, msg):
+        """ Hands a received message off to the appropriate handler.
+        """
+        stream = self._peer_streams[peersock]
+        L.debug("Full message received: %r", msg)
+        self.on_message(peersock, msg)
+
+        #
+        # For responses (they include an "original" member), we call the
+        # respective response handler if there's one pending. Otherwise, we
+        # call the generic handler.
+        #
+
+        if msg.original is None:                        # non-response
+            stream.generic_handler(peersock, msg)
+            return
+
+        for pair in stream.pending:
+            if pair.request.seq == msg.original.seq:    # expected!
+                msg.decode()    # so the requester never sees a corrupt one
+                stream.complete(pair, peersock, msg)    # unless it expired
+                break
+        else:
+            stream.generic_handler(peersock, msg)       # unexpected :(
@@ -0,0 +1,111 @@
+""" Checks whether a set of nodes has converged into a consistent ring.
+
+Instead of sleeping for however long stabilization "should" take, tests and
+tooling can wait for the ring to actually be right:
+
+```python
+    from cicada.chordlib import convergence
+    state = convergence.wait_until_converged(nodes, timeout=60)
+    assert state.converged, state
+```
+
+Checking is done against the true ring, which is built by sorting every node's
+hash once, so a check costs O(N log N) for successors and predecessors (and
+O(N * m log N) for the m fingers of every node, if those are checked too).
+"""
+
+import bisect
+
+from ..chordlib import clock
+
+
+class RingState(object):
+    """ How far a set of nodes is from forming the ring that it should.
+    """
+    def __init__(self, size, fingers=False):
+        self.size = size
+        self.fingers_checked = fingers
+        self.bad_successors = []    # [ LocalNode ]
+        self.bad_predecessors = []  # [ LocalNode ]
+        self.fingers_correct = 0
+        self.fingers_total = 0
+
+    @property
+    def converged(self):
+        """ Whether or not every node's successor and predecessor are right.
+        """
+        return not self.bad_successors and not self.bad_predecessors
+
+    @property
+    def finger_accuracy(self):
+        """ The fraction of finger table entries that point to the right node.
+        """
+        if not self.fingers_total: return 1.0
+        return float(self.fingers_correct) / self.fingers_total
+
+    def __nonzero__(self):
+        return self.converged
+
+    def __str__(self):
+        fingers = "%.1f%%" % (100 * self.finger_accuracy) \
+                  if self.fingers_checked else "n/a"
+        return "<RingState | nodes=%d,bad successors=%d,bad predecessors=%d," \
+               "fingers=%s>" % (self.size, len(self.bad_successors),
+               len(self.bad_predecessors), fingers)
+    def __repr__(self): return str(self)
+
+
+def check_ring(nodes, fingers=False):
+    """ Compares every node's view of the ring to the real thing.
+
+    :nodes          the `LocalNode`s that are supposed to make up the ring
+    :fingers[=False] whether or not to check routing tables, too
+    :returns        a `RingState`
+    """
+    ring = sorted(nodes, key=lambda n: int(n.hash))
+    hashes = [ int(n.hash) for n in ring ]
+    state = RingState(len(ring), fingers)
+    if len(ring) < 2: return state
+
+    for i, node in enumerate(ring):
+        expected = hashes[(i + 1) % len(ring)]
+        if not node.successor or int(node.successor.hash) != expected:
+            state.bad_successors.append(node)
+
+        expected = hashes[i - 1]
+        if not node.predecessor or int(node.predecessor.hash) != expected:
+            state.bad_predecessors.append(node)
+
+        if not fingers: continue
+
+        # Each route should point to the first node at or after its start.
+        for route in node.routing_table.routes:
+            state.fingers_total += 1
+            index = bisect.bisect_left(hashes, route.start) % len(ring)
+            if route.peer and int(route.peer.hash) == hashes[index]:
+                state.fingers_correct += 1
+
+    return state
+
+
+def wait_until_converged(nodes, timeout, interval=1, fingers=None):
+    """ Waits (on the installed clock) for nodes to form a consistent ring.
+
+    :nodes          see `check_ring()`
+    :timeout        the most seconds to wait
+    :interval[=1]   the seconds between checks
+    :fingers[=None] if set, the fraction of fingers that also have to be right
+                    for the ring to count as converged
+    :returns        the last `RingState`; it's truthy as long as successors
+                    and predecessors were right, so check `finger_accuracy`
+                    separately if that matters
+    """
+    deadline = clock.time() + timeout
+    while True:
+        state = check_ring(nodes, fingers is not None)
+        if state.converged and state.finger_accuracy >= (fingers or 0):
+            return state
+
+        if clock.time() >= deadline:
+            return state
+        clock.sleep(min(interval, deadline - clock.time()))
@@ -1,10 +1,10 @@
 #!/usr/bin/python2
 
-import random
 import socket
 import functools
 
 from ..chordlib  import commlib, L
+from ..chordlib  import clock
 from ..packetlib import message
 from ..chordlib  import utils as chutils
 from ..packetlib import chord as chordpkt
@@ -13,34 +13,50 @@ from ..packetlib import chord as chordpkt
 class HeartbeatManager(object):
     """ Maintains connections between peers.
     """
-    class InfoThread(chutils.InfiniteThread):
-        """ Sends pings to who we care about: predecessor and successor.
+    class PingThread(chutils.InfiniteThread):
+        """ Sends pings to who we care about: predecessor, successor & fingers.
+
+        Any traffic received from a peer already proves that it's alive, so we
+        only bother pinging the peers that have been quiet for a full interval.
         """
+        INTERVAL = 5
+
         def __init__(self, peerlist, parent):
-            super(HeartbeatManager.InfoThread, self).__init__(
-                name="InfoThread-%s" % str(int(parent.hash))[:4],
-                pause=5)
+            super(HeartbeatManager.PingThread, self).__init__(
+                name="PingThread-%s" % str(int(parent.hash))[:4],
+                pause=self.INTERVAL)
 
             self.parent = parent
             self.peerlist = peerlist
             self.processor = self.parent.processor
+            self.value = clock.rng().randint(0, 2 ** 31)
 
         def _loop_method(self):
-            fn = functools.partial(self._peer_filter, self.parent)
-            for peer in filter(fn, self.peerlist):
-                L.info("Sending an INFO message to %s:%d",
-                       *peer.peer_sock.remote)
+            now = clock.time()
+            for peer in self._watched_peers():
+                if peer.last_msg + self.INTERVAL > now:
+                    continue
 
-                msg = chordpkt.InfoRequest.make_packet(self.parent.hash)
+                L.debug("Sending a PING message to %s:%d",
+                        *peer.peer_sock.remote)
+
+                self.value = (self.value + 1) % (2 ** 32)
+                msg = chordpkt.PingMessage.make_packet(self.parent.hash,
+                                                       self.value)
                 self.processor.request(peer.peer_sock, msg,
-                                       self.parent.on_info_response,
+                                       self.parent.on_pong_response,
                                        wait_time=0)
 
-        @staticmethod
-        def _peer_filter(parent, peer):
-            return peer in (parent.predecessor, parent.successor) or \
-                   peer.hash in map(lambda p: p.hash,
-                                    parent.routing_table.unique_iter(0))
+        def _watched_peers(self):
+            """ Builds the list of peers to ping, computing membership once.
+            """
+            watched = set([
+                int(p.hash) for p in self.parent.routing_table.unique_iter(0)
+            ])
+            for node in (self.parent.predecessor, self.parent.successor):
+                if node is not None: watched.add(int(node.hash))
+
+            return [ p for p in self.peerlist if int(p.hash) in watched ]
 
 
     class PurgeThread(chutils.InfiniteThread):
@@ -49,7 +65,7 @@ class HeartbeatManager(object):
         def __init__(self, peerlist, parent):
             super(HeartbeatManager.PurgeThread,
                   self).__init__(name="PurgeThread-%s" % str(int(parent.hash))[:4],
-                                 pause=lambda: random.randint(15, 30))
+                                 pause=lambda: clock.rng().randint(15, 30))
 
             self.peerlist = peerlist
             self.parent = parent
@@ -61,18 +77,18 @@ class HeartbeatManager(object):
 
 
     def __init__(self, peerlist, parent):
-        self.info_thread  = HeartbeatManager.InfoThread(peerlist, parent)
+        self.ping_thread  = HeartbeatManager.PingThread(peerlist, parent)
         self.purge_thread = HeartbeatManager.PurgeThread(peerlist, parent)
         self.parent = parent
 
     def start(self):
-        self.info_thread.start()
+        self.ping_thread.start()
         self.purge_thread.start()
 
     def join(self, t=10):
-        self.info_thread.join(t)
+        self.ping_thread.join(t)
         self.purge_thread.join(t)
 
     def stop_running(self):
-        self.info_thread.stop_running()
+        self.ping_thread.stop_running()
         self.purge_thread.stop_running()
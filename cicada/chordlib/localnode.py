@@ -6,9 +6,9 @@ method), or simply by waiting for a peer to join this ring.
 """
 
 import time
-import random
 import select
 import socket
+import struct
 import logging
 import threading
 import functools
@@ -19,14 +19,18 @@ from .. import packetlib
 
 from ..chordlib  import L  # the logfile
 from ..chordlib  import utils as chutils
+from ..chordlib  import clock
 from ..chordlib  import routing
 from ..chordlib  import heartbeat
+from ..chordlib  import metrics as chmetrics
 from ..chordlib  import peersocket, commlib
 from ..chordlib  import chordnode, remotenode
+from ..chordlib  import transport as chtransport
 
 from ..packetlib import debug
 from ..packetlib import message
 from ..packetlib import chord as chordpkt
+from ..packetlib import compression
 from ..packetlib import utils as pktutils
 
 from ..traversal import upnp, natpmp
@@ -51,10 +55,29 @@ def handle_failed_request(fn):
 class LocalNode(chordnode.ChordNode):
     """ Represents the current local peer in the Chord network.
     """
+    SUCCESSOR_COUNT = 4     # r, the length of the backup successor list
+    HINT_SAMPLE_SIZE = 4    # known nodes to piggyback on maintenance messages
+    HINT_BACKLOG = 32       # most hinted nodes to hold on to until adopted
+    COMPRESS_THRESHOLD = 0x200  # smallest routed data worth compressing
+
+    # Routing hints are only attached to these (periodic) message types.
+    HINTED_TYPES = (
+        packetlib.MessageType.MSG_CH_INFO,
+        packetlib.MessageType.MSG_CH_NOTIFY,
+        packetlib.MessageType.MSG_CH_PING,
+    )
+
+    # Our compression codecs are advertised on these, as well.
+    NEGOTIATED_TYPES = HINTED_TYPES + (
+        packetlib.MessageType.MSG_CH_JOIN,
+    )
+
     def __init__(self, data, bind_addr,
                  on_send=lambda *args: None,
-                 on_data=lambda d: None,
-                 on_peer=lambda a: None):
+                 on_data=lambda *args: None,
+                 on_peer=lambda a: None,
+                 transport=chtransport.TCP,
+                 threaded=True):
         """ Creates a node on a specific address with specific data.
 
         Typically, the data that you pass is simply a string representation of
@@ -67,18 +90,61 @@ class LocalNode(chordnode.ChordNode):
         :on_send[=n/a]
         :on_data[=n/a]
         :on_peer[=n/a]
+        :transport[=TCP] the `transport.Transport` that all of our sockets are
+                        created on; we can only reach peers on the same one
+        :threaded[=True] whether or not to run our own threads for listening,
+                        processing, and maintenance; if not, the caller has to
+                        drive the node (see `sim`), and nothing we do blocks
         """
-        self.listener = peersocket.PeerSocket(on_send=on_send)
+        self.transport = transport
+        self.threaded = threaded
+        self.listener = peersocket.PeerSocket(on_send=on_send,
+                                              transport=transport)
         self.listener.bind(bind_addr)
 
+        # Everything we (and our sockets) measure goes in here; see `metrics`.
+        self.metrics = chmetrics.Registry(labels={
+            "node": "%s:%d" % self.listener.local
+        })
+        # Our own lookups are split up by what started them (see `lookup()`),
+        # since maintenance lookups would otherwise drown out the rest.
+        self._lookups = self.metrics.counter("lookups_total",
+            "Lookups started by this node, by origin.", ("origin", ))
+        self._lookups_forwarded = self.metrics.counter(
+            "lookups_forwarded_total", "Lookups forwarded for other nodes.")
+        self._lookup_failures = self.metrics.counter("lookup_failures_total",
+            "Lookups started by this node that got no response, by origin.",
+            ("origin", ))
+        self._lookup_latency = self.metrics.histogram(
+            "lookup_latency_seconds", "How long lookups took to resolve, by "
+            "origin.", chmetrics.LATENCY_BUCKETS, ("origin", ))
+        self._lookup_hops = self.metrics.histogram("lookup_hops",
+            "How many hops lookups took to resolve, by origin.",
+            chmetrics.HOP_BUCKETS, ("origin", ))
+        self._peers_added = self.metrics.counter("peers_added_total",
+            "Peers that we've connected to.")
+        self._peers_removed = self.metrics.counter("peers_removed_total",
+            "Peers that we've disconnected from, by reason.", ("reason", ))
+
         # Run listener thread with permanent "accept" state on above socket.
+        # Connections are accepted as soon as they arrive; the timeout is just
+        # how long it takes to notice being stopped.
         L.info("Starting listener thread for %s", self.listener.local)
         self.listen_thread = commlib.ListenerThread(self.listener,
-                                                    self.on_new_peer)
-        self.listen_thread.start()
+                                                    self.on_new_peer, timeout=1)
+        if threaded: self.listen_thread.start()
 
         self.peers = chutils.LockedSet()
+        self._sockets = {}      # { PeerSocket: RemoteNode }, for every peer
+        self.metrics.gauge("peers", "Peers that we're connected to.",
+                           fn=lambda: len(self.peers))
         self.data = data
+        self._piggybacked = {}  # { PeerSocket: deque([ data ]) }
+        self._piggyback_lock = threading.Lock()
+        self._hints = {}        # { int(Hash): ChordNode }, see `_learn_routes`
+        self._hint_lock = threading.Lock()
+        self._handoffs = []     # [ (ChordNode, bool) ], see `_queue_connect`
+        self._handoff_lock = threading.Lock()
 
         self.on_remove = lambda *args: None
         self.on_data_packet = on_data
@@ -92,11 +158,27 @@ class LocalNode(chordnode.ChordNode):
 
         self.routing_table = routing.RoutingTable(self, mod=routing.HASHMOD)
 
+        # Handlers for incoming requests (and unexpected responses), keyed by
+        # (message type, is response); see `register_handler()`.
+        types = packetlib.MessageType
+        self._handlers = {
+            (types.MSG_CH_JOIN,   False): self.on_join_request,
+            (types.MSG_CH_INFO,   False): self.on_info_request,
+            (types.MSG_CH_NOTIFY, False): self.on_notify_request,
+            (types.MSG_CH_LOOKUP, False): self.on_lookup_request,
+            (types.MSG_CH_QUIT,   False): self.on_quit_request,
+            (types.MSG_CH_PING,   False): self.on_ping_request,
+        }
+
         # This is a thread that processes all of the known peers for messages
         # and calls the appropriate message handler.
         self.processor = commlib.SocketProcessor(self.on_shutdown,
-                                                 self.on_error)
-        self.processor.start()
+                                                 self.on_error,
+                                                 self.on_message,
+                                                 self._add_extensions,
+                                                 self.transport,
+                                                 self.metrics)
+        if threaded: self.processor.start()
 
         # This thread periodically purges the peerlist of dead peers that
         # haven't responded to our PINGs.
@@ -122,9 +204,12 @@ class LocalNode(chordnode.ChordNode):
             if node: return node
 
         peer = remotenode.RemoteNode(self.on_send, hash, address,
-                                     existing_socket=socket)
+                                     existing_socket=socket,
+                                     transport=self.transport)
         self.processor.add_socket(peer.peer_sock, self.process)
         self.peers.add(peer)
+        self._sockets[peer.peer_sock] = peer
+        self._peers_added.inc()
         self.on_peer(peer.peer_sock.remote)
         return peer
 
@@ -138,7 +223,8 @@ class LocalNode(chordnode.ChordNode):
         try:
             self.on_remove(self, peer)
             self.processor.shutdown_socket(peer.peer_sock)
-            self.peers.remove(peer)
+            self._discard_peer(peer)
+            self._peers_removed.labels("purged").inc()
 
         except Exception:
             L.warning("Failed to remove a peer? %s" % peer)
@@ -146,14 +232,37 @@ class LocalNode(chordnode.ChordNode):
 
         return True
 
-    def join_ring(self, remote, timeout=10):
+    def piggyback(self, peer, data):
+        """ Queues application data to ride along with our next message to peer.
+
+        The data is delivered to the other side's `on_data` handler just like
+        data that was routed via a LOOKUP, but without requiring one.
+
+        :peer       the `RemoteNode` to send the data to
+        :data       the raw data to attach, at most
+                    `message.ExtensionType.MAX_APP_DATA` bytes
+        """
+        if len(data) > message.ExtensionType.MAX_APP_DATA:
+            raise ValueError("can only piggyback %d bytes, got %d" % (
+                message.ExtensionType.MAX_APP_DATA, len(data)))
+
+        with self._piggyback_lock:
+            self._piggybacked.setdefault(peer.peer_sock,
+                                         collections.deque()).append(data)
+
+    def join_ring(self, remote, timeout=10, on_joined=None):
         """ Joins a network through a peer at the specified address.
 
         This operation blocks until the response is received or the timeout is
-        reached.
+        reached, unless `on_joined` is set.
 
         :remote         the address referring to a peer in a Chord ring.
-        :timeout[=30]   the number of seconds to wait for a response.
+        :timeout[=10]   the number of seconds to wait for a response.
+        :on_joined[=None] if set, the request is sent without waiting for the
+                        response, and this is called once it arrives (or once
+                        `timeout` passes without it), indicating whether or
+                        not we joined:
+                            on_joined(bool)
         :returns        a 2-tuple of the request and the response (or `False`).
         """
         remote = (socket.gethostbyname(remote[0]), remote[1])
@@ -173,6 +282,14 @@ class LocalNode(chordnode.ChordNode):
                                           remote)
 
         request  = chordpkt.JoinRequest.make_packet(self.hash, self.chord_addr)
+        if on_joined is not None:
+            def on_response(sock, msg):
+                on_joined(msg is not None and self.on_join_response(sock, msg))
+
+            self.processor.request(self.successor.peer_sock, request,
+                                   on_response, wait_time=0, expires=timeout)
+            return request, False
+
         response = self.processor.request(self.successor.peer_sock, request,
                                           self.on_join_response, timeout)
 
@@ -182,22 +299,40 @@ class LocalNode(chordnode.ChordNode):
 
         return request, response
 
-    def leave_ring(self):
+    def leave_ring(self, timeout=2):
+        """ Gracefully leaves the ring.
+
+        Before shutting anything down, we send a QUIT to every node we're
+        connected to (which includes anyone using us as a route), handing them
+        our predecessor and successor so that they can close the ring around us
+        immediately rather than waiting to detect our absence.
+
+        :timeout[=2]    the number of seconds to wait for the QUITs to be
+                        acknowledged
+        """
+        if self.successor:
+            self._announce_departure(timeout)
+
         self.peers = chutils.LockedSet()
+        self._sockets = {}
         self.heartbeat.stop_running()
         self.stable.stop_running()
         self.router.stop_running()
         self.processor.stop_running()
-        self.heartbeat.join(3)
-        self.stable.join(3)
-        self.router.join(3)
-        self.processor.join(3)
+        if self.threaded:
+            self.heartbeat.join(3)
+            self.stable.join(3)
+            self.router.join(3)
+            self.processor.join(3)
 
-        for peer in self.peers.lockfree_iter():
-            self.processor.shutdown_socket(peer.peer_sock)
+        # Close every connection, including ones that other nodes opened to us.
+        for peersock in self.processor.sockets:
+            if peersock.valid:
+                self.processor.shutdown_socket(peersock)
 
         self.predecessor = None
         self.successor = None
+        self.successor_list = []
 
     def on_join_request(self, sock, msg):
         """ Receives a JOIN request from a node previously outside the ring.
@@ -222,7 +357,8 @@ class LocalNode(chordnode.ChordNode):
             self.successor = self.create_peer(msg.sender, req.listener, sock)
             response = chordpkt.JoinResponse.make_packet(
                 self.hash, self, self, self.predecessor,
-                self.successor, original=msg)
+                self.successor, self.successor_list,
+                list(self.routing_table.unique_iter(0)), original=msg)
             self.processor.response(sock, response)
             retval = response
 
@@ -230,19 +366,22 @@ class LocalNode(chordnode.ChordNode):
         # belongs in the range (peer.hash, successor.hash].
         else:
             def handler(sock, orig, result, msg):
+                if result is None: return   # the joiner will time out
                 response = chordpkt.JoinResponse.make_packet(
                     self.hash, result, self, self.predecessor,
-                    self.successor, original=orig)
+                    self.successor, self.successor_list,
+                    list(self.routing_table.unique_iter(0)), original=orig)
                 self.processor.response(sock, response)
 
             L.info("We need to make a remote lookup to make a good "
                    "successor recommendation.")
 
             peer = self._peerlist_contains(sock)
-            self.lookup(msg.sender, functools.partial(handler, sock, msg), 0)
+            self.lookup(msg.sender, functools.partial(handler, sock, msg), 0,
+                        started_by="join")
             retval = True
 
-        if not self.stable.is_alive():
+        if self.threaded and not self.stable.is_alive():
             self.stable.start()
             self.router.start()
             self.heartbeat.start()
@@ -285,7 +424,13 @@ class LocalNode(chordnode.ChordNode):
         self.successor.predecessor = response.predecessor
         self.successor.successor = response.successor
 
-        if not self.stable.is_alive():
+        # Rather than waiting for `fix_routes` to slowly fill out our routing
+        # table by lookups, we seed it with everyone the responder knows about.
+        # They're connected to by the next `fix_routes` call, not here.
+        self._seed_routes([ response.sender ] + response.successors +
+                          response.fingers)
+
+        if self.threaded and not self.stable.is_alive():
             self.stable.start()
             self.router.start()
             self.heartbeat.start()
@@ -315,6 +460,7 @@ class LocalNode(chordnode.ChordNode):
 
         self.predecessor.predecessor = node.predecessor
         self.predecessor.successor = node.successor
+        self.predecessor.successor_list = request.successors
         response = chordpkt.NotifyResponse.make_packet(self.hash, set_pred,
                                                        original=msg)
         self.processor.response(sock, response)
@@ -339,7 +485,9 @@ class LocalNode(chordnode.ChordNode):
         succ = self.successor   or pred
 
         response = chordpkt.InfoResponse.make_packet(self.hash, self,
-                                                     pred, succ, original=msg)
+                                                     pred, succ,
+                                                     self.successor_list,
+                                                     original=msg)
 
         L.info("Peer (%s:%d) requested info about us.", *sock.remote)
         L.info("Our details (%s:%d):", *self.chord_addr)
@@ -359,7 +507,8 @@ class LocalNode(chordnode.ChordNode):
         node = self._peerlist_contains(msg.sender)
         if not node:
             L.warning("Unknown socket source? %s:%d" % sock.remote)
-            node = self.create_peer(msg.sender, node.chord_addr, socket=sock)
+            node = self.create_peer(msg.sender, response.sender.chord_addr,
+                                    socket=sock)
 
         L.info("Received info from a peer: %s", str(int(msg.sender))[:8])
         L.info("    Successor on: %s:%d",   *response.successor.chord_addr)
@@ -367,15 +516,92 @@ class LocalNode(chordnode.ChordNode):
 
         node.predecessor = response.predecessor
         node.successor = response.successor
+        node.successor_list = response.successors
         node.last_msg = response.time
         return node
 
+    def on_ping_request(self, sock, msg):
+        """ Responds to a liveness probe by echoing its value back.
+        """
+        ping = chordpkt.PingMessage.unpack(msg.data)
+        response = chordpkt.PongMessage.make_packet(self.hash, ping.value,
+                                                    original=msg)
+        self.processor.response(sock, response)
+        return True
+
+    @handle_failed_request
+    def on_pong_response(self, sock, msg):
+        """ Marks the peer that responded to our PING as alive.
+        """
+        node = self._peerlist_contains(msg.sender)
+        if not node: return False
+
+        node.last_msg = clock.time()
+        return node
+
+    def on_quit_request(self, sock, msg):
+        """ Patches our pointers around a peer that is leaving the ring.
+
+        Anything that pointed to the departing node now points to its successor,
+        which inherits its interval. If it was our predecessor, its predecessor
+        takes its place.
+        """
+        request = chordpkt.QuitRequest.unpack(msg.data)
+        node = self._peerlist_contains(msg.sender)
+
+        L.info("Peer (hash=%d) is leaving the ring.", msg.sender)
+        response = chordpkt.QuitResponse.make_packet(self.hash, original=msg)
+        self.processor.response(sock, response)
+
+        # We can't wait on connections here, so the handed-off nodes are only
+        # used right away if we're already connected to them; otherwise, the
+        # stabilizer connects to them (see `_queue_connect`).
+        def handoff(n, successor=False):
+            if n is None or n.hash == self.hash or n.hash == msg.sender:
+                return None
+            peer = self._peerlist_contains(n.hash)
+            if peer and peer.is_valid: return peer
+            self._queue_connect(n, successor)
+            return None
+
+        was_successor = self.successor and self.successor.hash == msg.sender
+        replacement = handoff(request.successor, was_successor)
+        self.routing_table.replace(msg.sender, replacement)
+        self.successor_list = [
+            n for n in self.successor_list if n.hash != msg.sender
+        ]
+
+        if was_successor:
+            self.successor = replacement or \
+                             self._next_live_successor(self.successor)
+            L.info("    Our successor is now: %s", self.successor)
+            if self.successor:
+                self.successor_list = self._trim_successors(
+                    [ self.successor ] + self.successor_list)
+
+        # Our predecessor is usually only known as our closest preceding peer
+        # (see `predecessor`), which is still the departing one at this point.
+        if self.predecessor and self.predecessor.hash == msg.sender:
+            self.predecessor = handoff(request.predecessor)
+            L.info("    Our predecessor is now: %s", self._predecessor)
+
+        if node:
+            self.on_remove(self, node)
+            self._discard_peer(node)
+            self._peers_removed.labels("quit").inc()
+
+        return True
+
     def on_lookup_request(self, sock, msg):
         """ Forwards to next closest node or looks up request.
+
+        Any data on the request is only delivered if we turn out to be
+        responsible for the lookup value. Otherwise, the request's payload is
+        forwarded as-is: only its routing fields are read, so the data is
+        never unpacked, verified, or re-packed along the way.
         """
-        req = chordpkt.LookupRequest.unpack(msg.data)
-        peer = self._peerlist_contains(msg.sender)
-        if req.data: self.on_data_packet(peer, req.data)
+        payload = msg.payload
+        value, has_origin, data_at = chordpkt.LookupRequest.peek(payload)
 
         def on_response(socket, request, value, result_node, response):
             """ A specialized handler to route the lookup response packet.
@@ -399,11 +625,41 @@ class LocalNode(chordnode.ChordNode):
             self.processor.response(socket, duplicate)
 
         L.info("Received a lookup request from peer: %d", msg.sender)
-        self.lookup(req.lookup,
-                    functools.partial(on_response, sock, msg, req.lookup), 0)
+        respond = functools.partial(on_response, sock, msg, value)
+
+        nearest = None if self._owns(value) else \
+                  self._find_closest_peer(value, via=msg.sender)
+        if nearest is not None and has_origin and (not msg.compressed or
+           compression.codec_of(payload, data_at) in nearest.codecs):
+            L.info("  Forwarding lookup to the nearest neighbor we're aware "
+                   "of: %s", nearest)
+
+            def on_forwarded(sock, response):
+                respond(None, response and chordpkt.LookupResponse.unpack(
+                    response.data))
+
+            request = message.MessageContainer(msg.type, self.hash,
+                                               data=payload.tobytes(),
+                                               compressed=msg.compressed)
+            self.processor.request(nearest.peer_sock, request, on_forwarded,
+                                   wait_time=0)
+            self._lookups_forwarded.inc()
+            return True
+
+        # We're responsible for the value, or the request needs more than its
+        # routing fields adjusted before it can go on.
+        req = chordpkt.LookupRequest.unpack(msg.data)
+        if req.origin is not None:
+            origin = self._peerlist_contains(req.origin.hash) or req.origin
+        else:
+            origin = self._peerlist_contains(msg.sender)
+
+        self.lookup(req.lookup, respond, 0, data=req.data, origin=origin,
+                    compressed=msg.compressed, started_by=None, via=msg.sender)
         return True
 
-    def lookup(self, value, on_response, timeout, data=""):
+    def lookup(self, value, on_response, timeout, data="", origin=None,
+               compressed=False, expires=None, started_by="app", via=None):
         """ Performs an asynchronous LOOKUP request on a certain value.
 
         :value          a `Hash` value that we're looking up
@@ -421,20 +677,44 @@ class LocalNode(chordnode.ChordNode):
             actually routing data instead, but this isn't assumed. The response
             is still reported accordingly, which allows the caller to check if
             the data actually was actually routed to its intended destination,
-            or merely its nearest hop.
+            or merely its nearest hop. The data is only delivered (via
+            `on_data`) by the node responsible for `value`.
+        :origin[=None]  the node that the data originally came from, which
+            defaults to us
+        :compressed[=False] whether or not `data` was already compressed (see
+            `compress()`); otherwise, it may be compressed on its way out
+        :expires[=None] if `timeout` is 0, the most seconds to wait for the
+            response before giving up (and calling `on_response` with `None`);
+            by default, we wait for as long as the next hop stays connected
+        :started_by[="app"] what the lookup is for, which labels its metrics
+            (as their "origin"): "app" for the application's lookups (and the
+            data it routes), "join" for finding a joining node's successor, or
+            "fix_routes" for routing table maintenance; it's `None` for lookups
+            that we forward for others, which are measured where they started
+        :via[=None]     when forwarding, the hash of the node we got the lookup
+            from (see `_find_closest_peer`)
 
         :returns        the peer representing the nearest hop used for the
                         lookup request.
         """
+        mine = started_by is not None
+        if mine: self._lookups.labels(started_by).inc()
+        start = clock.time()
+
         def on_lookup_response(secondary_handler, response_socket,
                                response_message):
             """ The internal wrapper handler for processing a LOOKUP response.
             """
             if response_message is None:
+                if mine: self._lookup_failures.labels(started_by).inc()
                 secondary_handler(None, None)
                 return False
 
             r = chordpkt.LookupResponse.unpack(response_message.data)
+            if mine:
+                self._lookup_latency.labels(started_by).observe(
+                    clock.time() - start)
+                self._lookup_hops.labels(started_by).observe(r.hops)
 
             L.info("  Got a response for the lookup value %d.", r.lookup)
             L.info("  The responder was: %d", response_message.sender)
@@ -447,29 +727,97 @@ class LocalNode(chordnode.ChordNode):
 
         L.info("Peer %s is looking up the value %d.", self, value)
 
-        # First, is this our responsibility? that is, the range: (pred, self]
-        pred = self.predecessor or self.successor
-        iv = routing.Interval(int(pred.hash), int(self.hash), routing.HASHMOD)
-        if iv.within_open(int(value)) or value == self.hash:
-            L.info("  %d falls into our interval, (%d, %d].", value,
-                   pred.hash, self.hash)
+        # First, is this our responsibility?
+        if self._owns(value):
+            L.info("  %d falls into our interval.", value)
+            if data and compressed: data = compression.decompress(data)
+            if data: self.on_data_packet(origin or self, data)
+            if mine:
+                self._lookup_latency.labels(started_by).observe(0)
+                self._lookup_hops.labels(started_by).observe(0)
             on_response(self, None)
             return self
 
         # If it's not us, find the closest hop we know of.
-        nearest = self._find_closest_peer(value)
+        nearest = self._find_closest_peer(value, via=via)
 
         L.info("  Forwarding lookup to the nearest neighbor we're aware of:")
         L.info("    Nearest neighbor: %s", nearest)
 
-        request = chordpkt.LookupRequest.make_packet(self.hash, value, data)
+        data, compressed = self._encode_for(nearest, data, compressed)
+        request = chordpkt.LookupRequest.make_packet(self.hash, value, data,
+                                                     origin or self,
+                                                     compressed=compressed)
         self.processor.request(nearest.peer_sock, request,
                                functools.partial(on_lookup_response,
                                                  on_response),
-                               wait_time=timeout)
+                               wait_time=timeout, expires=expires)
+        if not mine: self._lookups_forwarded.inc()
 
         return nearest
 
+    def _owns(self, value):
+        """ Checks whether a value falls in our interval: (predecessor, self].
+        """
+        pred = self.predecessor or self.successor
+        iv = routing.Interval(int(pred.hash), int(self.hash), routing.HASHMOD)
+        return iv.within_open(int(value)) or value == self.hash
+
+    def send_direct(self, node, value, data, on_failure=lambda: None,
+                    compressed=False):
+        """ Sends data for a value straight to the node responsible for it.
+
+        This skips the overlay entirely, so the caller must already know (for
+        example, from an earlier lookup) who is responsible for `value`. If
+        that's no longer the case, the node will just route it onward.
+
+        :node           the `ChordNode` responsible for `value`
+        :value          the `Hash` value that the data is addressed to
+        :data           the raw data to send
+        :on_failure[=n/a]   called (on the processing thread) if the
+                        connection goes down before the node acknowledges;
+                        the data may or may not have arrived
+        :compressed[=False] see `lookup()`
+        :returns        whether or not the data was sent
+        """
+        try:
+            peer = self.create_peer(node.hash, node.chord_addr)
+        except socket.error:
+            L.warning("Failed to connect directly to %s.", node)
+            return False
+
+        def on_response(sock, msg):
+            if msg is None: on_failure()
+
+        data, compressed = self._encode_for(peer, data, compressed)
+        request = chordpkt.LookupRequest.make_packet(self.hash, value, data,
+                                                     self, compressed=compressed)
+        try:
+            self.processor.request(peer.peer_sock, request, on_response,
+                                   wait_time=0)
+        except (socket.error, ValueError):
+            L.warning("Failed to send directly to %s.", node)
+            return False
+
+        return peer.is_valid
+
+    def compress(self, data):
+        """ Compresses routed data ahead of time.
+
+        This is useful when sending the same data to many peers, since it's
+        then compressed once rather than on its way to each of them. Peers that
+        can't decompress it get the original data instead.
+
+        :data       the raw data to compress
+        :returns    a 2-tuple of the data to route and whether or not it's
+                    compressed, which should be passed on to `lookup()`
+        """
+        if len(data) < self.COMPRESS_THRESHOLD:
+            return data, False
+
+        blob = compression.compress(data)
+        return (blob, True) if blob else (data, False)
+
     def stabilize(self):
         """ Runs the stabilization algorithm.
 
@@ -478,6 +826,7 @@ class LocalNode(chordnode.ChordNode):
         instead." Then, we tell n's successor about n. That way, the successor
         can learn about n if it didn't already know in the first place.
         """
+        self._connect_handoffs()
         if not self.successor:  # nothing to stabilize yet
             return
 
@@ -485,6 +834,13 @@ class LocalNode(chordnode.ChordNode):
         L.info("Asking our successor (%s) for neighbor info...", self.successor)
         request = chordpkt.InfoRequest.make_packet(self.hash)
         try:
+            # Without our own threads, we can't wait on the response, so we
+            # finish stabilizing whenever it arrives instead.
+            if not self.threaded:
+                self.processor.request(self.successor.peer_sock, request,
+                                       self._on_stabilize_info, wait_time=0)
+                return
+
             response = self.processor.request(self.successor.peer_sock,
                                               request, self.on_info_response,
                                               wait_time=2)
@@ -498,19 +854,40 @@ class LocalNode(chordnode.ChordNode):
             L.error("Shouldn't self.successor be None at this point...?")
             return
 
+        self._finish_stabilize()
+
+    def _on_stabilize_info(self, sock, msg):
+        if msg is not None and self.on_info_response(sock, msg):
+            self._finish_stabilize()
+
+    def _finish_stabilize(self):
+        """ Adjusts our successor based on what it told us about its neighbors.
+        """
+        if not self.successor: return
+
+        # Our successor list is our successor followed by (most of) theirs.
+        backups = [ self.successor ] + self.successor.successor_list
+
         # It's possible that the successor hasn't stabilized yet, and thus
         # also doesn't have a predecessor node.
         x = self.successor.predecessor or self
 
+        # Concurrent joins can leave the ring "loopy": every node's successor
+        # agrees that it's that successor's predecessor, yet the cycle skips
+        # over nodes, so asking our successor alone never fixes it. Any peer
+        # we're connected to that falls between us and our successor does.
+        distance = lambda n: routing.moddist(int(self.hash), int(n.hash),
+                                             routing.HASHMOD) or routing.HASHMOD
+        x = min([ x ] + [ p for p in self.peers if p.is_valid ], key=distance)
+
         # We HAVE to use an open-ended range check, because if our successor's
         # predecessor is us (as it would be in the normal case), we'd be setting
         # us as our own successor!
         if routing.Interval(int(self.hash),
                             int(self.successor.hash)).within_open(int(x.hash)):
-            L.info("Our successor's predecessor is closer to us than our "
-                   "current successor!")
-            L.info("    Specifically, successor.predecessor: %d", x.hash)
-            L.info("    Whereas self.successor: %d", x.hash)
+            L.info("Found a node closer to us than our current successor!")
+            L.info("    Specifically, the node: %d", x.hash)
+            L.info("    Whereas self.successor: %d", self.successor.hash)
             L.info("    And self.range: [%d, %d)", self.hash,
                    self.successor.hash)
 
@@ -522,21 +899,28 @@ class LocalNode(chordnode.ChordNode):
             #   - Then, after C joins, A --> B --> C --> A.
             #   - We still need the connection between A <--> B, because B is
             #     A's successor, despite not being our successor anymore.
-            sp = self.successor.predecessor
-            self.successor = self.create_peer(sp.hash, sp.chord_addr)
+            self.successor = self.create_peer(x.hash, x.chord_addr)
+            backups.insert(0, self.successor)
+
+        self.successor_list = self._trim_successors(backups)
 
         # We need to notify our successor about ourselves (regardless of whether
         # we adjusted or not), so they can set their predecessor appropriately.
         L.info("Notifying our successor (%s) about us.", self.successor)
         request = chordpkt.NotifyRequest.make_packet(self.hash, self,
                                                      self.predecessor,
-                                                     self.successor)
+                                                     self.successor,
+                                                     self.successor_list)
         self.processor.request(self.successor.peer_sock, request,
                                None, wait_time=0)
 
     def fix_routes(self):
         """ Chooses a random route entry to validate in the network.
+
+        Any routing hints we've been given since the last call are adopted
+        first.
         """
+        self._adopt_hints()
         lroute = None
 
         # Prefer entries that don't have a valid peer yet.
@@ -545,10 +929,11 @@ class LocalNode(chordnode.ChordNode):
                 lroute = route
                 break
         else:
-            index = random.randint(0, self.routing_table.length - 1)
+            index = clock.rng().randint(0, self.routing_table.length - 1)
             lroute = self.routing_table[index]
 
         def fix_route(self, index, route, peer, msg):
+            if peer is None: return     # the lookup failed; retry next time
             if peer.chord_addr != self.chord_addr:
                 peer = self.create_peer(peer.hash, peer.chord_addr)
                 if not peer: return self.remove_peer(peer)
@@ -560,7 +945,8 @@ class LocalNode(chordnode.ChordNode):
         if state == routing.RoutingTable.LookupState.REMOTE:
             packed_interval = routing.Hash.pack_int(lroute.start)
             self.lookup(routing.Hash(hashed=packed_interval),
-                        functools.partial(fix_route, self, index, lroute), None)
+                        functools.partial(fix_route, self, index, lroute),
+                        None if self.threaded else 0, started_by="fix_routes")
 
         elif state == routing.RoutingTable.LookupState.LOCAL:
             fix_route(self, index, lroute, pred.successor, None)
@@ -570,24 +956,36 @@ class LocalNode(chordnode.ChordNode):
 
         return True
 
+    def register_handler(self, msg_type, handler, response=False):
+        """ Registers a handler for a type of incoming message.
+
+        This lets the layers above this one define their own message types
+        (which should be above `MessageType.MSG_CH_MAX`) and send them directly
+        to peers, or replace how we handle one of the built-in types.
+
+        :msg_type           the type of message to handle
+        :handler            called on the processing thread for every message
+                            of this type:
+                                handler(peer_socket, msg)
+        :response[=False]   whether to handle responses to this message type
+                            that don't correspond to any pending request,
+                            rather than requests
+        """
+        self._handlers[(msg_type, response)] = handler
+
     def process(self, peer_socket, msg):
-        L.debug("Received message %s from %s:%d", repr(msg), *peer_socket.local)
+        L.debug("Received message %r from %s:%d", msg, *peer_socket.local)
 
-        handlers = {
-            packetlib.MessageType.MSG_CH_JOIN:      (self.on_join_request,   0),
-            packetlib.MessageType.MSG_CH_INFO:      (self.on_info_request,   0),
-            packetlib.MessageType.MSG_CH_NOTIFY:    (self.on_notify_request, 0),
-            packetlib.MessageType.MSG_CH_LOOKUP:    (self.on_lookup_request, 0),
-        }
+        handler = self._handlers.get((msg.type, msg.is_response))
+        if handler is not None:
+            handler(peer_socket, msg)
+
+        # Responses to requests we've given up on are expected now and then.
+        elif msg.is_response:
+            L.warning("Dropped a response (%s) with no pending request.", msg)
 
-        for msg_type, params in handlers.iteritems():
-            func, response = params
-            if msg.type == msg_type and response == msg.is_response:
-                func(peer_socket, msg)
-                break
         else:
-            L.error("Message received (type=%s) without handler.",
-                    message.MessageType.LOOKUP[msg.type])
+            L.error("Message received (%s) without handler.", msg)
             msg.dump()
 
     def _peerlist_contains(self, elem):
@@ -630,12 +1028,7 @@ class LocalNode(chordnode.ChordNode):
         """
         # Intentionally don't use `_peerlist_contains` to avoid any calls on the
         # socket object that may throw.
-        node = None
-        for peer in self.peers:
-            if peer.peer_sock == socket:
-                node = peer
-                break
-
+        node = self._sockets.get(socket)
         if node:
             remote = node.chord_addr
             L.warning("Neighbor (%s:%d) went down %sgracefully", remote[0],
@@ -645,22 +1038,339 @@ class LocalNode(chordnode.ChordNode):
                       "" if graceful else "un-")
             return
 
-        #
-        # TODO: Successor lists for backup successors.
-        #
         self.on_remove(self, node)
+        with self._piggyback_lock:
+            self._piggybacked.pop(socket, None)
+        self.successor_list = [
+            n for n in self.successor_list if n.hash != node.hash
+        ]
 
         if self.successor and node == self.successor:
-            msg = "Lost our successor! (we are %s)" % self
-            self.successor = None
-            L.critical(msg)
+            L.critical("Lost our successor! (we are %s)" % self)
+            self.successor = self._next_live_successor(node)
+            if self.successor:
+                L.info("    Failed over to backup successor: %s",
+                       self.successor)
 
         if self.predecessor and node == self.predecessor:
             msg = "Lost our predecessor! (we are %s)" % self
             self.predecessor = None
             L.critical(msg)
 
-        self.peers.remove(node)
+        self._discard_peer(node)
+        self._peers_removed.labels("shutdown" if graceful else "error").inc()
+
+    def _discard_peer(self, peer):
+        """ Forgets about a peer, without touching its connection.
+        """
+        self.peers.remove(peer)
+        if self._sockets.get(peer.peer_sock) is peer:
+            del self._sockets[peer.peer_sock]
+
+    def _announce_departure(self, timeout):
+        """ Sends a QUIT to every connected node and waits for their replies.
+
+        :timeout    the number of seconds to wait for all of the replies
+        :returns    whether or not every QUIT was acknowledged in time
+        """
+        sockets = filter(lambda ps: ps.valid, self.processor.sockets)
+        pending = [ len(sockets) ]
+        lock = threading.Lock()
+        done = threading.Event()
+
+        # Acknowledgements arrive on the processing thread, and failures to
+        # send on this one, so the count has to be guarded.
+        def on_ack(sock, msg):
+            with lock:
+                pending[0] -= 1
+                if pending[0] <= 0: done.set()
+
+        L.info("Leaving the ring, notifying %d peers.", len(sockets))
+        for sock in sockets:
+            request = chordpkt.QuitRequest.make_packet(self.hash, self,
+                                                       self.predecessor,
+                                                       self.successor,
+                                                       self.successor_list)
+            try:
+                self.processor.request(sock, request, on_ack, 0)
+            except socket.error:
+                L.warning("Failed to notify %s:%d of our departure.",
+                          *sock.remote)
+                on_ack(sock, None)
+
+        if not sockets: return True
+        return clock.wait(done, timeout)
+
+    def on_message(self, sock, msg):
+        """ Does the bookkeeping that applies to every message we receive.
+
+        The node we join the ring through starts out with a placeholder hash,
+        which we replace as soon as it tells us its real one. This has to
+        happen right away, before we answer anything else, or we'd spread the
+        placeholder to other nodes.
+        """
+        peer = self._sockets.get(sock)
+        if peer is not None and peer.hash != msg.sender:
+            peer.hash = msg.sender
+
+        self._read_extensions(sock, msg)
+
+    def _add_extensions(self, sock, msg):
+        """ Attaches pending application data and routing hints to a message.
+        """
+        with self._piggyback_lock:
+            queued = self._piggybacked.get(sock)
+            if queued:
+                msg.extensions[message.ExtensionType.EXT_APP_DATA] = \
+                    queued.popleft()
+
+        if msg.type in self.NEGOTIATED_TYPES:
+            codecs = compression.supported()
+            msg.extensions[message.ExtensionType.EXT_CODECS] = \
+                struct.pack('!%dB' % len(codecs), *codecs)
+
+        if msg.type not in self.HINTED_TYPES:
+            return
+
+        fingers = list(self.routing_table.unique_iter(0))
+        sample = clock.rng().sample(fingers, min(len(fingers),
+                                                 self.HINT_SAMPLE_SIZE))
+        if sample:
+            msg.extensions[message.ExtensionType.EXT_KNOWN_NODES] = \
+                message.PackedNodeList(sample).pack()
+
+        if self.successor_list:
+            msg.extensions[message.ExtensionType.EXT_SUCCESSORS] = \
+                message.PackedNodeList(self.successor_list).pack()
+
+        msg.extensions[message.ExtensionType.EXT_LOAD] = \
+            struct.pack('!I', self.processor.connections)
+
+    def _encode_for(self, peer, data, compressed):
+        """ Adapts routed data to the compression codecs a peer supports.
+
+        :peer       the `RemoteNode` the data is about to be sent to
+        :data       the data to send
+        :compressed whether or not `data` is already compressed
+        :returns    a 2-tuple of the data to send and whether or not it's
+                    compressed
+        """
+        if compressed:
+            if compression.codec_of(data) in peer.codecs:
+                return data, True
+            return compression.decompress(data), False
+
+        if len(data) < self.COMPRESS_THRESHOLD or not peer.codecs:
+            return data, False
+
+        blob = compression.compress(data, peer.codecs)
+        return (blob, True) if blob else (data, False)
+
+    def _read_extensions(self, sock, msg):
+        """ Processes the application data and routing hints on a message.
+        """
+        if not msg.extensions: return
+
+        ext = msg.extensions
+        node = self._sockets.get(sock) or self._peerlist_contains(msg.sender)
+
+        if message.ExtensionType.EXT_APP_DATA in ext:
+            if node is not None:
+                self.on_data_packet(node,
+                                    ext[message.ExtensionType.EXT_APP_DATA])
+            else:
+                L.warning("Dropping data piggybacked by unknown sender %d.",
+                          msg.sender)
+
+        if message.ExtensionType.EXT_KNOWN_NODES in ext:
+            sample, _ = message.PackedNodeList.unpack(
+                ext[message.ExtensionType.EXT_KNOWN_NODES])
+            self._learn_routes(sample.nodes)
+
+        if not node: return
+
+        if message.ExtensionType.EXT_LOAD in ext:
+            node.load, = struct.unpack('!I',
+                                       ext[message.ExtensionType.EXT_LOAD])
+
+        if message.ExtensionType.EXT_CODECS in ext:
+            codecs = ext[message.ExtensionType.EXT_CODECS]
+            node.codecs = set(struct.unpack('!%dB' % len(codecs), codecs))
+
+        if message.ExtensionType.EXT_SUCCESSORS in ext:
+            succs, _ = message.PackedNodeList.unpack(
+                ext[message.ExtensionType.EXT_SUCCESSORS])
+            node.successor_list = succs.nodes
+
+            if self.successor and node.hash == self.successor.hash:
+                self.successor_list = self._trim_successors(
+                    [ self.successor ] + node.successor_list)
+
+    def _learn_routes(self, nodes):
+        """ Queues up nodes that would improve any of our routes.
+
+        This runs on the processing thread, which can't wait on connections, so
+        the nodes are only connected to (and added to our routing table) later,
+        by `_adopt_hints`.
+
+        :nodes      a list of `ChordNode`s another peer told us about
+        """
+        for node in nodes:
+            if not self._improves_route(node):
+                continue
+
+            with self._hint_lock:
+                if len(self._hints) < self.HINT_BACKLOG:
+                    self._hints[int(node.hash)] = node
+
+    def _adopt_hints(self):
+        """ Connects to queued-up hinted nodes and adds them to our routes.
+
+        We check each one again first, since our routes may have changed since
+        it was queued.
+        """
+        with self._hint_lock:
+            hints, self._hints = self._hints.values(), {}
+
+        hints.sort(key=lambda n: routing.moddist(int(self.hash), int(n.hash),
+                                                 routing.HASHMOD))
+        for node in hints:
+            # Hints are second-hand, so they lose to what we've seen ourselves.
+            known = self._peerlist_contains(node.chord_addr)
+            if known and known.hash != node.hash:
+                continue
+
+            if not self._improves_route(node):
+                continue
+
+            try:
+                peer = self.create_peer(node.hash, node.chord_addr)
+            except socket.error:
+                L.warning("Hinted peer %s is unreachable.", node)
+                continue
+
+            self.routing_table[0] = peer
+
+    def _improves_route(self, node):
+        """ Checks whether a node is closer than any of our routes' peers.
+
+        The only route a node can improve (as long as every route points to the
+        nearest peer we know of after its start) is the one whose interval it
+        falls in, so that's all we check; this runs for every hint we receive,
+        so scanning the whole table adds up.
+        """
+        if node.hash == self.hash or node.chord_addr == self.chord_addr:
+            return False
+
+        value = int(node.hash)
+        index = routing.moddist(int(self.hash), value,
+                                routing.HASHMOD).bit_length() - 1
+        route = self.routing_table.routes[index]
+        return not route.peer or \
+               routing.moddist(route.start, value, routing.HASHMOD) < \
+               routing.moddist(route.start, int(route.peer.hash),
+                               routing.HASHMOD)
+
+    def _seed_routes(self, nodes):
+        """ Fills the successor list and queues up routes from a set of nodes.
+
+        This runs while handling a JOIN response, so we don't connect to any of
+        the nodes here. They're all queued up as routing hints instead, and
+        `_adopt_hints` gives each route the nearest of them following its start,
+        which is the best estimate we can make without asking around.
+
+        :nodes      a list of `ChordNode`s we've learned about from a peer
+        """
+        self.routing_table[0] = self.successor
+
+        seeded = [ self.successor ]
+        for node in nodes:
+            if node.hash == self.hash or \
+               any([ n.hash == node.hash for n in seeded ]):
+                continue
+
+            seeded.append(node)
+            with self._hint_lock:
+                self._hints[int(node.hash)] = node
+
+        L.info("Seeded our routing table with %d peers.", len(seeded))
+        self.successor_list = self._trim_successors(sorted(seeded,
+            key=lambda n: routing.moddist(int(self.hash), int(n.hash),
+                                          routing.HASHMOD)))
+
+    def _trim_successors(self, candidates):
+        """ Builds a successor list of unique nodes from a list of candidates.
+
+        The candidates are in ring order, so we stop as soon as the list wraps
+        back around to us.
+        """
+        successors = []
+        for node in candidates:
+            if len(successors) >= self.SUCCESSOR_COUNT or \
+               node.hash == self.hash:
+                break
+
+            if not any([ n.hash == node.hash for n in successors ]):
+                successors.append(node)
+
+        return successors
+
+    def _next_live_successor(self, dead):
+        """ Finds the first node in our successor list that we're connected to.
+
+        This runs on the processing thread (where we find out that successors
+        are gone), which can't wait on connections. Any backups that come
+        before the one we pick are queued up for the stabilizer to connect to
+        instead, and it moves our successor back to the closest reachable one.
+
+        :dead       the successor that just went down, which we skip
+        :returns    a peer for the new successor, or `None` if we aren't
+                    connected to any of the backups
+        """
+        for node in self.successor_list:
+            if node.hash == dead.hash or node.hash == self.hash:
+                continue
+
+            peer = self._peerlist_contains(node.hash)
+            if peer and peer.is_valid: return peer
+            self._queue_connect(node, successor=True)
+
+        return None
+
+    def _queue_connect(self, node, successor=False):
+        """ Has the stabilizer connect to a node on our behalf.
+
+        :node       the `ChordNode` to connect to
+        :successor[=False] whether it should become our successor, as long as
+                    we don't have one by then (or it's closer than ours)
+        """
+        with self._handoff_lock:
+            self._handoffs.append((node, successor))
+
+    def _connect_handoffs(self):
+        """ Connects to the nodes queued up by `_queue_connect`, in order.
+        """
+        with self._handoff_lock:
+            handoffs, self._handoffs = self._handoffs, []
+
+        for node, successor in handoffs:
+            closer = not self.successor or routing.Interval(
+                int(self.hash), int(self.successor.hash)
+            ).within_open(int(node.hash))
+            if node.hash == self.hash or (successor and not closer):
+                continue
+
+            try:
+                peer = self.create_peer(node.hash, node.chord_addr)
+            except socket.error:
+                L.warning("Handed-off peer %s is unreachable.", node)
+                continue
+
+            if successor:
+                L.info("Our successor is now: %s", peer)
+                self.successor = peer
+                self.successor_list = self._trim_successors(
+                    [ peer ] + self.successor_list)
 
     def on_new_peer(self, new_peersock):
         """ Adds a newly connected peer to the internal socket processor.
@@ -716,24 +1426,45 @@ class LocalNode(chordnode.ChordNode):
         near = min(table, key=lambda x: x[1])
         return near[0]
 
-    def _find_closest_peer(self, value, exclude=set()):
-        """ Finds the closest known peer responsible for a value.
+    def _find_closest_peer(self, value, exclude=set(), via=None):
+        """ Finds the next hop towards the node responsible for a value.
 
-        Each peer is responsible (as far as we're concerned) for the values in
-        the range: (peer.predecessor.hash, peer.hash]. We use our routing table
-        to find the closest possible entry. Failing that, we fall back on
-        manually checking all of the internal peers for their intervals.
-        """
-        rv = self.routing_table.lookup(value)
-        if rv != self: return rv
+        If the value falls between us and our successor, then our successor is
+        responsible for it. Otherwise, we pass it on to the closest finger that
+        precedes it, which (with a full routing table) leaves at most half of
+        the remaining distance to go, so lookups take O(log n) hops. We only
+        consider the peers the heartbeat watches, since any other connection
+        may be purged while the lookup is still in flight.
 
-        pred = self.predecessor or self._find_closest_peer_moddist(value)
-        for peer in self.peers.difference(exclude):
-            iv = routing.Interval(int(pred.hash), int(peer.hash))
+        If the node that passed the lookup to us thought that _we_ were
+        responsible for it, though, its successor is out of date, and going
+        around the ring again would just lead back to it. Instead, we step back
+        to the closest peer we know of that follows the value.
+
+        :value          the `Hash` value being looked up
+        :exclude[=set()] peers not to consider
+        :via[=None]     the hash of the node that passed the lookup to us, if any
+        """
+        value = int(value)
+        if via is not None and \
+           routing.Interval(int(via), int(self.hash)).within_open(value):
+            return self._find_closest_peer_moddist(value, exclude)
+
+        succ = self.successor
+        if succ is not None and succ not in exclude:
+            iv = routing.Interval(int(self.hash), int(succ.hash))
             if iv.within_open(value) or iv.end == value:    # (start, end]
-                return peer
+                return succ
+
+        nearest = None
+        distance = routing.moddist(int(self.hash), value, routing.HASHMOD)
+        for peer in self.routing_table.unique_iter(0):
+            dist = routing.moddist(int(peer.hash), value, routing.HASHMOD)
+            if dist < distance and peer not in exclude:
+                nearest, distance = peer, dist
 
-        return self._find_closest_peer_moddist(value, exclude)
+        return nearest or succ or \
+               self._find_closest_peer_moddist(value, exclude)
 
     def __str__(self):
         return "[%s<-local(%s|peers=%d)->%s]" % (
@@ -0,0 +1,355 @@
+""" Counters, gauges, and histograms that describe what a node is doing.
+
+Every `LocalNode` keeps a `Registry` of metrics (as `node.metrics`), which its
+socket processor, sockets, and (if any) `SwarmPeer` add to and update as they
+go. They're cheap to update -- a dictionary lookup and a lock at most -- so
+they're always on.
+
+```python
+    registry = Registry()
+    sent = registry.counter("messages_sent_total", "Messages sent.", ("type", ))
+    sent.labels("LOOKUP").inc()
+
+    depth = registry.gauge("queue_depth", "Messages waiting.",
+                           fn=lambda: len(queue))
+    latency = registry.histogram("latency_seconds", "Request latency.",
+                                 LATENCY_BUCKETS)
+    latency.observe(0.012)
+
+    print registry.snapshot()   # a dictionary, for tooling and tests
+    print registry.prometheus() # the Prometheus text exposition format
+```
+
+Gauges can be given a function to call whenever they're read instead of being
+set, which is how queue depths and the like are tracked without any bookkeeping
+on the paths that change them.
+"""
+
+import bisect
+import threading
+import collections
+
+
+# Upper bounds of the buckets for latencies (in seconds) and hop counts.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+HOP_BUCKETS = tuple(range(0, 17)) + (24, 32)
+
+
+class Metric(object):
+    """ A named value, optionally split up by the values of some labels.
+
+    A metric with labels holds a separate child metric for every combination of
+    label values it's seen; see `labels()`. A metric without labels is updated
+    directly.
+    """
+    TYPE = "untyped"
+    __slots__ = ("name", "help", "label_names", "_children", "_lock")
+
+    def __init__(self, name, help, labels=()):
+        """ Creates the metric.
+
+        :name           the metric's name, which has to be a valid Prometheus
+                        metric name (letters, digits, and underscores)
+        :help           a short description of what it measures
+        :labels[=()]    the names of the labels that it's split up by
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}     # { (label values): Metric }
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """ Finds the child metric for some label values, creating it if needed.
+        """
+        child = self._children.get(values)
+        if child is not None: return child
+
+        if len(values) != len(self.label_names):
+            raise ValueError("expected %d label values, got %d" % (
+                             len(self.label_names), len(values)))
+
+        with self._lock:
+            return self._children.setdefault(values, self._child())
+
+    def samples(self):
+        """ Lists every value that makes up the metric.
+
+        :returns    a list of (name suffix, { label: value }, value) tuples
+        """
+        if not self.label_names:
+            return self._samples({})
+
+        samples = []
+        for values, child in sorted(self._children.items()):
+            samples.extend(child._samples(dict(zip(self.label_names, values))))
+        return samples
+
+    def snapshot(self):
+        """ Describes the metric's current value(s) as simple Python objects.
+
+        :returns    for a metric without labels, its value; otherwise, a
+                    dictionary of values keyed by the label values (joined by
+                    commas if there's more than one label)
+        """
+        if not self.label_names:
+            return self._snapshot()
+
+        return dict((",".join(map(str, values)), child._snapshot())
+                    for values, child in self._children.items())
+
+    def _child(self):
+        return type(self)(self.name, self.help)
+
+    def _samples(self, labels):
+        return [ ("", labels, self._snapshot()) ]
+
+    def _snapshot(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """ A count that only ever goes up, like the number of messages sent.
+    """
+    TYPE = "counter"
+    __slots__ = ("value", )
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _snapshot(self):
+        return self.value
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, like the number of connected peers.
+    """
+    TYPE = "gauge"
+    __slots__ = ("fn", "_value")
+
+    def __init__(self, name, help, labels=(), fn=None):
+        """ Creates the gauge.
+
+        :fn[=None]      if set, called (with no arguments) whenever the gauge is
+                        read, instead of it being set
+        """
+        super(Gauge, self).__init__(name, help, labels)
+        self.fn = fn
+        self._value = 0
+
+    @property
+    def value(self):
+        return self.fn() if self.fn is not None else self._value
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def _snapshot(self):
+        return self.value
+
+
+class Histogram(Metric):
+    """ Counts observations (like latencies) into buckets.
+
+    Only the count in each bucket is kept, so percentiles are estimates: they're
+    interpolated within the bucket that the percentile falls into (but never
+    past the smallest or largest value observed).
+    """
+    TYPE = "histogram"
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max")
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        """ Creates the histogram.
+
+        :buckets[=LATENCY_BUCKETS]  the (inclusive) upper bound of each bucket,
+                                    in increasing order; anything larger falls
+                                    into an extra, unbounded one
+        """
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [ 0 ] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = self.max = None
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min: self.min = value
+            if self.max is None or value > self.max: self.max = value
+
+    def percentile(self, p):
+        """ Estimates the `p`th percentile (from 0 to 100) of the observations.
+
+        :returns    the estimate, or `None` if nothing's been observed
+        """
+        if not self.count: return None
+
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lo = max(self.buckets[i - 1] if i else self.min, self.min)
+                hi = min(self.buckets[i] if i < len(self.buckets) else self.max,
+                         self.max)
+                return lo + (hi - lo) * (rank - seen) / count
+            seen += count
+
+        return self.max
+
+    def _child(self):
+        return Histogram(self.name, self.help, self.buckets)
+
+    def _samples(self, labels):
+        samples, total = [], 0
+        for bound, count in zip(self.buckets + ("+Inf", ), self.counts):
+            total += count
+            bucket = dict(labels)
+            bucket["le"] = bound
+            samples.append(("_bucket", bucket, total))
+
+        samples.append(("_sum", labels, self.sum))
+        samples.append(("_count", labels, self.count))
+        return samples
+
+    def _snapshot(self):
+        return {
+            "count":    self.count,
+            "sum":      self.sum,
+            "mean":     float(self.sum) / self.count if self.count else None,
+            "min":      self.min,
+            "max":      self.max,
+            "p50":      self.percentile(50),
+            "p95":      self.percentile(95),
+            "p99":      self.percentile(99),
+        }
+
+
+class Registry(object):
+    """ The set of metrics kept by a single node.
+    """
+    def __init__(self, prefix="cicada", labels=None):
+        """ Creates an empty registry.
+
+        :prefix[="cicada"]  prepended (with an underscore) to every metric's
+                            name when exporting
+        :labels[=None]      labels to attach to every exported value, like
+                            { "node": "10.0.0.1:49610" }, so that the metrics
+                            of several nodes can be told apart
+        """
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        """ Finds or creates a `Counter`. """
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), fn=None):
+        """ Finds or creates a `Gauge`; see `Gauge.__init__` for `fn`. """
+        gauge = self._register(Gauge, name, help, labels)
+        if fn is not None: gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        """ Finds or creates a `Histogram`. """
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def get(self, name):
+        """ Finds a metric by its (unprefixed) name, or `None`. """
+        return self._metrics.get(name)
+
+    def snapshot(self):
+        """ Describes every metric as simple Python objects.
+
+        :returns    a dictionary of { name: `Metric.snapshot()` }
+        """
+        return dict((name, metric.snapshot())
+                    for name, metric in self._metrics.items())
+
+    def prometheus(self):
+        """ Exports every metric in the Prometheus text exposition format.
+        """
+        return prometheus([ self ])
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def _register(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, labels=labels, **kwargs)
+                self._metrics[name] = metric
+
+            elif not isinstance(metric, cls):
+                raise ValueError("%s is already a %s" % (name, metric.TYPE))
+
+            return metric
+
+
+def prometheus(registries):
+    """ Exports the metrics of several registries as a single text document.
+
+    Metrics with the same name are grouped together, so each registry should
+    have distinguishing `labels` (like the node's address).
+    """
+    families = collections.OrderedDict()    # { name: [ (Registry, Metric) ] }
+    for registry in registries:
+        for metric in registry:
+            name = "%s_%s" % (registry.prefix, metric.name) \
+                   if registry.prefix else metric.name
+            families.setdefault(name, []).append((registry, metric))
+
+    lines = []
+    for name, members in families.iteritems():
+        metric = members[0][1]
+        lines.append("# HELP %s %s" % (name, _escape(metric.help)))
+        lines.append("# TYPE %s %s" % (name, metric.TYPE))
+        for registry, metric in members:
+            for suffix, labels, value in metric.samples():
+                labels = dict(registry.labels, **labels)
+                lines.append("%s%s%s %s" % (name, suffix, _format_labels(labels),
+                                            _format_value(value)))
+
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels: return ""
+    return "{%s}" % ",".join([
+        '%s="%s"' % (key, _escape(str(labels[key]), True))
+        for key in sorted(labels, key=lambda k: (k == "le", k))
+    ])
+
+
+def _format_value(value):
+    if value is None: return "NaN"
+    if isinstance(value, float):
+        if value != value: return "NaN"
+        if value in (float("inf"), float("-inf")):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(int(value))
+
+
+def _escape(text, quotes=False):
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quotes else text
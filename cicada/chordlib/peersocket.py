@@ -1,21 +1,27 @@
 import enum
+import logging
 import socket
 import select
 import struct
 import threading
 
 from ..chordlib  import L
+from ..chordlib  import clock
+from ..chordlib  import transport as chtransport
 from ..packetlib import message
+from ..packetlib import compact
 
 
 class ThreadsafeSocket(object):
     """ Provides a thread-safe (and logged) interface into sockets.
     """
-    def __init__(self, existing_socket=None):
+    __slots__ = ("sendlock", "socket")
+
+    def __init__(self, existing_socket=None, transport=chtransport.TCP):
         self.sendlock = threading.Lock()
         self.socket = existing_socket
         if not self.socket:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket = transport.socket()
 
     def accept(self):
         sock, addr = self.socket.accept()
@@ -27,14 +33,15 @@ class ThreadsafeSocket(object):
     def sendall(self, bytestream):
         with self.sendlock:
             self.socket.sendall(bytestream)
-            L.debug("Sent %d bytes %s", len(bytestream), repr(bytestream))
+            L.debug("Sent %d bytes %r", len(bytestream), bytestream)
 
     def recv(self, amt):
         L.debug("Waiting on %d bytes ... ", amt)
         data = self.socket.recv(amt)
-        L.debug("Received %d bytes from %s:%d: %s", len(data),
-                self.socket.getpeername()[0], self.socket.getpeername()[1],
-                repr(data))
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug("Received %d bytes from %s:%d: %r", len(data),
+                    self.socket.getpeername()[0], self.socket.getpeername()[1],
+                    data)
         return data
 
     def __getattr__(self, attr):
@@ -59,19 +66,27 @@ class ReadQueue(object):
         WAITING = 0
         READING = 1
 
-    def __init__(self):
-        self._queue = []
+    __slots__ = ("session", "_queue", "_pending", "_queue_lock", "_pkt_state",
+                 "_next_length", "_next_compact", "_next_resp")
+
+    _HEADER_FMT = message.MessageContainer.RAW_FORMATS[
+        message.MessageBlob.MSG_HEADER].raw_format
+    _header_offset = struct.calcsize('!' + ''.join(_HEADER_FMT[:-1]))
+    _resp_offset   = struct.calcsize('!' + ''.join(_HEADER_FMT[:3]))
+
+    def __init__(self, session=None):
+        """ Creates an empty queue.
+
+        :session[=None] the `compact.Session` of the connection we're reading
+                        from, which is needed to decode compact messages
+        """
+        self.session = session or compact.Session()
+        self._queue = []        # [ (MessageContainer, size on the wire) ]
         self._pending = ""
         self._queue_lock = threading.Lock()
         self._pkt_state = ReadQueue.PacketState.WAITING
-
-        formats = message.MessageContainer.RAW_FORMATS
-        header_fmt = formats[message.MessageBlob.MSG_HEADER].raw_format
-        prev_fmt = header_fmt[:-1]
-        upto_resp_fmt = header_fmt[:3]
-        self._header_offset = struct.calcsize('!' + ''.join(prev_fmt))
-        self._resp_offset   = struct.calcsize('!' + ''.join(upto_resp_fmt))
         self._next_length = 0
+        self._next_compact = False
 
     def read(self, data):
         """ Processes some data into the queue.
@@ -82,36 +97,45 @@ class ReadQueue(object):
         """
         with self._queue_lock:
             try:
-                L.debug("Received data: %s", repr(data))
+                L.debug("Received data: %r", data)
                 self._pending += data
 
-                # We are still waiting for the length byte.
-                if self._pkt_state == ReadQueue.PacketState.WAITING:
-                    n, m = self._header_offset, self._resp_offset
-                    if len(self._pending) >= n + 4:
-                        length = self._pending[n : n + 4]
-                        resp = self._pending[m : m + 1]
-
-                        self._next_resp, = struct.unpack('!?', resp)
-                        self._next_length, = struct.unpack('!I', length)
+                # A single read may contain several packets (or the tail of
+                # one), so we keep going until we run out of complete ones.
+                while True:
+                    # We are still waiting for the length byte.
+                    if self._pkt_state == ReadQueue.PacketState.WAITING:
+                        if not self._read_length(): break
                         self._pkt_state = ReadQueue.PacketState.READING
                         L.debug("Extracted data from packet: resp=%s,len=%d",
                                 self._next_resp, self._next_length)
 
-                if self._pkt_state == ReadQueue.PacketState.READING:
-                    base_length = message.MessageContainer.MIN_MESSAGE_LEN
-                    if self._next_resp:
-                        base_length += message.MessageContainer.RESPONSE_LEN
-
-                    total_length = base_length + self._next_length
-                    if len(self._pending) >= base_length + self._next_length:
-                        partial = self._pending[ : total_length]
-                        pkt = message.MessageContainer.unpack(partial)
-                        self._pending = self._pending[total_length : ]
-                        L.info("Received full packet in queue: %s", pkt)
-                        L.info("Remaining data: %s", repr(self._pending))
-                        self._queue.append(pkt)
-                        self._pkt_state = ReadQueue.PacketState.WAITING
+                    if self._next_compact:
+                        total_length = self._next_length
+                    else:
+                        total_length = message.MessageContainer.MIN_MESSAGE_LEN
+                        if self._next_resp:
+                            total_length += \
+                                message.MessageContainer.RESPONSE_LEN
+                        total_length += self._next_length
+
+                    if len(self._pending) < total_length: break
+
+                    partial = self._pending[ : total_length]
+                    self._pending = self._pending[total_length : ]
+                    self._pkt_state = ReadQueue.PacketState.WAITING
+
+                    if self._next_compact:
+                        pkt = compact.unpack(partial, self.session)
+                    else:
+                        # Most of the message is only decoded once it's used.
+                        pkt = message.MessageContainer.unpack(partial,
+                                                              lazy=True)
+                        if pkt.supports_compact: self.session.enabled = True
+
+                    L.info("Received full packet in queue: %s", pkt)
+                    L.debug("Remaining data: %r", self._pending)
+                    self._queue.append((pkt, total_length))
 
             except message.UnpackException, e:
                 import traceback
@@ -121,6 +145,33 @@ class ReadQueue(object):
                 debug.hexdump(self._pending)
                 raise
 
+    def _read_length(self):
+        """ Determines the length of the next packet, if enough has arrived.
+
+        For compact messages, `_next_length` is the length of the entire packet;
+        otherwise, it's the length of the payload.
+        """
+        prefix = compact.PREFIX_LEN
+        if len(self._pending) < prefix: return False
+
+        _, version = struct.unpack('!' + compact.PREFIX_FORMAT,
+                                   self._pending[:prefix])
+        self._next_compact = version == compact.VERSION
+        self._next_resp = False
+        if self._next_compact:
+            self._next_length = compact.frame_length(self._pending)
+            return self._next_length is not None
+
+        n, m = self._header_offset, self._resp_offset
+        if len(self._pending) < n + 4: return False
+
+        length = self._pending[n : n + 4]
+        resp = self._pending[m : m + 1]
+
+        self._next_resp, = struct.unpack('!?', resp)
+        self._next_length, = struct.unpack('!I', length)
+        return True
+
     @property
     def ready(self):
         """ Returns whether or not the queue is ready to be processed. """
@@ -128,9 +179,17 @@ class ReadQueue(object):
 
     def pop(self):
         """ Removes the oldest packet from the queue. """
+        return self.pop_sized()[0]
+
+    def pop_sized(self):
+        """ Removes the oldest packet, along with how many bytes it took up.
+        """
         with self._queue_lock:
             return self._queue.pop(0)
 
+    def __len__(self):
+        return len(self._queue)
+
 
 def validate_socket(fn):
     def wrapper(self, *args, **kwargs):
@@ -144,16 +203,63 @@ def validate_socket(fn):
     return wrapper
 
 
+class TrafficMetrics(object):
+    """ The counters that sockets update for every message they send or receive.
+
+    These are shared by every socket that a `commlib.SocketProcessor` manages;
+    see `metrics` for the registry that they live in.
+    """
+    def __init__(self, registry):
+        self.messages_sent = registry.counter("messages_sent_total",
+            "Messages sent, by type.", ("type", ))
+        self.bytes_sent = registry.counter("bytes_sent_total",
+            "Bytes sent, by the type of message they were in.", ("type", ))
+        self.messages_received = registry.counter("messages_received_total",
+            "Messages received, by type.", ("type", ))
+        self.bytes_received = registry.counter("bytes_received_total",
+            "Bytes received, by the type of message they were in.", ("type", ))
+
+    def sent(self, msg, size):
+        name = message.MessageType.LOOKUP.get(msg.type, str(msg.type))
+        self.messages_sent.labels(name).inc()
+        self.bytes_sent.labels(name).inc(size)
+
+    def received(self, msg, size):
+        name = message.MessageType.LOOKUP.get(msg.type, str(msg.type))
+        self.messages_received.labels(name).inc()
+        self.bytes_received.labels(name).inc(size)
+
+
 class PeerSocket(object):
     """ Wraps a socket object for use by a processor.
     """
-    def __init__(self, on_send=lambda *args: None):
+    READ_SIZE = 0x10000     # the most we'll read from the socket at once
+
+    # Every node holds a couple dozen of these (one per connection end).
+    __slots__ = ("transport", "_socket", "_fileno", "local", "remote",
+                 "_local", "_remote", "session", "_queue", "_writelock",
+                 "valid", "hooks", "last_recv", "metrics")
+
+    def __init__(self, on_send=lambda *args: None, transport=chtransport.TCP):
+        """ Prepares a socket; nothing is created until `bind` or `connect`.
+
+        :on_send[=n/a]          called with every chunk of data we write:
+                                    on_send(PeerSocket, data)
+        :transport[=TCP]        the `transport.Transport` to create sockets on
+        """
         super(PeerSocket, self).__init__()
+        self.transport = transport
+        self._fileno = 0
+        self.local = self.remote = None
         self._socket = None
         self._local, self._remote = None, None
-        self._queue = ReadQueue()
+        self.session = compact.Session()
+        self._queue = ReadQueue(self.session)
+        self._writelock = threading.Lock()
         self.valid = True
         self.hooks = {"send": on_send}
+        self.last_recv = clock.time()
+        self.metrics = None     # a `TrafficMetrics`, once we're processed
 
     def create_from_existing(self, existing_socket):
         """ Wraps an existing socket.
@@ -172,7 +278,7 @@ class PeerSocket(object):
             raise TypeError("expected (ip, port), got %s" % type(addr))
 
         self.valid = True
-        self._socket = ThreadsafeSocket()
+        self._socket = ThreadsafeSocket(transport=self.transport)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._socket.bind(addr)
         self._socket.listen(5)
@@ -185,7 +291,7 @@ class PeerSocket(object):
             raise TypeError("expected (ip, port), got %s" % type(addr))
 
         self.valid = True
-        self._socket = ThreadsafeSocket()
+        self._socket = ThreadsafeSocket(transport=self.transport)
         self._socket.connect(addr)
         self._cache_all_properties()
 
@@ -193,7 +299,7 @@ class PeerSocket(object):
         """ Accepts a new inbound connection.
         """
         client, addr = self._socket.accept()
-        return PeerSocket.create_from_accept(addr, client)
+        return PeerSocket.create_from_accept(addr, client, self.transport)
 
     @validate_socket
     def read(self):
@@ -202,14 +308,19 @@ class PeerSocket(object):
         Also, tries parsing the data in the protocol and adds to the internal
         message queue if a full packet has been processed.
         """
-        data = self._socket.recv(message.MessageContainer.MIN_MESSAGE_LEN)
+        data = self._socket.recv(self.READ_SIZE)
+        if not data:            # the remote end shut down cleanly
+            self.valid = False
+            return data
+
+        self.last_recv = clock.time()
 
         try:
             self._queue.read(data)
 
         except message.UnpackException, e:
             L.critical("Failed to process an incoming message: %s", str(e))
-            self._queue.pending = ""
+            self._queue._pending = ""
 
         return data
 
@@ -221,8 +332,29 @@ class PeerSocket(object):
         self._socket.sendall(data)
         return True
 
+    @validate_socket
+    def write_message(self, msg):
+        """ Packs and sends a `MessageContainer` on the socket.
+
+        We use the compact format if the other end has told us it supports it.
+        Packing and sending happen together, since compact messages have to be
+        sent in the order that they're packed.
+        """
+        with self._writelock:
+            if self.session.enabled:
+                data = compact.pack(msg, self.session)
+            else:
+                data = msg.pack()
+
+            written = self.write(data)
+            if written and self.metrics is not None:
+                self.metrics.sent(msg, len(data))
+            return written
+
     def pop_message(self):
-        return self._queue.pop()
+        msg, size = self._queue.pop_sized()
+        if self.metrics is not None: self.metrics.received(msg, size)
+        return msg
 
     @property
     def has_messages(self):
@@ -253,10 +385,11 @@ class PeerSocket(object):
         self.remote = self._socket.getpeername()
 
     @staticmethod
-    def create_from_accept(remote_address, accepted_socket):
+    def create_from_accept(remote_address, accepted_socket,
+                           transport=chtransport.TCP):
         """ Creates a `PeerSocket` instance from a recently-accepted connection.
         """
-        ps = PeerSocket()
+        ps = PeerSocket(transport=transport)
         ps.create_from_existing(accepted_socket)
         assert ps.remote == remote_address
         return ps
@@ -5,14 +5,15 @@ its peers are remote instances -- these correspond to the respective local
 instances on either another machine or a different local process.
 """
 
-import time
 import select
 import socket
 
 from ..chordlib  import commlib
 from ..chordlib  import chordnode, L
+from ..chordlib  import clock
 from ..chordlib  import peersocket
 from ..chordlib  import routing
+from ..chordlib  import transport as chtransport
 from ..packetlib import chord as chordpkt
 
 
@@ -25,7 +26,8 @@ class RemoteNode(chordnode.ChordNode):
 
     PEER_TIMEOUT = 30
 
-    def __init__(self, on_send, node_hash, listener_addr, existing_socket=None):
+    def __init__(self, on_send, node_hash, listener_addr, existing_socket=None,
+                 transport=chtransport.TCP):
         """ Establishes a connection to a remote node.
 
         If `existing_socket` exists, there is no connection initiated.
@@ -33,6 +35,7 @@ class RemoteNode(chordnode.ChordNode):
         :node_hash              the hash of the remote node
         :listener_addr          the listener address on the remote node
         :existing_socket[=None] is there already an established connection?
+        :transport[=TCP]        the `transport.Transport` to connect over
         """
         if not isinstance(listener_addr, tuple):
             raise TypeError("Must join ring via address pair, got %s!" % (
@@ -43,7 +46,7 @@ class RemoteNode(chordnode.ChordNode):
             if not isinstance(existing_socket, peersocket.PeerSocket):
                 raise
         else:
-            s = peersocket.PeerSocket(on_send=on_send)
+            s = peersocket.PeerSocket(on_send=on_send, transport=transport)
             s.connect(listener_addr)
             L.debug("Socket handle: %d", s.fileno())
 
@@ -53,8 +56,10 @@ class RemoteNode(chordnode.ChordNode):
             h = routing.Hash(hashed=node_hash)
 
         self.peer_sock = s
-        self.last_msg = time.time()
+        self._last_msg = clock.time()
         self.timeout = RemoteNode.PEER_TIMEOUT
+        self.load = 0   # the peer's connection count, as it last told us
+        self.codecs = set() # the compression codecs the peer told us it has
 
         super(RemoteNode, self).__init__(h, listener_addr)
         L.info("Created a remote peer with hash %d on %s:%d.",
@@ -74,8 +79,21 @@ class RemoteNode(chordnode.ChordNode):
     def is_valid(self):
         return self.peer_sock.valid
 
+    @property
+    def last_msg(self):
+        """ The last time we heard anything at all from this peer.
+
+        Every received byte counts towards liveness, not just PONGs, so busy
+        peers never need to be pinged explicitly.
+        """
+        return max(self._last_msg, self.peer_sock.last_recv)
+
+    @last_msg.setter
+    def last_msg(self, value):
+        self._last_msg = value
+
     @property
     def is_alive(self):
-        """ Alive: received a PONG within the last `PEER_TIMEOUT` seconds.
+        """ Alive: heard from the peer within the last `PEER_TIMEOUT` seconds.
         """
-        return self.last_msg + self.timeout >= time.time()
+        return self.last_msg + self.timeout >= clock.time()
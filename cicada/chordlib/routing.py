@@ -3,7 +3,10 @@
 
 import math
 import enum
+import struct
 import hashlib
+import binascii
+import itertools
 
 from cicada.chordlib import utils, L
 
@@ -31,6 +34,8 @@ def moddist(a, b, m):
 class Hash(object):
     """ A hashed value with proper conversions between types.
     """
+    __slots__ = ("_value", "_hash_str", "_hash_ints", "_int_cache")
+
     def __init__(self, value="", hashed=""):
         """ Initializes the hash.
 
@@ -59,19 +64,20 @@ class Hash(object):
             self._hash_str = Hash.unpack_hash(hashed)
             self._hash_ints = tuple(hashed)
 
+            # The other cases derive the parts from the string, so they always
+            # match; these parts could have been out of range, though.
+            assert Hash.pack_hash(self._hash_str) == self._hash_ints, \
+                   "Unpacked hash must match direct hash!"
+
         else:
             raise TypeError("Expected value or (str, iter, Hash), got: "
                             "value='%s',hashed='%s'" % (value, hashed))
 
-        assert str(self) == Hash.unpack_hash(self.parts), \
-               "Unpacked hash must match direct hash!"
-
         assert len(str(self)) == HASHLEN, \
                "Invalid hash size: %s" % str(self)
 
-        self._int_cache = sum([
-            i << (32 * j) for j, i in enumerate(self.parts[::-1])
-        ]) % HASHMOD
+        # The parts are big-endian, so this is the same as summing them up.
+        self._int_cache = int(binascii.hexlify(self._hash_str), 16) % HASHMOD
 
     @property
     def value(self):
@@ -125,14 +131,8 @@ class Hash(object):
         if len(data) != HASHLEN:
             raise ValueError("expected a hash, got something else? %s" % data)
 
-        chunks = []
-        for i in xrange(0, HASHLEN, 4):         # 4 bytes to an integer
-            chunk = data[i : i + 4]
-            # pack characters left to right, shifting a byte per index
-            n = sum([ord(c) << 8 * x for x, c in enumerate(chunk[::-1])])
-            chunks.append(n)
-
-        return tuple(chunks)
+        # 4 big-endian bytes to an integer
+        return struct.unpack("!%dI" % CHUNKLEN, data)
 
     @staticmethod
     def unpack_hash(hash_chunks):
@@ -142,16 +142,9 @@ class Hash(object):
             raise ValueError("expected %d integers, got: %s" % (
                              CHUNKLEN, hash_chunks))
 
-        chunks = []
-        for num in hash_chunks:
-            # mask with 0xFF shifted by index and shifted back to be in 0-255
-            chunk = ''.join([
-                chr((num & (0xFF << (8 * i))) >> (8 * i)) \
-                for i in xrange(3, -1, -1)
-            ])
-            chunks.append(chunk)
-
-        return ''.join(chunks).ljust(HASHLEN, '\x00')
+        # each integer masked down to its 4 (big-endian) bytes
+        return struct.pack("!%dI" % CHUNKLEN,
+                           *[ num & 0xFFFFFFFF for num in hash_chunks ])
 
     @staticmethod
     def pack_int(long_value):
@@ -169,9 +162,12 @@ class Hash(object):
 class Interval(object):
     """ Represents an interval [a, b) in a modulus ring.
     """
+    __slots__ = ("modulus", "start", "end")  # every peer keeps hundreds of these
+
     def __init__(self, start, end, mod=HASHMOD):
         self.modulus = mod
-        self.interval = (start, end)
+        self.start = start
+        self.end = end
 
     def within(self, x):
         """ Is `x` within [start, end)? """
@@ -195,12 +191,6 @@ class Interval(object):
 
         return utils.in_range(x, btm, top)
 
-    @property
-    def start(self): return self.interval[0]
-
-    @property
-    def end(self): return self.interval[1]
-
     def __repr__(self): return str(self)
     def __str__(self):
         return "[%d, %s)" % (self.start, self.end)
@@ -209,6 +199,8 @@ class Interval(object):
 class Route(Interval):
     """ Associates an `Interval` with a peer.
     """
+    __slots__ = ("peer", )
+
     def __init__(self, start, end, peer, mod=HASHMOD):
         super(Route, self).__init__(start, end, mod)
         self.peer = peer
@@ -240,11 +232,13 @@ class RoutingTable(object):
         self.root = root
 
         self.length = int(math.ceil(math.log(self.mod, 2)))
+        # Each route ends where the next one starts, so they share the bounds.
         start = int(self.root.hash)
+        bounds = [
+            (start + 2 ** i) % self.mod for i in xrange(self.length + 1)
+        ]
         self.routes = [
-            Route((start + 2 ** i)       % self.mod,
-                  (start + 2 ** (i + 1)) % self.mod,
-                  None, self.mod) \
+            Route(bounds[i], bounds[i + 1], None, self.mod)
             for i in xrange(self.length)
         ]
 
@@ -305,23 +299,21 @@ class RoutingTable(object):
         return self(0)
 
     def iter(self, start):
-        yield self.routes[start]
-
-        i = (start + 1) % len(self.routes)
-        while i != start:
-            yield self.routes[i]
-            i = (i + 1) % len(self.routes)
+        return itertools.chain(self.routes[start:], self.routes[:start])
 
     def unique_iter(self, start):
         """ Iterates over the unique, non-None peers in the routing table.
+
+        This runs for nearly every message, so it's kept as tight as possible.
         """
         last = None
         for route in self.iter(start):
-            if not route.peer or not route.peer.is_valid or route.peer == last:
+            peer = route.peer
+            if peer is None or peer is last or not peer.is_valid:
                 continue
 
-            last = route.peer
-            yield route.peer
+            last = peer
+            yield peer
 
     def __getitem__(self, i):
         return self.routes[i]
@@ -337,6 +329,20 @@ class RoutingTable(object):
             if md <= cr and route.peer.chord_addr != peer.chord_addr:
                 route.peer = peer
 
+    def replace(self, peer, replacement=None):
+        """ Swaps out every route pointing to a peer with another one.
+
+        When a node leaves the ring, its successor inherits its whole interval,
+        so that successor is the correct new entry for each of its routes.
+
+        :peer               the peer (or its `Hash`) being removed
+        :replacement[=None] the peer taking over those routes, if any
+        """
+        peer_hash = peer if isinstance(peer, Hash) else peer.hash
+        for route in self.routes:
+            if route.peer and route.peer.hash == peer_hash:
+                route.peer = replacement
+
     def __len__(self):
         """ Returns the number of valid unique routing entries in the table.
         """
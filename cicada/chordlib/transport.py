@@ -0,0 +1,436 @@
+""" Defines how peers' sockets are created and polled.
+
+Everything above a `PeerSocket` only ever deals with packed frames, so what
+carries those frames is pluggable. Normally, it's TCP. The loopback transport
+instead passes them between sockets in the same process through in-memory
+buffers, which lets a single process host a large number of nodes (for tests,
+simulations, and benchmarks) without involving the kernel or using up ports and
+file descriptors.
+
+A transport is shared by every socket of a node, and nodes can only reach one
+another if they use the same transport instance (the shard transport bridges
+the gap: it's loopback between its own nodes and TCP to everyone else).
+"""
+
+import os
+import errno
+import fcntl
+import select
+import socket
+import itertools
+import threading
+import collections
+
+
+class Transport(object):
+    """ The interface that a transport provides.
+    """
+    def socket(self):
+        """ Creates an unconnected stream socket.
+
+        It must provide the subset of the `socket.socket` interface that a
+        `peersocket.ThreadsafeSocket` uses, and raise `socket.error`s.
+        """
+        raise NotImplementedError()
+
+    def select(self, readers, timeout):
+        """ Waits for any of the given `PeerSocket`s to become readable.
+
+        :readers    the sockets to wait on
+        :timeout    the most seconds to wait
+        :returns    a 2-tuple of the readable sockets and the errored ones
+        """
+        raise NotImplementedError()
+
+
+class TCPTransport(Transport):
+    """ Real sockets, polled with `poll()` (or `select()` where there's no
+    `poll()`; see `_poll()`).
+    """
+    def socket(self):
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def select(self, readers, timeout):
+        return _poll(readers, timeout)
+
+
+class LoopbackTransport(Transport):
+    """ Sockets that live entirely within this process.
+
+    Listeners are registered by address, so connecting to an address only works
+    if a socket on this transport is bound to it. Frames written to one end of a
+    connection are buffered on the other end until they're read.
+    """
+    EPHEMERAL_PORTS = 0xC000    # where outgoing connections' ports start
+
+    class Socket(object):
+        """ One end of an in-memory connection, or a listener.
+        """
+        __slots__ = ("transport", "_fileno", "local", "remote", "peer", "inbox",
+                     "backlog", "listening", "eof", "closed", "waiters")
+
+        def __init__(self, transport, fileno):
+            self.transport = transport
+            self._fileno = fileno
+            self.local = self.remote = None
+            self.peer = None            # the other end of the connection
+            self.inbox = collections.deque()
+            self.backlog = None         # for listeners: deque([ Socket ])
+            self.listening = False
+            self.eof = False            # the other end won't write any more
+            self.closed = False
+            self.waiters = set()        # [ threading.Event ] from `select()`
+
+        def setsockopt(self, *args):
+            pass
+
+        def bind(self, addr):
+            self.transport._bind(self, addr)
+
+        def listen(self, backlog):
+            self.listening = True
+            self.backlog = collections.deque()
+
+        def connect(self, addr):
+            self.transport._connect(self, addr)
+
+        def accept(self):
+            with self.transport._lock:
+                if not self.backlog:
+                    raise socket.error(errno.EAGAIN, "no pending connections")
+                accepted = self.backlog.popleft()
+            return accepted, accepted.remote
+
+        def sendall(self, data):
+            with self.transport._lock:
+                if self.closed or self.peer is None:
+                    raise socket.error(errno.EPIPE, "socket is not connected")
+                if not self.peer.closed:
+                    self.peer.inbox.append(data)
+                    self.peer._wake()
+
+        def recv(self, amt):
+            with self.transport._lock:
+                if self.closed:
+                    raise socket.error(errno.EBADF, "socket is closed")
+
+                data = ""
+                while self.inbox and len(data) < amt:
+                    chunk = self.inbox.popleft()
+                    if len(data) + len(chunk) > amt:
+                        split = amt - len(data)
+                        self.inbox.appendleft(chunk[split:])
+                        chunk = chunk[:split]
+                    data += chunk
+                return data     # empty only once the other end shuts down
+
+        def shutdown(self, how):
+            with self.transport._lock:
+                if self.peer is not None:
+                    self.peer.eof = True
+                    self.peer._wake()
+
+        def close(self):
+            with self.transport._lock:
+                if self.closed: return
+                self.closed = True
+                if self.peer is not None:
+                    self.peer.eof = True
+                    self.peer._wake()
+                self.transport._release(self)
+
+        def fileno(self):
+            return self._fileno
+
+        def getsockname(self):
+            return self.local
+
+        def getpeername(self):
+            if self.remote is None:
+                raise socket.error(errno.ENOTCONN, "socket is not connected")
+            return self.remote
+
+        @property
+        def readable(self):
+            if self.listening: return bool(self.backlog)
+            return bool(self.inbox) or self.eof or self.closed
+
+        def _wake(self):
+            for waiter in self.waiters:
+                waiter.set()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filenos = itertools.count(1)
+        self._ports = itertools.count(self.EPHEMERAL_PORTS)
+        self._sockets = {}      # { fileno: Socket }
+        self._listeners = {}    # { (ip, port): Socket }
+
+    def socket(self):
+        with self._lock:
+            sock = self.Socket(self, next(self._filenos))
+            self._sockets[sock.fileno()] = sock
+            return sock
+
+    def select(self, readers, timeout):
+        with self._lock:
+            readable = self._readable(readers)
+            if readable or not timeout: return readable, []
+
+            sockets = filter(None, [
+                self._sockets.get(r.fileno()) for r in readers
+            ])
+            wakeup = threading.Event()
+            for sock in sockets: sock.waiters.add(wakeup)
+
+        wakeup.wait(timeout)
+        with self._lock:
+            for sock in sockets: sock.waiters.discard(wakeup)
+            return self._readable(readers), []
+
+    def _readable(self, readers):
+        sockets = self._sockets
+        return [
+            r for r in readers
+            if r.fileno() in sockets and sockets[r.fileno()].readable
+        ]
+
+    def _bind(self, sock, addr):
+        addr = self._resolve(addr)
+        with self._lock:
+            if addr in self._listeners:
+                raise socket.error(errno.EADDRINUSE, "address already in use")
+            self._listeners[addr] = sock
+            sock.local = addr
+
+    def _connect(self, sock, addr):
+        addr = self._resolve(addr)
+        with self._lock:
+            listener = self._listeners.get(addr)
+            if listener is None or not listener.listening:
+                raise socket.error(errno.ECONNREFUSED, "connection refused")
+
+            accepted = self.Socket(self, next(self._filenos))
+            self._sockets[accepted.fileno()] = accepted
+
+            sock.local = (addr[0], next(self._ports))
+            sock.remote = accepted.local = addr
+            accepted.remote = sock.local
+            sock.peer, accepted.peer = accepted, sock
+
+            listener.backlog.append(accepted)
+            listener._wake()
+
+    def _release(self, sock):
+        self._sockets.pop(sock.fileno(), None)
+        if sock.listening and self._listeners.get(sock.local) is sock:
+            del self._listeners[sock.local]
+        sock._wake()
+
+    @staticmethod
+    def _resolve(addr):
+        return (socket.gethostbyname(addr[0]), addr[1])
+
+
+class ShardTransport(LoopbackTransport):
+    """ Loopback sockets between local nodes, and TCP sockets to other ones.
+
+    This is for hosting a shard of a larger network in one process: nodes that
+    bound on this transport reach each other in memory, while every listener is
+    also bound to a real socket so that nodes elsewhere (in other processes, or
+    on other machines) can still connect to it.
+    """
+    FILENO_BASE = 1 << 24   # keeps our filenos clear of real descriptors
+
+    class Socket(LoopbackTransport.Socket):
+        def __init__(self, transport, fileno):
+            super(ShardTransport.Socket, self).__init__(transport, fileno)
+            self.real = None    # the TCP socket we're backed by, if any
+
+        def bind(self, addr):
+            self.real = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.real.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.real.bind(addr)
+            super(ShardTransport.Socket, self).bind(addr)
+
+        def listen(self, backlog):
+            super(ShardTransport.Socket, self).listen(backlog)
+            self.real.listen(backlog)
+
+        def connect(self, addr):
+            if self.transport._hosts(addr):
+                self.transport.local_connections += 1
+                return super(ShardTransport.Socket, self).connect(addr)
+
+            self.real = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.real.connect(addr)
+            self.transport.remote_connections += 1
+
+        def accept(self):
+            with self.transport._lock:
+                pending = bool(self.backlog)
+
+            if pending:
+                return super(ShardTransport.Socket, self).accept()
+
+            conn, addr = self.real.accept()
+            return self.transport._adopt(conn), addr
+
+        def sendall(self, data):
+            if self.real is None:
+                return super(ShardTransport.Socket, self).sendall(data)
+            self.real.sendall(data)
+
+        def recv(self, amt):
+            if self.real is None:
+                return super(ShardTransport.Socket, self).recv(amt)
+            return self.real.recv(amt)
+
+        def shutdown(self, how):
+            if self.real is None or self.listening:
+                return super(ShardTransport.Socket, self).shutdown(how)
+            self.real.shutdown(how)
+
+        def close(self):
+            if self.real is not None: self.real.close()
+            super(ShardTransport.Socket, self).close()
+
+        def getsockname(self):
+            if self.real is None or self.listening:
+                return super(ShardTransport.Socket, self).getsockname()
+            return self.real.getsockname()
+
+        def getpeername(self):
+            if self.real is None:
+                return super(ShardTransport.Socket, self).getpeername()
+            return self.real.getpeername()
+
+    class Waker(object):
+        """ Lets in-memory activity interrupt a real `poll()`, via a pipe.
+        """
+        def __init__(self):
+            self._r, self._w = os.pipe()
+            for fd in (self._r, self._w):
+                fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        def set(self):
+            try:
+                os.write(self._w, "!")
+            except OSError:     # full, so the reader will wake up regardless
+                pass
+
+        def clear(self):
+            """ Discards wakeups that nobody was waiting for.
+            """
+            try:
+                while os.read(self._r, 0x100): pass
+            except OSError:     # empty
+                pass
+
+        def fileno(self):
+            return self._r
+
+        def close(self):
+            if self._r is None: return
+            os.close(self._r)
+            os.close(self._w)
+            self._r = self._w = None
+
+        def __del__(self):
+            self.close()
+
+    def __init__(self):
+        super(ShardTransport, self).__init__()
+        self._filenos = itertools.count(self.FILENO_BASE)
+        self._wakers = threading.local()
+        self.local_connections = 0      # connections made in memory
+        self.remote_connections = 0     # ... and over TCP
+
+    def select(self, readers, timeout):
+        waker = self._waker()
+        with self._lock:
+            sockets = filter(None, [
+                self._sockets.get(r.fileno()) for r in readers
+            ])
+            real = dict((s.real, s) for s in sockets if s.real is not None)
+            readable = self._readable(readers)
+            if not real and (readable or not timeout): return readable, []
+
+            waker.clear()
+            for sock in sockets: sock.waiters.add(waker)
+
+        try:
+            wait = 0 if readable else timeout
+            rd, er = _poll(real.keys() + [ waker ], wait)
+        finally:
+            with self._lock:
+                for sock in sockets: sock.waiters.discard(waker)
+
+        errored = set(real[r].fileno() for r in er if r is not waker)
+        ready = set(real[r].fileno() for r in rd if r is not waker)
+        with self._lock:
+            ready.update(r.fileno() for r in self._readable(readers))
+
+        return [ r for r in readers if r.fileno() in ready ], \
+               [ r for r in readers if r.fileno() in errored ]
+
+    def _waker(self):
+        """ The calling thread's `Waker`.
+
+        Each polling thread keeps its own for as long as it lives rather than
+        opening a pipe on every poll. They can't be shared between threads,
+        since one thread clearing the pipe would swallow another's wakeup.
+        """
+        waker = getattr(self._wakers, "waker", None)
+        if waker is None:
+            waker = self._wakers.waker = self.Waker()
+        return waker
+
+    def _hosts(self, addr):
+        """ Whether or not a node on this transport is listening on `addr`.
+        """
+        with self._lock:
+            return self._resolve(addr) in self._listeners
+
+    def _adopt(self, real):
+        """ Wraps a real socket that a listener accepted.
+        """
+        with self._lock:
+            sock = self.Socket(self, next(self._filenos))
+            sock.real = real
+            self._sockets[sock.fileno()] = sock
+            return sock
+
+
+def _poll(readers, timeout):
+    """ Waits for any of the given file-like objects to become readable.
+
+    This prefers `poll()`, since `select()` can't watch descriptors numbered
+    past FD_SETSIZE (usually 1024), which a process hosting many nodes quickly
+    runs into. Without `poll()` (e.g. on Windows), that limit still applies.
+
+    :readers    objects with a `fileno()`
+    :timeout    the most seconds to wait, or `None` to wait indefinitely
+    :returns    a 2-tuple of the readable objects and the errored ones
+    """
+    if not hasattr(select, "poll"):
+        readable, _, errors = select.select(readers, [], readers, timeout)
+        return readable, errors
+
+    poller = select.poll()
+    by_fileno = {}
+    for r in readers:
+        by_fileno[r.fileno()] = r
+        poller.register(r, select.POLLIN | select.POLLPRI)
+
+    events = poller.poll(None if timeout is None else timeout * 1000)
+
+    # Like `select()`, hang-ups and errors show up as readable, so that the
+    # reader finds out about them from `recv()`.
+    readable = select.POLLIN | select.POLLHUP | select.POLLERR
+    errored  = select.POLLPRI | select.POLLNVAL
+    return [ by_fileno[fd] for fd, event in events if event & readable ], \
+           [ by_fileno[fd] for fd, event in events if event & errored ]
+
+
+TCP = TCPTransport()    # the default transport
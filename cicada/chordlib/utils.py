@@ -1,7 +1,8 @@
 import threading
-import time
 import math
 
+from ..chordlib import clock
+
 
 class InfiniteThread(threading.Thread):
     """ An abstract thread to run a method forever until its stopped.
@@ -12,14 +13,33 @@ class InfiniteThread(threading.Thread):
         self.running = True
         self.setDaemon(True)
 
+    def start(self):
+        # Threads that pause between iterations hold up a virtual clock while
+        # they're working (see `clock.VirtualClock`), starting right away so
+        # that time doesn't run ahead of them.
+        self._clock = clock.get()
+        if self._sleep: self._clock.enter(self)
+        super(InfiniteThread, self).start()
+
     def run(self):
-        while self.running:
-            self._loop_method()
-            time.sleep(self.sleep)
+        try:
+            while self.running:
+                self._loop_method()
+                self._clock.sleep(self.sleep)
+        finally:
+            if self._sleep: self._clock.leave(self)
 
     def _loop_method(self):
         raise NotImplemented
 
+    def step(self):
+        """ Runs a single iteration of the loop on the calling thread.
+
+        This lets something else (like a simulator) drive the work that this
+        thread would otherwise do on its own.
+        """
+        self._loop_method()
+
     def stop_running(self):
         self.running = False
 
@@ -31,6 +51,8 @@ class InfiniteThread(threading.Thread):
 class FixedStack(object):
     """ Implements a fixed-sized list that pops off the oldest items.
     """
+    __slots__ = ("size", "_list")
+
     def __init__(self, size):
         self.size = size
         self._list = []
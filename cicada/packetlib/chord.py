@@ -8,33 +8,39 @@ import struct
 import random
 import collections
 
+from ..chordlib  import clock
 from ..chordlib  import routing
 from ..chordlib  import chordnode
 from ..packetlib import message
 from ..packetlib import utils as pktutils
 
 from ..packetlib.message import PackedHash, PackedAddress, PackedNode
+from ..packetlib.message import PackedNodeList
 
 
 class InfoRequest(message.BaseMessage):
     RAW_FORMAT = []
     TYPE = message.MessageType.MSG_CH_INFO
     @classmethod
-    def unpack(cls, bs): return InfoRequest()
+    def unpack_from(cls, buf, offset=0): return InfoRequest(), offset
     def __repr__(self): return "<INFO>"
 
 
 class InfoResponse(message.BaseMessage):
-    RAW_FORMAT = [ PackedNode.EMBED_FORMAT ]
+    RAW_FORMAT = [
+        PackedNode.EMBED_FORMAT,
+        # followed by a `PackedNodeList` of the sender's successor list
+    ]
     TYPE = message.MessageType.MSG_CH_INFO
     RESPONSE = True
 
-    def __init__(self, sender, pred, succ):
+    def __init__(self, sender, pred, succ, successors=()):
         """ Creates internal structures for the INFO message.
 
-        :sender     a `ChordNode` instance of the peer sending their info
-        :pred       the peer's predecessor node (or `None`)
-        :succ       the peer's successor node (or `None`)
+        :sender         a `ChordNode` instance of the peer sending their info
+        :pred           the peer's predecessor node (or `None`)
+        :succ           the peer's successor node (or `None`)
+        :successors[=()] the peer's successor list, nearest first
         """
         if any([not isinstance(x, chordnode.ChordNode) and x is not None \
                 for x in (sender, pred, succ)]):
@@ -44,22 +50,28 @@ class InfoResponse(message.BaseMessage):
         self.sender = sender
         self.predecessor = pred
         self.successor = succ
-        self.time = time.time()
+        self.successors = list(successors)
+        self.time = clock.time()
 
     def pack(self):
         return struct.pack('!' + self.FORMAT,
                            PackedNode(self.sender, self.predecessor,
-                                      self.successor).pack())
+                                      self.successor).pack()) + \
+               PackedNodeList(self.successors).pack()
 
     @classmethod
-    def unpack(cls, bs):
-        node, bs = PackedNode.unpack(bs)
-        return cls(node.node, node.predecessor, node.successor)
+    def unpack_from(cls, buf, offset=0):
+        node, offset = PackedNode.unpack_from(buf, offset)
+        succ, offset = PackedNodeList.unpack_from(buf, offset)
+        return cls(node.node, node.predecessor, node.successor,
+                   succ.nodes), offset
 
     def __repr__(self):
-        return "<INFOr | hash=%d,pred=%d,succ=%d>" % (self.sender.hash,
+        return "<INFOr | hash=%d,pred=%d,succ=%d,succs=%d>" % (
+            self.sender.hash,
             0 if not self.predecessor else self.predecessor.hash,
-            0 if not self.successor   else self.successor.hash)
+            0 if not self.successor   else self.successor.hash,
+            len(self.successors))
 
 
 class JoinRequest(message.BaseMessage):
@@ -85,10 +97,11 @@ class JoinRequest(message.BaseMessage):
                            PackedAddress(*self.listener).pack())
 
     @classmethod
-    def unpack(cls, bytestream):
-        addr, bs = PackedAddress.unpack(bytestream)
-        assert not bs, "Unpacked JR, but bytes remain: %s" % repr(bs)
-        return cls(addr)
+    def unpack_from(cls, buf, offset=0):
+        addr, offset = PackedAddress.unpack_from(buf, offset)
+        assert offset == len(buf), "Unpacked JR, but bytes remain: %s" % (
+               repr(buf[offset:].tobytes()))
+        return cls(addr), offset
 
     def __repr__(self):
         return "<JOIN | on=%s:%d>" % self.listener
@@ -99,20 +112,25 @@ class JoinResponse(InfoResponse):
         InfoResponse.EMBED_FORMAT,
         PackedHash.EMBED_FORMAT,        # requestor's successor hash
         PackedAddress.EMBED_FORMAT,     # ^ address
+        # followed by a `PackedNodeList` of the sender's routing table peers
     ]
     TYPE = message.MessageType.MSG_CH_JOIN
     RESPONSE = True
 
-    def __init__(self, req_succ, *args):
+    def __init__(self, req_succ, sender, pred, succ, successors=(), fingers=()):
         """ Prepares a respones to a JOIN request.
 
-        :req_succ   a node corresponding to a successor of the JOIN sender
-        :args       the remaining parameters are sent directly to `InfoResponse`
+        :req_succ       a node corresponding to a successor of the JOIN sender
+        :sender, pred, succ, successors
+                        these are sent directly to `InfoResponse`
+        :fingers[=()]   the unique peers in the sender's routing table, which
+                        let the new node seed its own table right away
         """
-        super(JoinResponse, self).__init__(*args)
+        super(JoinResponse, self).__init__(sender, pred, succ, successors)
         self.request_successor = req_succ
         self.req_succ_hash = req_succ.hash
         self.req_succ_addr = req_succ.chord_addr
+        self.fingers = list(fingers)
 
     def pack(self):
         old_fmt = self.FORMAT
@@ -120,28 +138,28 @@ class JoinResponse(InfoResponse):
         embedded  = super(JoinResponse, self).pack()
         self.FORMAT = old_fmt
 
-        return struct.pack('!' + self.FORMAT, embedded,
-                           PackedHash(self.req_succ_hash).pack(),
-                           PackedAddress(*self.req_succ_addr).pack())
+        # The embedded INFO is variable-length, so it can't be in the format.
+        req_succ = struct.pack('!' + ''.join(self.RAW_FORMAT[1:]),
+                               PackedHash(self.req_succ_hash).pack(),
+                               PackedAddress(*self.req_succ_addr).pack())
+        return embedded + req_succ + PackedNodeList(self.fingers).pack()
 
     @classmethod
-    def unpack(cls, bytestream):
-        info = InfoResponse.unpack(bytestream)
-
-        bytestream = bytestream[len(info.pack()):]  # inefficient but idc tbh
-        req_succ_hash, bytestream = PackedHash.unpack(bytestream)
-        req_succ_addr, bytestream = PackedAddress.unpack(bytestream)
+    def unpack_from(cls, buf, offset=0):
+        info,          offset = InfoResponse.unpack_from(buf, offset)
+        req_succ_hash, offset = PackedHash.unpack_from(buf, offset)
+        req_succ_addr, offset = PackedAddress.unpack_from(buf, offset)
+        fingers,       offset = PackedNodeList.unpack_from(buf, offset)
 
-        rsn = chordnode.ChordNode(routing.Hash(hashed=req_succ_hash),
-                                  req_succ_addr)
-
-        return cls(rsn, info.sender, info.predecessor, info.successor)
+        rsn = chordnode.ChordNode(req_succ_hash, req_succ_addr)
+        return cls(rsn, info.sender, info.predecessor, info.successor,
+                   info.successors, fingers.nodes), offset
 
     def __repr__(self):
         sub_info = super(JoinResponse, self).__repr__()
-        return "<JOINr | result=%d@%s:%d | %s>" % (
+        return "<JOINr | result=%d@%s:%d,fingers=%d | %s>" % (
                self.req_succ_hash, self.req_succ_addr[0], self.req_succ_addr[1],
-               sub_info[len("<INFO | ") : -1])
+               len(self.fingers), sub_info[len("<INFO | ") : -1])
 
 
 class NotifyRequest(InfoResponse):
@@ -171,45 +189,85 @@ class NotifyResponse(message.BaseMessage):
         return struct.pack('!' + self.FORMAT, self.set_pred)
 
     @classmethod
-    def unpack(cls, bs):
-        bit = struct.unpack('!' + cls.FORMAT, bs)
-        return cls(bit)
+    def unpack_from(cls, buf, offset=0):
+        bit, = struct.unpack_from('!' + cls.FORMAT, buf, offset)
+        return cls(bit), offset + cls.MESSAGE_SIZE
 
     def __repr__(self):
         return "<NOTIFYr | set=%s>" % bool(self.set_pred)
 
 
 class LookupRequest(message.BaseMessage):
+    """ Looks up the node responsible for a hash, optionally carrying data.
+
+    Any data is opaque to the nodes routing the request; it's forwarded as-is
+    and only delivered by the node that owns the lookup hash. The origin is
+    included so that the owner knows who the data actually came from.
+    """
     RAW_FORMAT = [
         PackedHash.EMBED_FORMAT,    # hash to look up
+        "?",                        # origin valid bit
+        PackedHash.EMBED_FORMAT,    # origin hash
+        PackedAddress.EMBED_FORMAT, # origin listener
         "I",                        # length of data to send, if any
         "%ds",                      # additional data, if any
     ]
     TYPE = message.MessageType.MSG_CH_LOOKUP
 
-    def __init__(self, lookup_hash, data=""):
+    def __init__(self, lookup_hash, data="", origin=None):
         if not isinstance(lookup_hash, routing.Hash):
             raise TypeError("Please provide a Hash object.")
 
         self.lookup = lookup_hash
         self.data = data
+        self.origin = origin
 
     def pack(self):
+        has_origin = self.origin is not None
+        origin_hash = self.origin.hash if has_origin else \
+                      routing.Hash(hashed="0" * routing.HASHLEN)
+        origin_addr = self.origin.chord_addr if has_origin else ("0.0.0.0", 0)
+
         return struct.pack('!' + self.FORMAT % len(self.data),
                            PackedHash(self.lookup).pack(),
+                           has_origin,
+                           PackedHash(origin_hash).pack(),
+                           PackedAddress(*origin_addr).pack(),
                            len(self.data), self.data)
 
     @classmethod
-    def unpack(cls, bs):
-        get = lambda f: message.MessageContainer.extract_chunk(f, bs, offset)
+    def unpack_from(cls, buf, offset=0):
+        get = lambda f: message.MessageContainer.extract_chunk(f, buf, offset)
+
+        lookup,      offset = PackedHash.unpack_from(buf, offset)
+        has_origin,  offset = get(cls.RAW_FORMAT[1])
+        origin_hash, offset = PackedHash.unpack_from(buf, offset)
+        origin_addr, offset = PackedAddress.unpack_from(buf, offset)
+        dlen,        offset = get(cls.RAW_FORMAT[4])
+        data,        offset = get(cls.RAW_FORMAT[5] % dlen)
+
+        assert offset == len(buf), "Remaining bytes?? %s" % (
+               repr(buf[offset:].tobytes()))
+        origin = chordnode.ChordNode(origin_hash, origin_addr) \
+                 if has_origin else None
+        return LookupRequest(lookup, data, origin), offset
 
-        offset = 0
-        lookup, bs     = PackedHash.unpack(bs)
-        dlen,   offset = get(cls.RAW_FORMAT[1])
-        data,   offset = get(cls.RAW_FORMAT[2] % dlen)
+    @classmethod
+    def peek(cls, buf):
+        """ Reads only the routing fields of a packed request.
 
-        assert bs[offset:] == "", "Remaining bytes?? %s" % bs[offset:]
-        return LookupRequest(lookup, data)
+        This lets a request be forwarded without unpacking (and re-packing) the
+        rest of it.
+
+        :buf        the packed request
+        :returns    a 3-tuple of the lookup `Hash`, whether or not the origin
+                    is set, and the offset of the data in `buf`
+        """
+        lookup, offset = PackedHash.unpack_from(buf, 0)
+        has_origin, _ = message.MessageContainer.extract_chunk(
+            cls.RAW_FORMAT[1], buf, offset)
+        return lookup, has_origin, struct.calcsize('!' + ''.join(
+            cls.RAW_FORMAT[:5]))
 
     def __repr__(self):
         return "<LOOKUP | value=%d>" % (self.lookup)
@@ -244,13 +302,14 @@ class LookupResponse(message.BaseMessage):
             self.hops)
 
     @classmethod
-    def unpack(cls, bs):
-        lookup,  bs = PackedHash.unpack(bs)
-        mapped,  bs = PackedHash.unpack(bs)
-        address, bs = PackedAddress.unpack(bs)
-        hops = message.MessageContainer.extract_chunk(cls.RAW_FORMAT[-1], bs, 0)
+    def unpack_from(cls, buf, offset=0):
+        lookup,  offset = PackedHash.unpack_from(buf, offset)
+        mapped,  offset = PackedHash.unpack_from(buf, offset)
+        address, offset = PackedAddress.unpack_from(buf, offset)
+        hops,    offset = message.MessageContainer.extract_chunk(
+            cls.RAW_FORMAT[-1], buf, offset)
 
-        return LookupResponse(lookup, mapped, address, hops[0])
+        return LookupResponse(lookup, mapped, address, hops), offset
 
     def __repr__(self):
         return "<LOOKUPr %d | result=%d,%s:%d,hops=%d>" % (
@@ -258,12 +317,78 @@ class LookupResponse(message.BaseMessage):
                self.listener[1], self.hops)
 
 
+class QuitRequest(InfoResponse):
+    """ Announces that the sender is leaving the ring.
+
+    This carries the same details as an INFO response: the leaving node's
+    predecessor, successor, and successor list, which lets the receiver patch
+    its own pointers around the departing node right away.
+    """
+    RAW_FORMAT = InfoResponse.RAW_FORMAT
+    TYPE = message.MessageType.MSG_CH_QUIT
+    RESPONSE = False
+
+    def __init__(self, *args):
+        super(QuitRequest, self).__init__(*args)
+
+    def __repr__(self):
+        info_str = super(QuitRequest, self).__repr__()
+        return "<QUIT | %s>" % info_str[len("<INFO | ") : -1]
+
+
+class QuitResponse(message.BaseMessage):
+    """ Acknowledges that a QUIT was processed.
+    """
+    RAW_FORMAT = []
+    TYPE = message.MessageType.MSG_CH_QUIT
+    RESPONSE = True
+    @classmethod
+    def unpack_from(cls, buf, offset=0): return QuitResponse(), offset
+    def __repr__(self): return "<QUITr>"
+
+
+class PingMessage(message.BaseMessage):
+    """ A minimal liveness probe.
+
+    Unlike an INFO request, this carries no ring state whatsoever; the response
+    simply echoes back the value we sent so the sender can pair them up.
+    """
+    RAW_FORMAT = [
+        "I",    # ping value, echoed back in the PONG
+    ]
+    TYPE = message.MessageType.MSG_CH_PING
+
+    def __init__(self, value):
+        self.value = value
+
+    def pack(self):
+        return struct.pack('!' + self.FORMAT, self.value)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        value, = struct.unpack_from('!' + cls.FORMAT, buf, offset)
+        return cls(value), offset + cls.MESSAGE_SIZE
+
+    def __repr__(self):
+        return "<PING | value=%d>" % self.value
+
+
+class PongMessage(PingMessage):
+    RAW_FORMAT = PingMessage.RAW_FORMAT
+    TYPE = message.MessageType.MSG_CH_PING
+    RESPONSE = True
+
+    def __repr__(self):
+        return "<PONG | value=%d>" % self.value
+
+
 def generic_unpacker(msg):
     for packet_type in (
         JoinRequest,    JoinResponse,
         InfoRequest,    InfoResponse,
         NotifyRequest,  NotifyResponse,
         LookupRequest,  LookupResponse,
+        QuitRequest,    QuitResponse,
         PingMessage,    PongMessage
     ):
         if msg.type == packet_type.TYPE and \
@@ -13,11 +13,15 @@ class MessageType(enum.IntEnum):
     """
     MSG_CI_DATA     = 0xFF00
     MSG_CI_BCAST    = 0xFF01
+    MSG_CI_STREAM   = 0xFF02
+    MSG_CI_STREAM_ACK = 0xFF03
 
 # A simple constant-to-string conversion table for human-readability.
 MessageLookup = {
     MessageType.MSG_CI_DATA:    "DATA",
     MessageType.MSG_CI_BCAST:   "BCAST",
+    MessageType.MSG_CI_STREAM:  "STREAM",
+    MessageType.MSG_CI_STREAM_ACK: "STREAM_ACK",
 }
 
 
@@ -37,10 +41,19 @@ class CicadaBaseMessage(object):
         pkt.type = cls.CI_TYPE
         return pkt
 
-    @staticmethod
-    def unpack(bs):
-        fmt = ''.join(CicadaBaseMessage.FORMAT)
-        return bs[struct.calcsize(fmt):]
+    @classmethod
+    def unpack(cls, bs):
+        return cls.unpack_from(memoryview(bs))[0]
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """ Unpacks a message starting at `offset` in a buffer.
+
+        Like `message.BaseMessage.unpack_from`, this returns the message and
+        the offset just past it. The message type at the start is skipped,
+        since the caller already had to read it to know what to unpack.
+        """
+        raise NotImplementedError()
 
     @property
     def msg_type(self):
@@ -108,25 +121,20 @@ class BroadcastMessage(CicadaBaseMessage):
                            dlen, self.data)
 
     @classmethod
-    def unpack(cls, bs):
-        get = lambda f: message.MessageContainer.extract_chunk(f, bs, offset)
-
-        offset = 0
-        hashsize = message.PackedHash.MESSAGE_SIZE
+    def unpack_from(cls, buf, offset=0):
+        get = lambda f: message.MessageContainer.extract_chunk(f, buf, offset)
 
-        bs = CicadaBaseMessage.unpack(bs)
-        vlen,    offset = get(cls.RAW_FORMAT[0])
-        voffset         = offset
-        visited, offset = get(cls.RAW_FORMAT[1] % (hashsize * vlen))
-        dlen,    offset = get(cls.RAW_FORMAT[2])
-        data,    offset = get(cls.RAW_FORMAT[3] % dlen)
+        offset += CicadaBaseMessage.MESSAGE_SIZE
+        vlen, offset = get(cls.RAW_FORMAT[0])
 
-        visited = [
-            message.PackedHash.unpack(bs[i : i + hashsize])[0] \
-            for i in xrange(voffset, voffset + len(visited), hashsize)
-        ]
+        visited = []
+        for _ in xrange(vlen):
+            node_hash, offset = message.PackedHash.unpack_from(buf, offset)
+            visited.append(node_hash)
 
-        return BroadcastMessage(data, [], visited)
+        dlen, offset = get(cls.RAW_FORMAT[2])
+        data, offset = get(cls.RAW_FORMAT[3] % dlen)
+        return BroadcastMessage(data, [], visited), offset
 
     def __repr__(self):
         return "<BCast | data=%s; seen=%d>" % (
@@ -150,12 +158,93 @@ class DataMessage(CicadaBaseMessage):
                            len(self.data), self.data)
 
     @classmethod
-    def unpack(cls, bs):
-        get = lambda f: message.MessageContainer.extract_chunk(f, bs, offset)
+    def unpack_from(cls, buf, offset=0):
+        get = lambda f: message.MessageContainer.extract_chunk(f, buf, offset)
 
-        offset = 0
-        bs = CicadaBaseMessage.unpack(bs)
+        offset += CicadaBaseMessage.MESSAGE_SIZE
         dlen,   offset = get(cls.RAW_FORMAT[0])
         data,   offset = get(cls.RAW_FORMAT[1] % dlen)
 
-        return DataMessage(data)
+        return DataMessage(data), offset
+
+
+class StreamMessage(CicadaBaseMessage):
+    """ A single, sequenced chunk of a stream of data.
+
+    The final chunk of a stream has the FIN flag set (and is usually empty).
+    """
+    CI_TYPE = MessageType.MSG_CI_STREAM
+    FLAG_FIN = 0x01
+    RAW_FORMAT = [
+        "I",    # stream identifier
+        "I",    # chunk sequence number
+        "B",    # flags
+        "I",    # data length
+        "%ds",  # data itself
+    ]
+
+    def __init__(self, stream_id, sequence, data, flags=0):
+        super(StreamMessage, self).__init__()
+        self.stream_id = stream_id
+        self.seq = sequence
+        self.flags = flags
+        self.data = data
+
+    def pack(self):
+        return super(StreamMessage, self).pack() + \
+               struct.pack('!' + self.FORMAT % len(self.data),
+                           self.stream_id, self.seq, self.flags,
+                           len(self.data), self.data)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        get = lambda f: message.MessageContainer.extract_chunk(f, buf, offset)
+
+        offset += CicadaBaseMessage.MESSAGE_SIZE
+        stream_id, offset = get(cls.RAW_FORMAT[0])
+        seq,       offset = get(cls.RAW_FORMAT[1])
+        flags,     offset = get(cls.RAW_FORMAT[2])
+        dlen,      offset = get(cls.RAW_FORMAT[3])
+        data,      offset = get(cls.RAW_FORMAT[4] % dlen)
+
+        return StreamMessage(stream_id, seq, data, flags), offset
+
+    @property
+    def is_fin(self):
+        return bool(self.flags & self.FLAG_FIN)
+
+    def __repr__(self):
+        return "<Stream %d | seq=%d,len=%d%s>" % (self.stream_id, self.seq,
+               len(self.data), ",FIN" if self.is_fin else "")
+
+
+class StreamAckMessage(CicadaBaseMessage):
+    """ Acknowledges stream chunks and advertises the receiver's window.
+    """
+    CI_TYPE = MessageType.MSG_CI_STREAM_ACK
+    RAW_FORMAT = [
+        "I",    # stream identifier
+        "I",    # next expected sequence number (all prior ones are received)
+        "H",    # receive window, in chunks
+    ]
+
+    def __init__(self, stream_id, next_seq, window):
+        super(StreamAckMessage, self).__init__()
+        self.stream_id = stream_id
+        self.next_seq = next_seq
+        self.window = window
+
+    def pack(self):
+        return super(StreamAckMessage, self).pack() + \
+               struct.pack('!' + self.FORMAT, self.stream_id, self.next_seq,
+                           self.window)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        offset += CicadaBaseMessage.MESSAGE_SIZE
+        fields = struct.unpack_from('!' + cls.FORMAT, buf, offset)
+        return StreamAckMessage(*fields), offset + cls.MESSAGE_SIZE
+
+    def __repr__(self):
+        return "<StreamAck %d | next=%d,window=%d>" % (self.stream_id,
+               self.next_seq, self.window)
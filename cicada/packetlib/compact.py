@@ -0,0 +1,369 @@
+""" Implements the compact (v2) wire format.
+
+The v0.6 format repeats a lot of information that never changes over the life
+of a connection: the sender hash on every message, a security hash-chain, a
+16-byte checksum, and the full 256-bit hash and address of every node that's
+mentioned, even if it's the same handful of nodes every time.
+
+The compact format is only a different _encoding_ of the same messages: the
+payloads are transcoded field-by-field into it when they're sent and back into
+their v0.6 form when they're received, so nothing above the socket layer can
+tell the difference. It differs in the following ways:
+
+    - Lengths, sequence numbers, and message types are varints.
+    - The sender hash is only sent when it changes, which in practice means
+      only on the first message of a connection.
+    - The first time a node (a hash and listener address) is sent on a
+      connection, it's assigned a handle; afterwards, only the handle is sent.
+    - There's no security hash-chain, and the checksum is a 4-byte CRC32.
+
+Whether or not the remote end can decode the format is negotiated per
+connection: every v0.6 message advertises support for it (via
+`MessageContainer.FEATURE_COMPACT`), and we only switch a connection over to
+the compact format once the other end has told us that it understands it.
+"""
+
+import zlib
+import struct
+
+from ..packetlib import message
+from ..packetlib.errors import ExceptionType
+
+from ..chordlib  import routing
+
+
+VERSION = 0x0200    # v2.0
+
+PREFIX_FORMAT = "2sH"   # the protocol identifier and version, as in v0.6
+PREFIX_LEN = struct.calcsize('!' + PREFIX_FORMAT)
+CHECKSUM_FORMAT = "I"   # CRC32 of everything following it
+CHECKSUM_LEN = struct.calcsize('!' + CHECKSUM_FORMAT)
+
+# Bits in the flags byte.
+FLAG_RESPONSE   = 0x01
+FLAG_EXTENSIONS = 0x02
+FLAG_COMPRESSED = 0x04
+FLAG_SENDER     = 0x08  # the sender hash is included
+
+
+class Session(object):
+    """ The compact format's state on a single connection.
+
+    Each direction of a connection is independent: the handles we assign to
+    nodes we send are unrelated to the ones the remote end assigns.
+    """
+    MAX_HANDLES = 0x1000    # the most nodes we'll remember per direction
+    __slots__ = ("enabled", "sent_sender", "recv_sender", "sent_nodes",
+                 "recv_nodes")
+
+    def __init__(self):
+        self.enabled = False    # can the remote end decode compact messages?
+        self.sent_sender = None
+        self.recv_sender = None
+        self.sent_nodes = {}    # { packed node: handle }
+        self.recv_nodes = []    # [ packed node ], indexed by handle
+
+
+def pack_varint(value):
+    """ Packs an unsigned integer into a LEB128 varint.
+    """
+    out = []
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(chr(byte | 0x80))
+        else:
+            out.append(chr(byte))
+            return ''.join(out)
+
+
+def unpack_varint(bs, offset=0):
+    """ Unpacks a varint from a byte string.
+
+    :returns    a 2-tuple of the value and the offset past it
+    :raises     `UnpackException` if the varint isn't complete
+    """
+    value = shift = 0
+    while True:
+        if offset >= len(bs):
+            raise message.UnpackException(ExceptionType.EXC_MALFORMED,
+                                          "truncated varint")
+        byte = ord(bs[offset])
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def frame_length(bs):
+    """ Determines the total length of the compact message at the start of `bs`.
+
+    :returns    the length, or `None` if not enough of it has arrived to know
+    """
+    try:
+        length, offset = unpack_varint(bs, PREFIX_LEN)
+    except message.UnpackException:
+        return None
+    return offset + length
+
+
+#
+# Payload transcoding.
+#
+# Each field type is a pair of functions that convert a single field from its
+# v0.6 form to its compact form and back. Both take the session, the bytes
+# being read, the offset to start reading at, and a list to append the output
+# to, and return the offset past the field that they read.
+#
+
+NODE_LEN = message.PackedHash.MESSAGE_SIZE + message.PackedAddress.MESSAGE_SIZE
+NO_NODE  = message.PackedHash(routing.Hash(hashed="0" * routing.HASHLEN)).pack()
+NO_NODE += message.PackedAddress("0.0.0.0", 0).pack()   # filler for "no node"
+
+
+def _fixed(size):
+    def copy(session, bs, offset, out):
+        out.append(bs[offset : offset + size])
+        return offset + size
+    return copy, copy
+
+def _int(fmt):
+    size = struct.calcsize('!' + fmt)
+    def encode(session, bs, offset, out):
+        value, = struct.unpack('!' + fmt, bs[offset : offset + size])
+        out.append(pack_varint(value))
+        return offset + size
+
+    def decode(session, bs, offset, out):
+        value, offset = unpack_varint(bs, offset)
+        out.append(struct.pack('!' + fmt, value))
+        return offset
+    return encode, decode
+
+def _encode_node(session, bs, offset, out):
+    node = bs[offset : offset + NODE_LEN]
+    if node in session.sent_nodes:
+        out.append(pack_varint(session.sent_nodes[node] + 1))
+    else:
+        if len(session.sent_nodes) < session.MAX_HANDLES:
+            session.sent_nodes[node] = len(session.sent_nodes)
+        out.append(pack_varint(0) + node)
+    return offset + NODE_LEN
+
+def _decode_node(session, bs, offset, out):
+    handle, offset = unpack_varint(bs, offset)
+    if handle:
+        if handle > len(session.recv_nodes):
+            raise message.UnpackException(ExceptionType.EXC_MALFORMED,
+                                          "unknown node handle %d" % handle)
+        out.append(session.recv_nodes[handle - 1])
+        return offset
+
+    node = bs[offset : offset + NODE_LEN]
+    if len(session.recv_nodes) < session.MAX_HANDLES:
+        session.recv_nodes.append(node)
+    out.append(node)
+    return offset + NODE_LEN
+
+def _encode_optional_node(session, bs, offset, out):
+    valid = bs[offset] != "\x00"
+    out.append(bs[offset])
+    if valid: return _encode_node(session, bs, offset + 1, out)
+    return offset + 1 + NODE_LEN
+
+def _decode_optional_node(session, bs, offset, out):
+    valid = bs[offset] != "\x00"
+    out.append(bs[offset])
+    if valid: return _decode_node(session, bs, offset + 1, out)
+    out.append(NO_NODE)
+    return offset + 1
+
+def _encode_node_list(session, bs, offset, out):
+    count, = struct.unpack('!B', bs[offset])
+    out.append(pack_varint(count))
+    offset += 1
+    for _ in xrange(count):
+        offset = _encode_node(session, bs, offset, out)
+    return offset
+
+def _decode_node_list(session, bs, offset, out):
+    count, offset = unpack_varint(bs, offset)
+    out.append(struct.pack('!B', count))
+    for _ in xrange(count):
+        offset = _decode_node(session, bs, offset, out)
+    return offset
+
+def _encode_blob(session, bs, offset, out):
+    length, = struct.unpack('!I', bs[offset : offset + 4])
+    offset += 4
+    out.append(pack_varint(length) + bs[offset : offset + length])
+    return offset + length
+
+def _decode_blob(session, bs, offset, out):
+    length, offset = unpack_varint(bs, offset)
+    out.append(struct.pack('!I', length) + bs[offset : offset + length])
+    return offset + length
+
+def _rest(session, bs, offset, out):
+    out.append(bs[offset:])
+    return len(bs)
+
+
+HASH      = _fixed(message.PackedHash.MESSAGE_SIZE)
+ADDRESS   = _fixed(message.PackedAddress.MESSAGE_SIZE)
+BOOL      = _fixed(1)
+SHORT     = _int("H")
+INT       = _int("I")
+NODE      = (_encode_node, _decode_node)
+OPT_NODE  = (_encode_optional_node, _decode_optional_node)
+NODE_LIST = (_encode_node_list, _decode_node_list)
+BLOB      = (_encode_blob, _decode_blob)    # "I"-length prefixed data
+REST      = (_rest, _rest)                  # anything we don't understand
+PACKED_NODE = [ NODE, OPT_NODE, OPT_NODE ]  # see `message.PackedNode`
+
+_types = message.MessageType
+SCHEMAS = {     # { (message type, is response): [ fields ] }
+    (_types.MSG_CH_JOIN,   False): [ ADDRESS ],
+    (_types.MSG_CH_JOIN,   True):  PACKED_NODE + [ NODE_LIST, NODE, NODE_LIST ],
+    (_types.MSG_CH_INFO,   False): [],
+    (_types.MSG_CH_INFO,   True):  PACKED_NODE + [ NODE_LIST ],
+    (_types.MSG_CH_NOTIFY, False): PACKED_NODE + [ NODE_LIST ],
+    (_types.MSG_CH_NOTIFY, True):  [ BOOL ],
+    (_types.MSG_CH_LOOKUP, False): [ HASH, OPT_NODE, BLOB ],
+    (_types.MSG_CH_LOOKUP, True):  [ HASH, NODE, SHORT ],
+    (_types.MSG_CH_QUIT,   False): PACKED_NODE + [ NODE_LIST ],
+    (_types.MSG_CH_QUIT,   True):  [],
+    (_types.MSG_CH_PING,   False): [ INT ],
+    (_types.MSG_CH_PING,   True):  [ INT ],
+}
+
+_ext = message.ExtensionType
+EXTENSION_SCHEMAS = {
+    _ext.EXT_KNOWN_NODES:   [ NODE_LIST ],
+    _ext.EXT_SUCCESSORS:    [ NODE_LIST ],
+}
+
+
+def _transcode(schema, session, bs, decode):
+    out, offset = [], 0
+    for field in schema:
+        offset = field[int(decode)](session, bs, offset, out)
+
+    if offset != len(bs):   # trailing data we don't know how to interpret
+        REST[0](session, bs, offset, out)
+    return ''.join(out)
+
+
+def pack(msg, session):
+    """ Packs a `MessageContainer` in the compact format.
+
+    The packed message can only be decoded on the other end of the connection
+    that `session` belongs to, and must be sent before any other message is
+    packed for it.
+    """
+    schema = SCHEMAS.get((msg.type, msg.is_response), [ REST ])
+
+    flags = 0
+    if msg.is_response: flags |= FLAG_RESPONSE
+    if msg.compressed:  flags |= FLAG_COMPRESSED
+    if msg.extensions:  flags |= FLAG_EXTENSIONS
+    if session.sent_sender is None or msg.sender != session.sent_sender:
+        flags |= FLAG_SENDER
+        session.sent_sender = msg.sender
+
+    body = [ struct.pack('!B', flags), pack_varint(msg.type),
+             pack_varint(msg.seq) ]
+
+    if msg.is_response:
+        body.append(pack_varint(msg.original.seq))
+
+    if flags & FLAG_SENDER:
+        body.append(message.PackedHash(msg.sender).pack())
+
+    if msg.extensions:
+        body.append(pack_varint(len(msg.extensions)))
+        for ext_type, value in sorted(msg.extensions.iteritems()):
+            value = _transcode(EXTENSION_SCHEMAS.get(ext_type, [ REST ]),
+                               session, value, False)
+            body.append(struct.pack('!B', ext_type) +
+                        pack_varint(len(value)) + value)
+
+    body.append(_transcode(schema, session, msg.data, False))
+    body = ''.join(body)
+
+    checksum = zlib.crc32(body) & 0xFFFFFFFF
+    msg.checksum = struct.pack('!' + CHECKSUM_FORMAT, checksum)
+    return struct.pack('!' + PREFIX_FORMAT, msg.protocol, VERSION) + \
+           pack_varint(CHECKSUM_LEN + len(body)) + msg.checksum + body
+
+
+def unpack(packet, session):
+    """ Unpacks a single, complete compact message into a `MessageContainer`.
+
+    The resulting message is indistinguishable from its v0.6 counterpart.
+
+    :raises     `UnpackException` if the message can't be decoded
+    """
+    try:
+        return _unpack(packet, session)
+    except (IndexError, struct.error), e:
+        raise message.UnpackException(ExceptionType.EXC_MALFORMED, str(e))
+
+
+def _unpack(packet, session):
+    protocol, version = struct.unpack('!' + PREFIX_FORMAT, packet[:PREFIX_LEN])
+    if protocol not in (message.MessageContainer.CICADA_PR,
+                        message.MessageContainer.CHORD_PR):
+        raise message.UnpackException(ExceptionType.EXC_WRONG_PROTOCOL,
+                                      protocol)
+
+    if version != VERSION:
+        raise message.UnpackException(ExceptionType.EXC_WRONG_VERSION, version)
+
+    length, offset = unpack_varint(packet, PREFIX_LEN)
+    if offset + length != len(packet):
+        raise message.UnpackException(ExceptionType.EXC_WRONG_LENGTH,
+                                      offset + length, len(packet))
+
+    checksum = packet[offset : offset + CHECKSUM_LEN]
+    offset += CHECKSUM_LEN
+    expected, = struct.unpack('!' + CHECKSUM_FORMAT, checksum)
+    if zlib.crc32(packet[offset:]) & 0xFFFFFFFF != expected:
+        raise message.UnpackException(ExceptionType.EXC_BAD_CHECKSUM)
+
+    flags, = struct.unpack('!B', packet[offset])
+    msg_type, offset = unpack_varint(packet, offset + 1)
+    seq,      offset = unpack_varint(packet, offset)
+
+    original = None
+    if flags & FLAG_RESPONSE:
+        orig_seq, offset = unpack_varint(packet, offset)
+        original = message.MessageContainer.FAKE_RESP(orig_seq, "")
+
+    if flags & FLAG_SENDER:
+        end = offset + message.PackedHash.MESSAGE_SIZE
+        session.recv_sender, _ = message.PackedHash.unpack(packet[offset:end])
+        offset = end
+
+    extensions = {}
+    if flags & FLAG_EXTENSIONS:
+        count, offset = unpack_varint(packet, offset)
+        for _ in xrange(count):
+            ext_type, = struct.unpack('!B', packet[offset])
+            ext_len, offset = unpack_varint(packet, offset + 1)
+            value = packet[offset : offset + ext_len]
+            extensions[ext_type] = _transcode(
+                EXTENSION_SCHEMAS.get(ext_type, [ REST ]), session, value, True)
+            offset += ext_len
+
+    schema = SCHEMAS.get((msg_type, bool(flags & FLAG_RESPONSE)), [ REST ])
+    data = _transcode(schema, session, packet[offset:], True)
+
+    msg = message.MessageContainer(msg_type, session.recv_sender, data=data,
+                                   sequence=seq, original=original,
+                                   extensions=extensions,
+                                   compressed=bool(flags & FLAG_COMPRESSED))
+    msg.checksum = checksum
+    return msg
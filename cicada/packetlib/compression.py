@@ -0,0 +1,109 @@
+""" Provides pluggable compression codecs for routed application data.
+
+Compressed data is prefixed with the identifier of the codec that produced it,
+so a receiver can always tell how to decompress it (or whether it can at all).
+Peers tell each other which codecs they support (see `ExtensionType.EXT_CODECS`)
+and data is only ever sent compressed to peers that can decompress it.
+"""
+
+import zlib
+import struct
+
+
+class Codec(object):
+    """ The base class for a compression codec.
+    """
+    ID   = 0x00     # unique identifier, sent on the wire
+    NAME = "none"
+
+    def compress(self, data):   raise NotImplementedError()
+    def decompress(self, data): raise NotImplementedError()
+
+
+class ZlibCodec(Codec):
+    """ Standard DEFLATE compression, which is good enough for most text.
+    """
+    ID    = 0x01
+    NAME  = "zlib"
+    LEVEL = 6       # we're bandwidth-bound far more often than CPU-bound
+
+    def compress(self, data):   return zlib.compress(data, self.LEVEL)
+    def decompress(self, data): return zlib.decompress(data)
+
+
+HEADER = "B"        # the codec identifier
+HEADER_LEN = struct.calcsize('!' + HEADER)
+
+# Codecs we can use, in order of preference.
+CODECS = [ ZlibCodec() ]
+
+
+class CompressionException(Exception):
+    pass
+
+
+def register(codec, preferred=False):
+    """ Adds a codec to the set of ones we support.
+
+    :codec              a `Codec` instance with a unique `ID`
+    :preferred[=False]  whether or not to prefer it over existing codecs
+    """
+    if any([ c.ID == codec.ID for c in CODECS ]):
+        raise ValueError("codec 0x%02x is already registered" % codec.ID)
+
+    if preferred: CODECS.insert(0, codec)
+    else:         CODECS.append(codec)
+
+
+def supported():
+    """ Returns the identifiers of all of the codecs we support.
+    """
+    return [ c.ID for c in CODECS ]
+
+
+def codec_of(blob, offset=0):
+    """ Returns the identifier of the codec that compressed some data.
+
+    :offset[=0]     where the compressed data starts in `blob`
+    """
+    return struct.unpack_from('!' + HEADER, blob, offset)[0]
+
+
+def compress(data, codecs=None):
+    """ Compresses data with the most preferred codec that's acceptable.
+
+    :data           the raw data to compress
+    :codecs[=None]  the codec identifiers that are acceptable, such as those
+                    supported by the peer we're sending to; by default, any
+                    codec we support is acceptable
+    :returns        the compressed data (including the codec prefix), or `None`
+                    if no codec is acceptable or compression doesn't help
+    """
+    for codec in CODECS:
+        if codecs is not None and codec.ID not in codecs: continue
+
+        blob = struct.pack('!' + HEADER, codec.ID) + codec.compress(data)
+        return blob if len(blob) < len(data) else None
+
+    return None
+
+
+def decompress(blob):
+    """ Decompresses data produced by `compress()`.
+
+    Since the data comes off the network, this raises a `CompressionException`
+    for anything it can't decompress, whatever the codec itself would raise.
+    """
+    if len(blob) < HEADER_LEN:
+        raise CompressionException("compressed data is missing its codec")
+
+    codec_id = codec_of(blob)
+    for codec in CODECS:
+        if codec.ID == codec_id:
+            try:
+                return codec.decompress(blob[HEADER_LEN:])
+            except Exception, e:
+                raise CompressionException("corrupt %s data: %s" % (
+                                           codec.NAME, str(e)))
+
+    raise CompressionException("unsupported codec: 0x%02x" % codec_id)
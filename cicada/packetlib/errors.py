@@ -7,3 +7,4 @@ class ExceptionType(object):
     EXC_WRONG_LENGTH    = 6
     EXC_BAD_CHECKSUM    = 7
     EXC_BAD_HASH        = 8
+    EXC_MALFORMED       = 9
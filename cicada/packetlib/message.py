@@ -52,6 +52,14 @@ class FormatMetaclass(type):
 
 
 class PackedObject(object):
+    """ The base class for objects that are embedded in message payloads.
+
+    Each one is decoded by `unpack_from(buf, offset)`, which reads the object
+    starting at `offset` and returns it along with the offset just past it.
+    `buf` can be a `memoryview`, so nested objects are decoded in a single pass
+    without copying the bytes they're made of. `unpack(bs)` is the older form,
+    which returns the unread remainder of `bs` rather than an offset.
+    """
     __metaclass__ = FormatMetaclass
     RAW_FORMAT = []
 
@@ -74,13 +82,13 @@ class PackedAddress(PackedObject):
 
     @classmethod
     def unpack(cls, bytestream):
-        offset = 0
-        get = lambda i: MessageContainer.extract_chunk(
-            cls.RAW_FORMAT[i], bytestream, offset)
+        address, offset = cls.unpack_from(bytestream)
+        return address, bytestream[offset:]
 
-        ip,     offset = get(0)
-        port,   offset = get(1)
-        return (pktutils.int_to_ip(ip), port), bytestream[offset:]
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        ip, port = struct.unpack_from('!' + cls.FORMAT, buf, offset)
+        return (pktutils.int_to_ip(ip), port), offset + cls.MESSAGE_SIZE
 
 
 class PackedHash(PackedObject):
@@ -102,12 +110,13 @@ class PackedHash(PackedObject):
 
     @classmethod
     def unpack(cls, bs):
-        offset = 0
-        get = lambda i: MessageContainer.extract_chunk(
-            cls.RAW_FORMAT[i], bs, offset, keep_chunks=True)
+        hashval, offset = cls.unpack_from(bs)
+        return hashval, bs[offset:]
 
-        parts, i = get(0)
-        return routing.Hash(hashed=routing.Hash.unpack_hash(parts)), bs[i:]
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        parts = struct.unpack_from('!' + cls.FORMAT, buf, offset)
+        return routing.Hash(hashed=parts), offset + cls.MESSAGE_SIZE
 
 
 class PackedNode(PackedObject):
@@ -158,29 +167,67 @@ class PackedNode(PackedObject):
 
     @classmethod
     def unpack(cls, bs):
-        offset = 0
-        get = lambda i: MessageContainer.extract_chunk(
-            cls.RAW_FORMAT[i], bs, offset)
-
-        node_hash, bs = PackedHash.unpack(bs)
-        node_addr, bs = PackedAddress.unpack(bs)
-        node = chordnode.ChordNode(node_hash, node_addr)
-
-        offset = 0
-        pred_valid, offset = get(2)
-        pred_hash, bs = PackedHash.unpack(bs[offset:])
-        pred_addr, bs = PackedAddress.unpack(bs)
-        pred = chordnode.ChordNode(pred_hash, pred_addr) if pred_valid else None
-
-        offset = 0
-        succ_valid, offset = get(5)
-        succ_hash, bs = PackedHash.unpack(bs[offset:])
-        succ_addr, bs = PackedAddress.unpack(bs)
-        succ = chordnode.ChordNode(succ_hash, succ_addr) if succ_valid else None
+        node, offset = cls.unpack_from(bs)
+        return node, bs[offset:]
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        def get_node(offset):
+            node_hash, offset = PackedHash.unpack_from(buf, offset)
+            node_addr, offset = PackedAddress.unpack_from(buf, offset)
+            return chordnode.ChordNode(node_hash, node_addr), offset
+
+        def get_optional(offset):
+            valid, = struct.unpack_from('!' + cls.RAW_FORMAT[2], buf, offset)
+            node, offset = get_node(offset + 1)
+            return node if valid else None, offset
+
+        node, offset = get_node(offset)
+        pred, offset = get_optional(offset)
+        succ, offset = get_optional(offset)
 
         node.predecessor = pred
         node.successor = succ
-        return cls(node, pred, succ), bs
+        return cls(node, pred, succ), offset
+
+
+class PackedNodeList(PackedObject):
+    """ Describes how to serialize a short list of Chord nodes.
+
+    Only the identifying details of each node (its hash and listener address)
+    are included, so this is much more compact than a list of `PackedNode`s.
+    """
+    RAW_FORMAT = [
+        "B",    # number of nodes, N, followed by N (hash, listener) pairs
+    ]
+    MAX_LENGTH = 0xFF
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)[:self.MAX_LENGTH]
+
+    def pack(self):
+        return struct.pack('!' + self.FORMAT, len(self.nodes)) + ''.join([
+            PackedHash(n.hash).pack() + PackedAddress(*n.chord_addr).pack()
+            for n in self.nodes
+        ])
+
+    @classmethod
+    def unpack(cls, bs):
+        nodes, offset = cls.unpack_from(bs)
+        return nodes, bs[offset:]
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        count, = struct.unpack_from('!' + cls.FORMAT, buf, offset)
+        offset += cls.MESSAGE_SIZE
+
+        nodes = []
+        for _ in xrange(count):
+            node_hash, offset = PackedHash.unpack_from(buf, offset)
+            node_addr, offset = PackedAddress.unpack_from(buf, offset)
+            nodes.append(chordnode.ChordNode(node_hash, node_addr))
+
+        return cls(nodes), offset
 
 
 class MessageBlob(enum.Enum):
@@ -189,6 +236,7 @@ class MessageBlob(enum.Enum):
     MSG_HEADER      = 0     # used in all messages
     MSG_RESPONSE    = 1     # only in responses, describes original request
     MSG_PAYLOAD     = 2     # packet data
+    MSG_EXTENSION   = 3     # a single TLV entry in the extension section
 
 
 class MessageType(object):
@@ -199,6 +247,7 @@ class MessageType(object):
     MSG_CH_NOTIFY   = MSG_CH_INFO   + 1
     MSG_CH_LOOKUP   = MSG_CH_NOTIFY + 1
     MSG_CH_QUIT     = MSG_CH_LOOKUP + 1
+    MSG_CH_PING     = MSG_CH_QUIT   + 1
     MSG_CH_ERROR    = 0x00FF
     MSG_CH_MAX      = 0x00FF                # last Chord-type message
 
@@ -209,10 +258,38 @@ class MessageType(object):
         MSG_CH_LOOKUP:  "LOOKUP",
         MSG_CH_INFO:    "INFO",
         MSG_CH_QUIT:    "QUIT",
+        MSG_CH_PING:    "PING",
         MSG_CH_ERROR:   "ERROR",
     }
 
 
+class ExtensionType(object):
+    """ Describes the TLV entries that can follow the payload of any message.
+
+    These let both the application layer and the routing layer piggyback data
+    onto messages that are being sent anyway.
+    """
+    EXT_APP_DATA    = 0x01      # raw application bytes
+    EXT_KNOWN_NODES = 0x02      # `PackedNodeList` sample of the sender's peers
+    EXT_SUCCESSORS  = 0x03      # `PackedNodeList` of the sender's successors
+    EXT_LOAD        = 0x04      # "I", the number of the sender's connections
+    EXT_CODECS      = 0x05      # "B" identifiers of the sender's compression
+                                # codecs, see `compression`
+
+    # The whole section is sized with an "H", so application data is capped
+    # well below that to leave room for the routing layer's own entries.
+    MAX_APP_DATA    = 0xF000
+
+    # A simple constant-to-string conversion table for human-readability.
+    LOOKUP = {
+        EXT_APP_DATA:       "APP_DATA",
+        EXT_KNOWN_NODES:    "KNOWN_NODES",
+        EXT_SUCCESSORS:     "SUCCESSORS",
+        EXT_LOAD:           "LOAD",
+        EXT_CODECS:         "CODECS",
+    }
+
+
 class UnpackException(Exception):
     """ Represents an exception that occurs when decoding a packet.
     """
@@ -239,7 +316,13 @@ class MessageContainer(object):
 
     CHORD_PR  = "\x63\x68"      # ch
     CICADA_PR = "\x63\x69"      # ci
-    VERSION   = 0x0005          # v0.5
+    VERSION   = 0x0006          # v0.6: successor lists in INFO responses
+                                #       and origins in LOOKUP requests
+
+    # Bits in the "optional features" header byte.
+    FEATURE_EXTENSIONS = 0x01   # an extension section follows the payload
+    FEATURE_COMPRESSED = 0x02   # the routed data in the payload is compressed
+    FEATURE_COMPACT    = 0x04   # the sender can decode the compact (v2) format
 
     RAW_FORMATS = {
         MessageBlob.MSG_HEADER: debug.ProtocolSpecifier([
@@ -262,18 +345,29 @@ class MessageContainer(object):
             (PackedHash.EMBED_FORMAT,
                      "sender hash"),
             ("%ds",  "P-byte payload string"),
-        ])
+        ]),
+        MessageBlob.MSG_EXTENSION: debug.ProtocolSpecifier([
+            ("B",    "extension type"),
+            ("H",    "value length, L"),
+            ("%ds",  "L-byte value"),
+        ]),
     }
     FORMATS  = {
         MessageBlob.MSG_HEADER:   RAW_FORMATS[MessageBlob.MSG_HEADER].format,
         MessageBlob.MSG_RESPONSE: RAW_FORMATS[MessageBlob.MSG_RESPONSE].format,
         MessageBlob.MSG_PAYLOAD:  RAW_FORMATS[MessageBlob.MSG_PAYLOAD].format,
+        MessageBlob.MSG_EXTENSION:
+            RAW_FORMATS[MessageBlob.MSG_EXTENSION].format,
     }
     HEADER_LEN   = struct.calcsize('!' + FORMATS[MessageBlob.MSG_HEADER])
     RESPONSE_LEN = struct.calcsize('!' + FORMATS[MessageBlob.MSG_RESPONSE])
     MIN_MESSAGE_LEN = HEADER_LEN
+    CHECKSUM_OFFSET = struct.calcsize('!' + ''.join(    # everything before it
+        RAW_FORMATS[MessageBlob.MSG_HEADER].raw_format[:7]))
+    EXTENSION_TRAILER = "H"     # total length of the TLV entries
 
-    def __init__(self, msg_type, sender, data="", sequence=0, original=None):
+    def __init__(self, msg_type, sender, data="", sequence=0, original=None,
+                 extensions=None, compressed=False):
         """ Prepares a packet.
 
         Data is not packaged in any special way; it is just shoved between the
@@ -285,6 +379,10 @@ class MessageContainer(object):
         :sequence   sequence number of the packet
         :original   the message being responded to, which indicates that this is
                     a response message
+        :extensions[=None]  a dictionary of `ExtensionType`s to raw values,
+                    which are sent in the extension section after the payload
+        :compressed[=False] whether or not the application data carried by the
+                    payload (such as a lookup's data) is compressed
         """
         for value, t in ((msg_type, int), (data, str), (sequence, int)):
             if not isinstance(value, t):
@@ -295,6 +393,9 @@ class MessageContainer(object):
         self.data = data
         self.seq = sequence
         self.original = original
+        self.extensions = dict(extensions or {})
+        self.compressed = compressed
+        self.supports_compact = False   # set on unpacking
 
     def pack(self):
         """ Packs the packet into a binary format for transfer.
@@ -306,16 +407,17 @@ class MessageContainer(object):
             data_hash = ""
 
         hashchain = routing.Hash(value=sender_hash + data_hash)
+        extensions = self._pack_extensions()
         header = struct.pack(
             '!' + self.FORMATS[MessageBlob.MSG_HEADER],
             self.protocol,
             self.VERSION,
             self.type,
             self.is_response,
-            self.seq, 0,
+            self.seq, self.features(bool(extensions)),
             PackedHash(hashchain).pack(),
             '\x00' * 16,
-            len(self.data) + PackedHash.MESSAGE_SIZE)
+            len(self.data) + PackedHash.MESSAGE_SIZE + len(extensions))
 
         if self.is_response:
             header += struct.pack(
@@ -331,117 +433,109 @@ class MessageContainer(object):
             PackedHash(self.sender).pack(),
             self.data)
 
-        packet = header + payload
+        packet = header + payload + extensions
         self.checksum = md5.md5(packet).digest()
 
         # Inject the checksum into the packet at the right place.
         packet = self._inject_checksum(packet, self.checksum)
 
-        assert len(packet) == self.length, \
-               "expected len=%d, got %d." % (len(packet), self.length)
+        expected = self._length(extensions)
+        assert len(packet) == expected, \
+               "expected len=%d, got %d." % (expected, len(packet))
         return packet
 
-    @classmethod
-    def _inject_checksum(cls, packet, checksum):
-        header, remainder = (
-            packet[ : cls.HEADER_LEN ],
-            packet[ cls.HEADER_LEN : ]
-        )
-
-        header_blob = cls.RAW_FORMATS[MessageBlob.MSG_HEADER].raw_format
-        offset = header_blob.index("16s")
-        before = struct.calcsize('!' + ''.join(header_blob[:offset]))
-        packet = header[:before] + checksum + \
-                 header[before + len(checksum):] + remainder
-
-        return packet
-
-    @classmethod
-    def unpack(cls, packet):
-        """ Unpacks a single full packet from a sequence of raw bytes.
-
-        The assumption is that the entire bytestream makes up a complete and
-        correct packet object. If the message is improperly formatted, an
-        `UnpackException` is thrown.
+    def decode(self):
+        """ Finishes decoding a received message; see `LazyMessage`.
         """
-        if len(packet) < cls.MIN_MESSAGE_LEN:
-            raise UnpackException(ExceptionType.EXC_TOO_SHORT, len(packet))
-
-        ## Validate the header.
-        header_fmt = cls.RAW_FORMATS[MessageBlob.MSG_HEADER].raw_format
-        offset = 0
-
-        get = lambda i: MessageContainer.extract_chunk(
-            header_fmt[i], packet, offset)
-
-        protocol,  offset = get(0)
-        version,   offset = get(1)
-
-        if protocol not in (cls.CICADA_PR, cls.CHORD_PR):
-            raise UnpackException(ExceptionType.EXC_WRONG_PROTOCOL, protocol)
-
-        if version != cls.VERSION:
-            raise UnpackException(ExceptionType.EXC_WRONG_VERSION, version)
-
-        # TODO: Ensure type matches protocol.
-        i = 2
-        msgtype,   offset = get(i); i += 1
-        is_resp,   offset = get(i); i += 1
-        seq_no,    offset = get(i); i += 1
-        features,  offset = get(i); i += 1
-        hashval,   offset = get(i); i += 1
-        checksum,  offset = get(i); i += 1
-        payload_sz,offset = get(i)
-
-        resp = None
-        data_offset = cls.HEADER_LEN
-        total_len = data_offset + payload_sz
-
-        if is_resp:
-            data_offset += cls.RESPONSE_LEN
-            total_len += cls.RESPONSE_LEN
+        pass
 
-            get2 = lambda i: MessageContainer.extract_chunk(
-                cls.RAW_FORMATS[MessageBlob.MSG_RESPONSE].raw_format[i],
-                packet, offset)
+    def features(self, extensions):
+        """ Builds the "optional features" header byte.
+        """
+        features = self.FEATURE_COMPACT
+        if extensions:       features |= self.FEATURE_EXTENSIONS
+        if self.compressed:  features |= self.FEATURE_COMPRESSED
+        return features
 
-            seq, offset = get2(0)
-            chk, offset = get2(1)
-            resp = cls.FAKE_RESP(seq, chk)
+    def _pack_extensions(self):
+        """ Packs the extension section (empty if there are no extensions).
 
-        if total_len != len(packet):
-            raise UnpackException(ExceptionType.EXC_WRONG_LENGTH, total_len,
-                                  len(packet))
+        The section is a series of (type, length, value) entries followed by
+        the total length of those entries, so that the receiver can find where
+        the payload ends.
+        """
+        if not self.extensions: return ""
 
-        get = lambda i: MessageContainer.extract_chunk(
-            cls.RAW_FORMATS[MessageBlob.MSG_PAYLOAD].raw_format[i] % (
-                payload_sz - len(PackedHash(sender).pack())), bs, 0)
+        fmt = '!' + self.FORMATS[MessageBlob.MSG_EXTENSION]
+        entries = ''.join([
+            struct.pack(fmt % len(value), ext_type, len(value), value)
+            for ext_type, value in sorted(self.extensions.iteritems())
+        ])
+        return entries + struct.pack('!' + self.EXTENSION_TRAILER, len(entries))
 
-        bs = packet[data_offset:]
-        sender, bs = PackedHash.unpack(bs)
-        data,   bs = get(1)
+    @classmethod
+    def _unpack_extensions(cls, buf, start, end):
+        """ Splits the extension section off of the end of a payload.
 
-        cicada = MessageContainer(msgtype, sender, data=data, sequence=seq_no,
-                                  original=resp)
+        :buf        the packet data
+        :start, end the bounds of the payload, including the extension section
+        :returns    a 2-tuple of where the payload data ends and a dictionary
+                    of the extension entries
+        """
+        trailer_len = struct.calcsize('!' + cls.EXTENSION_TRAILER)
+        section_len, = struct.unpack_from('!' + cls.EXTENSION_TRAILER, buf,
+                                          end - trailer_len)
+        offset = end - trailer_len - section_len
+        if offset < start:
+            raise UnpackException(ExceptionType.EXC_WRONG_LENGTH, section_len,
+                                  end - start - trailer_len)
+
+        fmt = cls.RAW_FORMATS[MessageBlob.MSG_EXTENSION].raw_format
+        get = lambda f, i: MessageContainer.extract_chunk(f, buf, i)
+
+        # Every entry has to fit within the section, or the lengths are bogus.
+        limit = end - trailer_len
+        entry_len = struct.calcsize('!' + fmt[0] + fmt[1])
+
+        payload_end = offset
+        extensions = {}
+        while offset < limit:
+            if limit - offset < entry_len:
+                raise UnpackException(ExceptionType.EXC_WRONG_LENGTH,
+                                      entry_len, limit - offset)
+
+            ext_type, offset = get(fmt[0], offset)
+            ext_len,  offset = get(fmt[1], offset)
+            if limit - offset < ext_len:
+                raise UnpackException(ExceptionType.EXC_WRONG_LENGTH,
+                                      ext_len, limit - offset)
+
+            value,    offset = get(fmt[2] % ext_len, offset)
+            extensions[ext_type] = value
+
+        return payload_end, extensions
 
-        data_hash = ""
-        sender_hash = str(routing.Hash(value=str(cicada.sender)))
-        if cicada.data:
-            data_hash = str(routing.Hash(value=cicada.data))
-        expected_hashchain = routing.Hash(value=sender_hash + data_hash)
+    @classmethod
+    def _inject_checksum(cls, packet, checksum):
+        before = cls.CHECKSUM_OFFSET
+        return packet[:before] + checksum + packet[before + len(checksum):]
 
-        if expected_hashchain != hashval:
-            L.warning(EXCEPTION_STRINGS[ExceptionType.EXC_BAD_HASH])
+    @classmethod
+    def unpack(cls, packet, lazy=False):
+        """ Unpacks a single full packet from a sequence of raw bytes.
 
-        # Checksum validation.
-        fake_packet = MessageContainer._inject_checksum(packet, '\x00' * 16)
-        expected = md5.md5(fake_packet).digest()
-        if checksum != expected:
-            raise UnpackException(ExceptionType.EXC_BAD_CHECKSUM)
+        The assumption is that the entire bytestream makes up a complete and
+        correct packet object. If the message is improperly formatted, an
+        `UnpackException` is thrown.
 
-        cicada.checksum = checksum
-        L.debug("Checksum for %s: %s", cicada, repr(cicada.checksum))
-        return cicada
+        :packet         the raw packet
+        :lazy[=False]   only decode the header right away, leaving the payload
+                        (and any exceptions it causes) until it's first used;
+                        see `LazyMessage`
+        """
+        msg = LazyMessage(packet)
+        if not lazy: msg.decode()
+        return msg
 
     def dump(self):
         """ Attempts to dump the packet in a readable format.
@@ -453,10 +547,7 @@ class MessageContainer(object):
 
         pay = D.ProtocolSpecifier(self.RAW_FORMATS[MessageBlob.MSG_PAYLOAD])
         pay.raw_format[1] = pay.raw_format[1] % len(self.data)
-        fmts.append(pay)
-
-        end = D.ProtocolSpecifier(self.RAW_FORMATS[MessageBlob.MSG_END])
-        fmts.append(end)
+        fmts.append(pay)    # any extensions are hex-dumped after this
 
         chunks, desc = (sum([fmt.raw_format for fmt in fmts], []),
                         sum(map(lambda x: list(x.descriptions), fmts), []))
@@ -478,7 +569,19 @@ class MessageContainer(object):
 
     @property
     def length(self):
-        return self.HEADER_LEN + PackedHash.MESSAGE_SIZE + len(self.data)
+        return self._length(self._pack_extensions())
+
+    @property
+    def payload(self):
+        """ The payload's data, as a `memoryview`; see `LazyMessage.payload`.
+        """
+        return memoryview(self.data)
+
+    def _length(self, extensions):
+        """ The packet's length, given its packed extension section.
+        """
+        return self.HEADER_LEN + PackedHash.MESSAGE_SIZE + len(self.data) + \
+               len(extensions)
 
     @property
     def protocol(self):
@@ -488,7 +591,7 @@ class MessageContainer(object):
 
     @property
     def msg_type(self):
-        return MessageType.LOOKUP[self.type]
+        return MessageType.LOOKUP.get(self.type, "0x%04x" % self.type)
 
     @property
     def is_response(self):
@@ -503,31 +606,175 @@ class MessageContainer(object):
     @staticmethod
     def extract_chunk(fmt, data, i, keep_chunks=False):
         """ Extracts a chunk `fmt` out of a packet `data` at index `i`.
+
+        `data` can be a `memoryview`, in which case nothing is copied.
+
+        :raises     `UnpackException` if there aren't enough bytes left
         """
         blob_len = struct.calcsize('!' + fmt)
-        if len(data[i:]) < blob_len:
-            print "  Format[%d]:" % i, fmt
-            debug.hexdump(data)
-            import pdb; pdb.set_trace()
-            assert False, "Invalid blob; expected=%d, got=%d" % (
-                struct.calcsize('!' + fmt), len(data[i:]))
-
-        unpack = struct.unpack('!' + fmt, data[i : i + blob_len])
+        if len(data) - i < blob_len:
+            raise UnpackException(ExceptionType.EXC_WRONG_LENGTH, blob_len,
+                                  max(len(data) - i, 0))
+
+        unpack = struct.unpack_from('!' + fmt, data, i)
         return unpack[0] if not keep_chunks else unpack, blob_len + i
 
     @staticmethod
     def version_to_str(v):
         """ Converts a 2-byte version short into a readable string.
         """
-        return "%d.%d" % ((v & 0xFF00) >> 2, v & 0x00FF)
+        return "%d.%d" % ((v & 0xFF00) >> 8, v & 0x00FF)
 
     def __repr__(self): return str(self)
     def __str__(self):
-        return "<%s%s(%dB)%s>" % (MessageType.LOOKUP[self.type],
+        return "<%s%s(%dB)%s>" % (self.msg_type,
             "r" if self.is_response else "", self.length,
             (" | to=%d" % self.original.seq) if self.is_response else "")
 
 
+class LazyMessage(MessageContainer):
+    """ A received message that's only decoded as far as it's actually used.
+
+    The header fields and the sender are decoded right away, since nearly
+    everything needs them. Splitting out the payload and verifying the packet's
+    hash-chain and checksum happen when `data` is first accessed. Messages that
+    nobody reads, like responses to requests that were given up on, never get
+    that far.
+
+    Messages that are only passed along don't need to get that far, either:
+    `payload` and `extensions` are read straight out of the packet, without
+    verifying it.
+
+    The packet is decoded in-place, so the only copies made are of the
+    fields of the resulting message.
+    """
+    def __init__(self, packet):
+        if len(packet) < self.MIN_MESSAGE_LEN:
+            raise UnpackException(ExceptionType.EXC_TOO_SHORT, len(packet))
+
+        buf = memoryview(packet)
+
+        ## Validate the header.
+        protocol, version, self.type, is_resp, self.seq, self._features, \
+            self._hashchain, self.checksum, payload_sz = struct.unpack_from(
+                '!' + self.FORMATS[MessageBlob.MSG_HEADER], buf, 0)
+
+        if protocol not in (self.CICADA_PR, self.CHORD_PR):
+            raise UnpackException(ExceptionType.EXC_WRONG_PROTOCOL, protocol)
+
+        if version != self.VERSION:
+            raise UnpackException(ExceptionType.EXC_WRONG_VERSION, version)
+
+        # TODO: Ensure type matches protocol.
+        self.original = None
+        offset = MessageContainer.HEADER_LEN
+        total_len = offset + payload_sz
+
+        if is_resp:
+            self.original = self.FAKE_RESP(*struct.unpack_from(
+                '!' + self.FORMATS[MessageBlob.MSG_RESPONSE], buf, offset))
+            offset += self.RESPONSE_LEN
+            total_len += self.RESPONSE_LEN
+
+        if total_len != len(packet):
+            raise UnpackException(ExceptionType.EXC_WRONG_LENGTH, total_len,
+                                  len(packet))
+
+        self.sender, self._data_offset = PackedHash.unpack_from(buf, offset)
+        self.compressed = bool(self._features & self.FEATURE_COMPRESSED)
+        self.supports_compact = bool(self._features & self.FEATURE_COMPACT)
+
+        self._packet = packet
+        self._data = self._extensions = None
+        self._data_end = len(packet)
+
+    def decode(self):
+        """ Decodes the payload and verifies the packet, if it's not done yet.
+
+        :raises     `UnpackException` if the packet has been tampered with
+        """
+        if self._packet is None: return
+
+        buf = memoryview(self._packet)
+        extensions = self._split()
+        data = buf[self._data_offset : self._data_end].tobytes()
+
+        data_hash = ""
+        sender_hash = str(routing.Hash(value=str(self.sender)))
+        if data:
+            data_hash = str(routing.Hash(value=data))
+        expected_hashchain = routing.Hash(value=sender_hash + data_hash)
+
+        if expected_hashchain != self._hashchain:
+            L.warning(EXCEPTION_STRINGS[ExceptionType.EXC_BAD_HASH])
+
+        # Checksum validation, as if the checksum field were zeroed-out.
+        before = self.CHECKSUM_OFFSET
+        expected = md5.md5(buf[:before])
+        expected.update('\x00' * len(self.checksum))
+        expected.update(buf[before + len(self.checksum):])
+        if self.checksum != expected.digest():
+            raise UnpackException(ExceptionType.EXC_BAD_CHECKSUM)
+
+        L.debug("Checksum for %s: %s", self, repr(self.checksum))
+        self._data, self._extensions = data, extensions
+        self._packet = None
+
+    @property
+    def data(self):
+        self.decode()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self.decode()
+        self._data = value
+
+    @property
+    def payload(self):
+        """ The payload's data, without decoding or verifying the packet.
+
+        This is a `memoryview` into the received packet, so nothing is copied.
+        """
+        if self._packet is None:
+            return super(LazyMessage, self).payload
+
+        self._split()
+        return memoryview(self._packet)[self._data_offset : self._data_end]
+
+    @property
+    def extensions(self):
+        if self._packet is not None:
+            return self._split()
+        return self._extensions
+
+    def _split(self):
+        """ Finds where the payload ends and reads the extension section.
+
+        :returns    the extensions, which aren't verified until `decode()`
+        """
+        if self._extensions is None:
+            extensions = {}
+            if self._features & self.FEATURE_EXTENSIONS:
+                self._data_end, extensions = self._unpack_extensions(
+                    memoryview(self._packet), self._data_offset,
+                    len(self._packet))
+            self._extensions = extensions
+
+        return self._extensions
+
+    @extensions.setter
+    def extensions(self, value):
+        self.decode()
+        self._extensions = value
+
+    @property
+    def length(self):
+        if self._packet is not None:
+            return len(self._packet)
+        return super(LazyMessage, self).length
+
+
 class BaseMessage(object):
     """ Base class for all _data_ messages sent using the Cicada protocol.
     """
@@ -535,9 +782,21 @@ class BaseMessage(object):
     RAW_FORMAT = []
     RESPONSE = False
 
+    def pack(self): return ""
+
     @classmethod
-    def unpack(cls, pkt): raise NotImplementedError()
-    def pack(self):       return ""
+    def unpack(cls, bs):
+        """ Unpacks a message from an entire payload.
+        """
+        return cls.unpack_from(memoryview(bs))[0]
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """ Unpacks a message starting at `offset` in a buffer.
+
+        :returns    a 2-tuple of the message and the offset just past it
+        """
+        raise NotImplementedError()
 
     @classmethod
     def make_packet(cls, sender, *args, **kwargs):
@@ -577,4 +836,5 @@ EXCEPTION_STRINGS = {
         "Incorrect packet length! Expected %d bytes, got %d bytes.",
     ExceptionType.EXC_BAD_CHECKSUM: "Invalid packet checksum!",
     ExceptionType.EXC_BAD_HASH: "Invalid security hash -- might be modified!",
+    ExceptionType.EXC_MALFORMED: "Malformed packet: %s.",
 }
@@ -1,6 +1,8 @@
 """ Provides helpful packet-oriented utilities.
 """
+import time
 import threading
+import collections
 
 
 def ip_to_int(addr):
@@ -24,32 +26,32 @@ def int_to_ip(n):
 
 
 class ConditionQueue(object):
-    """ A one-to-one condition-based FIFO queue.
+    """ A many-to-many condition-based FIFO queue.
 
-    This lets you synchronize a producer (adding to the queue) with a consumer
+    This lets you synchronize producers (adding to the queue) with consumers
     (popping off the queue).
 
-    The producer adds data to the queue as they normally would (`push()`).
-    The consumer waits for content as follows:
+    Producers add data to the queue as they normally would (`push()`).
+    Consumers wait for content as follows:
 
     ```python
 
         # assume the `ConditionQueue` instance is `queue`
         with queue:
-            queue.wait()
-
-            # doesn't necessarily need to occur inside of the `with` statement
-            # if there's only one consumer
-            data = queue.pop()
+            if queue.wait(timeout):
+                data = queue.pop()      # or `queue.pop_many()`, for a batch
 
         # use `data`
     ```
 
+    With more than one consumer, the `pop()` must occur inside of the `with`
+    statement, otherwise another consumer may empty the queue first.
+
     NOTE: If the above paradigm isn't followed, the consumer may block the
           producer flow.
     """
     def __init__(self):
-        self._queue = []
+        self._queue = collections.deque()
         self._queue_lock = threading.RLock()
         self._queue_cond = threading.Condition(self._queue_lock)
 
@@ -59,13 +61,37 @@ class ConditionQueue(object):
             self._queue_cond.notify()
 
     def pop(self):
-        """ Removes the oldest packet from the queue. """
+        """ Removes the oldest item from the queue. """
+        with self._queue_lock:
+            return self._queue.popleft()
+
+    def pop_many(self, max_n=None):
+        """ Removes up to `max_n` of the oldest items (or all of them).
+
+        :max_n[=None]   the most items to remove
+        :returns        a list of the items, oldest first
+        """
         with self._queue_lock:
-            return self._queue.pop(0)
+            if max_n is None or max_n >= len(self._queue):
+                items = list(self._queue)
+                self._queue.clear()
+                return items
+
+            return [ self._queue.popleft() for _ in xrange(max_n) ]
 
-    def wait(self):
+    def wait(self, timeout=None):
+        """ Waits for the queue to have items in it.
+
+        :timeout[=None] the most seconds to wait, if at all
+        :returns        whether or not there are items in the queue
+        """
+        deadline = None if timeout is None else time.time() + timeout
         while not self.ready:
-            self._queue_cond.wait()
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0: break
+            self._queue_cond.wait(remaining)
+
+        return self.ready
 
     def __enter__(self):
         self._queue_cond.acquire()
@@ -75,7 +101,7 @@ class ConditionQueue(object):
         # return True    # suppress exceptions
 
     def __len__(self):
-        return len(self.queue)
+        return len(self._queue)
 
     @property
     def ready(self):
@@ -0,0 +1,6 @@
+""" Discrete-event simulation of whole Chord rings in a single process.
+"""
+
+from .events    import EventLoop
+from .network   import SimTransport
+from .simulator import Simulator
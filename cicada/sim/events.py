@@ -0,0 +1,89 @@
+""" Provides the discrete-event loop that simulations run on.
+"""
+
+import heapq
+import logging
+import itertools
+import collections
+
+from ..chordlib import L as chord_log
+from ..chordlib import clock
+
+
+# Simulations turn the nodes' logging down (see `Simulator.LOG_LEVEL`), but
+# events failing is worth hearing about regardless, so it has its own logger.
+L = logging.getLogger(__name__)
+L.setLevel(logging.WARNING)
+for handler in chord_log.handlers: L.addHandler(handler)
+
+
+class EventLoop(clock.SystemClock):
+    """ Runs scheduled callbacks in order of their (virtual) time.
+
+    Everything happens on a single thread: time jumps straight from one event
+    to the next, so nothing can (or needs to) block. The loop doubles as the
+    clock that the Chord layer runs on while it's installed.
+    """
+    def __init__(self, seed=None):
+        """ Prepares an empty loop.
+
+        :seed[=None]    seeds every random choice made during the simulation
+        """
+        super(EventLoop, self).__init__(seed)
+        self.now = 0
+        self.processed = 0
+        self.errors = collections.Counter()     # { exception type: count }
+        self._order = itertools.count()         # breaks ties in event times
+        self._events = []       # heap: [ (time, order, callable, args) ]
+
+    def schedule(self, delay, fn, *args):
+        """ Calls `fn(*args)` after `delay` seconds of virtual time.
+        """
+        self.schedule_at(self.now + delay, fn, *args)
+
+    def schedule_at(self, when, fn, *args):
+        """ Calls `fn(*args)` at a particular (virtual) time.
+        """
+        heapq.heappush(self._events, (max(when, self.now), next(self._order),
+                                      fn, args))
+
+    def run(self, until=None):
+        """ Processes events in order.
+
+        :until[=None]   the time to stop at; by default, we run until there
+                        are no more events (which may be never)
+        :returns        the number of events processed
+        """
+        start = self.processed
+        while self._events and (until is None or self._events[0][0] <= until):
+            self.now, _, fn, args = heapq.heappop(self._events)
+            self.processed += 1
+            try:
+                fn(*args)
+            except Exception, e:
+                # Nodes would only lose a thread to this, so we carry on, but
+                # the first of each kind is usually a bug worth a look.
+                kind = type(e).__name__
+                self.errors[kind] += 1
+                if self.errors[kind] == 1:
+                    L.warning("Simulated event %r failed (later %s errors "
+                              "are only counted):", fn, kind, exc_info=True)
+
+        if until is not None: self.now = max(self.now, until)
+        return self.processed - start
+
+    @property
+    def pending(self):
+        return len(self._events)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        raise RuntimeError("nothing can sleep in a simulation")
+
+    def wait(self, event, timeout=None):
+        return event.is_set()   # it can only ever be set by another event
+
+    def io_timeout(self, timeout):
+        return 0
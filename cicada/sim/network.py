@@ -0,0 +1,116 @@
+""" Provides the simulated network that nodes in a simulation talk over.
+"""
+
+import errno
+import socket
+
+from ..chordlib import transport as chtransport
+
+
+class SimTransport(chtransport.LoopbackTransport):
+    """ An in-memory transport where data takes (virtual) time to arrive.
+
+    Connections behave like TCP: data arrives in order, and it's never lost.
+    Instead, a lost segment costs a retransmission timeout before it (and
+    everything sent after it) arrives.
+
+    Every socket belongs to the node that was acting when it was created (see
+    `acting`), and that node is woken up whenever the socket is readable.
+    """
+    RTO = 0.2   # seconds that a lost segment delays delivery by
+
+    class Socket(chtransport.LoopbackTransport.Socket):
+        __slots__ = ("owner", "arrival")
+
+        def __init__(self, transport, fileno):
+            super(SimTransport.Socket, self).__init__(transport, fileno)
+            self.owner = transport.acting
+            self.arrival = 0    # when the last data we sent will arrive
+
+        def sendall(self, data):
+            self.transport._send(self, data)
+
+        def shutdown(self, how):
+            if self.peer is not None:
+                self.transport._send(self, None)
+
+        def close(self):
+            if self.closed: return
+            self.shutdown(socket.SHUT_RDWR)
+            self.closed = True
+            with self.transport._lock:
+                self.transport._release(self)
+
+    def __init__(self, loop, latency=0.05, jitter=0.02, loss=0.0):
+        """ Creates a network.
+
+        :loop           the `events.EventLoop` that delivers data
+        :latency[=0.05] the average one-way delay, in seconds
+        :jitter[=0.02]  delays vary uniformly by up to this much either way
+        :loss[=0.0]     the probability that a segment has to be retransmitted
+        """
+        super(SimTransport, self).__init__()
+        self.loop = loop
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.acting = None      # the node that's currently running
+        self.on_wake = lambda owner: None
+        self.messages = 0       # segments sent (each is one packed message)
+        self.bytes = 0
+        self._owned = {}        # { owner: set(Socket) }
+
+    def socket(self):
+        sock = super(SimTransport, self).socket()
+        self._owned.setdefault(sock.owner, set()).add(sock)
+        return sock
+
+    def crash(self, owner):
+        """ Abruptly closes every socket that a node owns.
+        """
+        for sock in list(self._owned.pop(owner, ())):
+            sock.close()
+
+    def _connect(self, sock, addr):
+        super(SimTransport, self)._connect(sock, addr)
+
+        # The accepting end belongs to the listener, which only finds out
+        # about the connection once the handshake reaches it.
+        accepted = sock.peer
+        accepted.owner = self._listeners[sock.remote].owner
+        self._owned.setdefault(accepted.owner, set()).add(accepted)
+        sock.arrival = self.loop.now + self._delay()
+        self.loop.schedule_at(sock.arrival, self.on_wake, accepted.owner)
+
+    def _send(self, sock, data):
+        """ Schedules data (or the end of the stream, if `None`) to arrive.
+        """
+        if sock.closed or sock.peer is None:
+            raise socket.error(errno.EPIPE, "socket is not connected")
+
+        if data is not None:
+            self.messages += 1
+            self.bytes += len(data)
+
+        # Nothing can overtake data that was sent before it.
+        sock.arrival = max(sock.arrival, self.loop.now + self._delay())
+        self.loop.schedule_at(sock.arrival, self._deliver, sock.peer, data)
+
+    def _deliver(self, sock, data):
+        if sock.closed: return
+        if data is None:
+            sock.eof = True
+        else:
+            sock.inbox.append(data)
+        self.on_wake(sock.owner)
+
+    def _release(self, sock):
+        super(SimTransport, self)._release(sock)
+        self._owned.get(sock.owner, set()).discard(sock)
+
+    def _delay(self):
+        rng = self.loop.random
+        delay = self.latency + rng.uniform(-self.jitter, self.jitter)
+        while self.loss and rng.random() < self.loss:
+            delay += self.RTO
+        return max(0, delay)
@@ -1 +1,5 @@
 from .swarmnode import SwarmPeer
+from .stream    import SwarmStream, StreamError
+from .workers   import WorkerPool
+from .asyncpeer import AsyncSwarmPeer, Future, FutureTimeout, gather
+from .sharding  import ShardedHost, Shard
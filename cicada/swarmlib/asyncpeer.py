@@ -0,0 +1,322 @@
+""" Provides a non-blocking, future-based variant of the user-facing API.
+
+The regular `SwarmPeer` blocks the calling thread on every operation that waits
+on the network, so an application juggling many sends and lookups at once ends
+up spawning a thread for each one. Here, every operation is fired off
+immediately and returns a `Future` instead. The responses are matched up to
+their futures by the peer's existing processing thread, so an in-flight
+operation costs a small object rather than an OS thread.
+
+Futures are completed on the peer's worker pool, so callbacks attached to them
+(see `Future.add_done_callback`) never hold up the network thread either.
+"""
+
+import threading
+import collections
+
+from ..chordlib  import L
+from ..chordlib  import clock
+from ..swarmlib  import swarmnode
+from ..packetlib import cicada as cicadapkt
+
+
+class FutureTimeout(Exception):
+    pass
+
+
+class FutureCancelled(Exception):
+    pass
+
+
+class Future(object):
+    """ The eventual result of an asynchronous operation.
+
+    A caller decides how long it's willing to wait for the result (see
+    `result()`), independently of the operation's own deadline (after which the
+    future fails with `FutureTimeout`).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def set_result(self, result):
+        """ Completes the future, unless it's already done.
+
+        :returns    whether or not the future was completed by this call
+        """
+        return self._finish(result, None)
+
+    def set_exception(self, error):
+        """ Fails the future with an exception instance, unless it's done.
+        """
+        return self._finish(None, error)
+
+    def cancel(self):
+        """ Gives up on the result, unless the future is already done.
+        """
+        return self._finish(None, FutureCancelled())
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Waits for the result of the operation.
+
+        :timeout[=None] the most seconds to wait, if at all
+        :returns        the result, or raises the exception the future failed
+                        with (or `FutureTimeout`, if the timeout expired)
+        """
+        if not self._done.wait(timeout):
+            raise FutureTimeout("no result after %s seconds" % repr(timeout))
+
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, fn):
+        """ Calls `fn(future)` once the future is done (or now, if it is).
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+
+        self._run(fn)
+
+    def _finish(self, result, error):
+        with self._lock:
+            if self.done(): return False
+            self._result, self._error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            self._run(fn)
+        return True
+
+    def _run(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            L.exception("Future callback %s failed.", repr(fn))
+
+    def __repr__(self):
+        if not self.done(): return "<Future | pending>"
+        if self._error is not None:
+            return "<Future | error=%s>" % repr(self._error)
+        return "<Future | result=%s>" % repr(self._result)
+
+
+def gather(futures, timeout=None):
+    """ Waits for the results of many futures at once.
+
+    :futures        the futures to wait on
+    :timeout[=None] the most seconds to wait for all of them, if at all
+    :returns        a list of their results, in the same order
+    """
+    everything = Future()
+    remaining = [ len(futures) ]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]: return
+        everything.set_result(None)
+
+    if not futures: everything.set_result(None)
+    for future in futures:
+        future.add_done_callback(on_done)
+
+    everything.result(timeout)
+    return [ future.result() for future in futures ]
+
+
+class AsyncSwarmPeer(swarmnode.SwarmPeer):
+    """ A `SwarmPeer` whose network operations return `Future`s.
+
+    Opening a connection to a peer (which `connect()` may have to do) still
+    happens on the calling thread, but nothing ever waits on a response.
+
+    Operations that wait on the network give up after `timeout` seconds, and
+    their futures then fail with `FutureTimeout`, so a peer that never answers
+    can't leave requests pending forever.
+    """
+    TIMEOUT = 10    # default seconds before an unanswered operation expires
+    def __init__(self, *args, **kwargs):
+        super(AsyncSwarmPeer, self).__init__(*args, **kwargs)
+        self._inbox_lock = threading.Lock()
+        self._inbox = collections.deque()       # [ (source, data) ]
+        self._receivers = collections.deque()   # [ (Future, batch) ]
+
+    @swarmnode.bind_first
+    def connect(self, network_host, network_port, timeout=TIMEOUT):
+        """ Joins the swarm through a peer that's already in it.
+
+        :timeout[=TIMEOUT]  the most seconds to wait for the peer to let us in
+        :returns    a future indicating whether or not we joined
+        """
+        future = Future()
+        self.peer.join_ring((network_host, network_port), timeout,
+                            on_joined=self._completer(future, 0, timeout))
+        return future
+
+    @swarmnode.bind_first
+    def lookup(self, target, timeout=TIMEOUT):
+        """ Finds the peer responsible for a target.
+
+        :target     anything accepted by `SwarmPeer.send()`
+        :timeout[=TIMEOUT]  the most seconds to wait for the lookup
+        :returns    a future of the resulting `ChordNode` (or `None`, if the
+                    lookup failed)
+        """
+        dest = self._target_hash(target)
+        future = Future()
+        complete = self._completer(future, int(dest), timeout)
+        self.peer.lookup(dest, lambda result, response: complete(result), 0,
+                         expires=timeout)
+        return future
+
+    @swarmnode.bind_first
+    def send(self, target, data, timeout=TIMEOUT):
+        """ Sends a data packet into the Cicada network.
+
+        :timeout[=TIMEOUT]  the most seconds to wait for the data to arrive
+        :returns    a future of the `ChordNode` that the data reached (or
+                    `None`, if routing it failed)
+        """
+        dest = self._target_hash(target)
+        pkt = cicadapkt.DataMessage.make_packet(data)
+        data, compressed = self.peer.compress(pkt.pack())
+        self._sent.labels("send").inc()
+
+        future = Future()
+        complete = self._completer(future, int(dest), timeout)
+        self.peer.lookup(dest, lambda result, response: complete(result), 0,
+                         data=data, compressed=compressed, expires=timeout)
+        return future
+
+    @swarmnode.bind_first
+    def broadcast(self, data, visited=[]):
+        """ Sends a data packet to every peer in the network.
+
+        :returns    a future of the number of peers that acknowledged it; any
+                    that don't within `TIMEOUT` seconds are counted as not
+        """
+        peers = set(self.peer.routing_table.unique_iter(0))
+        pkt = cicadapkt.BroadcastMessage.make_packet(data,
+            map(lambda x: x.hash, peers), visited=visited)
+        data, compressed = self.peer.compress(pkt.pack())
+        targets = filter(lambda p: p.hash not in visited, peers)
+        self._sent.labels("broadcast").inc()
+
+        future = Future()
+        complete = self._completer(future, int(self.hash))
+        state = { "pending": len(targets), "acked": 0 }
+        lock = threading.Lock()
+
+        def on_response(result, response):
+            with lock:
+                state["pending"] -= 1
+                state["acked"] += result is not None
+                if state["pending"]: return
+            complete(state["acked"])
+
+        if not targets: complete(0)
+        for peer in targets:
+            self.peer.lookup(peer.hash, on_response, 0, data=data,
+                             compressed=compressed, expires=self.TIMEOUT)
+        return future
+
+    @swarmnode.bind_first
+    def recv(self):
+        """ Receives the next data message from the Cicada network.
+
+        If the result is no longer wanted, cancel the future, otherwise the
+        message it would have received is lost.
+
+        :returns    a future of a 2-tuple of the source peer and the data
+        """
+        return self._receive(False)
+
+    @swarmnode.bind_first
+    def recv_many(self, max_n=None):
+        """ Receives a batch of data messages from the Cicada network.
+
+        :max_n[=None]   the most messages to receive; by default, every message
+                        that's pending is received
+        :returns        a future of a list of 2-tuples of the source peer and
+                        the data, which has at least one message in it
+        """
+        return self._receive(max_n or True)
+
+    def __iter__(self):
+        while self.peer is not None:
+            future = self.recv()
+            try:
+                yield future.result(self.RECV_POLL)
+            except FutureTimeout:
+                if not future.cancel():     # it completed as we gave up
+                    yield future.result()
+
+    def _receive(self, batch):
+        future = Future()
+        with self._inbox_lock:
+            if not self._inbox:
+                self._receivers.append((future, batch))
+                return future
+
+            if not batch:
+                result = self._inbox.popleft()
+            elif batch is True or batch >= len(self._inbox):
+                result = list(self._inbox)
+                self._inbox.clear()
+            else:
+                result = [ self._inbox.popleft() for _ in xrange(batch) ]
+
+        future.set_result(result)
+        return future
+
+    def _queued(self):
+        return len(self._inbox)
+
+    def _deliver(self, source_peer, data):
+        """ Hands a data message to the oldest waiting receiver, if any.
+
+        Receivers are completed outside of the lock, since their callbacks may
+        well want to receive again.
+        """
+        self._received.inc()
+        message = (source_peer, self._unwrap(source_peer, data))
+        while True:
+            with self._inbox_lock:
+                if not self._receivers:
+                    self._inbox.append(message)
+                    return
+
+                future, batch = self._receivers.popleft()
+
+            if future.set_result([ message ] if batch else message):
+                return
+
+    def _completer(self, future, key, timeout=None):
+        """ Returns a callable that completes a future on the worker pool.
+
+        :timeout[=None] if set, a failed result (`None` or `False`) that only
+                        comes in once this many seconds have passed means that
+                        the operation expired, so the future fails instead
+        """
+        deadline = None if timeout is None else clock.time() + timeout
+        def complete(result):
+            if (result is None or result is False) and \
+               deadline is not None and clock.time() >= deadline:
+                error = FutureTimeout("no response after %s seconds" % (
+                                      repr(timeout)))
+                self.workers.submit(key, future.set_exception, error)
+            else:
+                self.workers.submit(key, future.set_result, result)
+        return complete
+
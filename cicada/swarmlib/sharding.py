@@ -0,0 +1,254 @@
+""" Hosts a large number of peers across several processes.
+
+Every peer in a process shares the interpreter lock, so a single process can
+only ever make use of one core, no matter how many peers it hosts. A
+`ShardedHost` instead splits the peers into shards (by default, one per core),
+each running in its own process:
+
+    - Peers within a shard talk to each other in memory, over a
+      `chordlib.transport.ShardTransport`.
+    - Peers in different shards talk over TCP, just like peers on different
+      machines would.
+    - The process that created the host acts as the coordinator: it can run
+      code on every shard and collects their statistics.
+
+```python
+    def ping_neighbors(peers):
+        for peer in peers:
+            peer.send(peer.peer.successor.hash, "PING")
+        return len(peers)
+
+    with ShardedHost(1000) as host:
+        print host.call(ping_neighbors)
+        print host.stats()
+```
+
+Shards drain their peers' received messages as they come in, passing each one
+to the host's `handler` (if any) and counting it. Anything that's sent to a
+shard (handlers, functions to `call()`) has to be picklable.
+"""
+
+import os
+import traceback
+import multiprocessing
+
+from ..chordlib import L
+from ..chordlib import transport as chtransport
+from ..swarmlib import swarmnode
+from ..swarmlib import workers as swarmworkers
+
+
+class ShardedHost(object):
+    """ A network of `SwarmPeer`s spread across a pool of processes.
+
+    All of the peers form a single ring: the first peer of the first shard
+    starts it, the first peer of every other shard joins through that peer (over
+    TCP), and every other peer joins through the first one in its own shard.
+    """
+    TIMEOUT = 60        # seconds to wait on a shard before giving up on it
+    TOTALS = ("peers", "joined", "received", "local_connections",
+              "remote_connections")
+
+    def __init__(self, count, shards=None, host="127.0.0.1", port=0xC1CA,
+                 handler=None):
+        """ Prepares the host; nothing is started until `start()`.
+
+        :count          the total number of peers to host
+        :shards[=None]  the number of processes to split them across; by
+                        default, this is the number of cores
+        :host[="127.0.0.1"] the address that every peer binds to
+        :port[=0xC1CA]  the first peer's port; the rest are consecutive
+        :handler[=None] called (in the shard) for every message a peer
+                        receives:
+                            handler(SwarmPeer, source, data)
+        """
+        self.shards = max(1, min(count, shards or multiprocessing.cpu_count()))
+        self.addresses = [ (host, port + i) for i in xrange(count) ]
+        self.handler = handler
+        self._processes = []
+        self._conns = []
+
+    def start(self):
+        """ Starts every shard, returning once all of their peers have joined.
+
+        :returns    each shard's initial statistics (see `stats()`)
+        """
+        bootstrap = self.addresses[0]
+        count = len(self.addresses)
+        for i in xrange(self.shards):
+            lo, hi = i * count // self.shards, (i + 1) * count // self.shards
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_run_shard, name="Shard-%d" % i,
+                args=(child, self.addresses[lo:hi], bootstrap if i else None,
+                      self.handler))
+            process.daemon = True
+            process.start()
+
+            self._processes.append(process)
+            self._conns.append(parent)
+
+            # Every other shard joins through the first, so it has to be up.
+            if i == 0: first = self._result(parent)
+
+        L.info("Started %d peers across %d shards", count, self.shards)
+        return [ first ] + [ self._result(conn) for conn in self._conns[1:] ]
+
+    def call(self, fn, *args):
+        """ Runs a function on every shard.
+
+        :fn         called with the shard's peers (and any other arguments):
+                        fn([ SwarmPeer ], *args)
+        :returns    a list of each shard's result, in shard order
+        """
+        for conn in self._conns:
+            conn.send(("call", fn, args))
+        return [ self._result(conn) for conn in self._conns ]
+
+    def stats(self):
+        """ Collects statistics from every shard.
+
+        :returns    a dictionary with the totals across every shard, as well as
+                    each shard's own statistics (under "shards")
+        """
+        for conn in self._conns:
+            conn.send(("stats", ))
+        return self._summarize([ self._result(conn) for conn in self._conns ])
+
+    def stop(self, timeout=10):
+        """ Shuts down every shard.
+
+        :returns    the final statistics (see `stats()`)
+        """
+        for conn in self._conns:
+            conn.send(("stop", ))
+
+        results = []
+        for conn, process in zip(self._conns, self._processes):
+            try:
+                results.append(self._result(conn, timeout))
+            except swarmnode.SwarmException:
+                L.warning("%s didn't stop in time", process.name)
+
+            process.join(timeout)
+            if process.is_alive(): process.terminate()
+
+        self._processes, self._conns = [], []
+        return self._summarize(results)
+
+    def _result(self, conn, timeout=None):
+        """ Waits on a shard's response to a command.
+        """
+        if not conn.poll(self.TIMEOUT if timeout is None else timeout):
+            raise swarmnode.SwarmException("A shard stopped responding.")
+
+        ok, result = conn.recv()
+        if not ok:
+            raise swarmnode.SwarmException("Shard failed:\n%s" % result)
+        return result
+
+    def _summarize(self, results):
+        totals = dict((key, sum([ r[key] for r in results ]))
+                      for key in self.TOTALS)
+        totals["shards"] = results
+        return totals
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class Shard(object):
+    """ The peers hosted by a single process.
+
+    The peers share one `WorkerPool`, rather than starting a pool apiece, and
+    every peer's listener is a real socket, so a shard needs a file descriptor
+    (against the process' limit) for each peer on top of its TCP connections.
+    """
+    POLL = 0.05     # seconds between checks for commands
+
+    def __init__(self, addresses, bootstrap=None, handler=None):
+        """ Creates the peers and joins them into the ring.
+
+        :addresses      the (host, port) pairs to bind peers to
+        :bootstrap[=None] the address of a peer in another shard to join the
+                        ring through; if not set, our first peer starts it
+        :handler[=None] see `ShardedHost`
+        """
+        self.transport = chtransport.ShardTransport()
+        self.workers = swarmworkers.WorkerPool()    # shared by every peer
+        self.handler = handler
+        self.received = 0
+        self.peers = []
+
+        for address in addresses:
+            peer = swarmnode.SwarmPeer(workers=self.workers,
+                                       transport=self.transport)
+            peer.bind(*address)
+
+            via = addresses[0] if self.peers else bootstrap
+            if via is not None: peer.connect(*via)
+            self.peers.append(peer)
+
+    def serve(self, conn):
+        """ Handles commands from the coordinator until it says to stop.
+        """
+        while True:
+            if conn.poll(self.POLL):
+                command = conn.recv()
+                if command[0] == "stop": break
+
+                try:
+                    if command[0] == "stats":
+                        result = self.stats()
+                    else:
+                        _, fn, args = command
+                        result = fn(self.peers, *args)
+
+                except Exception:
+                    conn.send((False, traceback.format_exc()))
+                    continue
+
+                conn.send((True, result))
+
+            self.drain()
+
+        # Exiting the process takes down every peer's threads with it.
+        conn.send((True, self.stats()))
+
+    def drain(self):
+        """ Processes every message that our peers have received.
+        """
+        for peer in self.peers:
+            for source, data in peer.recv_many(timeout=0):
+                self.received += 1
+                if self.handler is not None:
+                    self.handler(peer, source, data)
+
+    def stats(self):
+        return {
+            "pid":                  os.getpid(),
+            "peers":                len(self.peers),
+            "joined":               len([
+                p for p in self.peers if p.peer.successor
+            ]),
+            "received":             self.received,
+            "local_connections":    self.transport.local_connections,
+            "remote_connections":   self.transport.remote_connections,
+        }
+
+
+def _run_shard(conn, addresses, bootstrap, handler):
+    """ The entry point of a shard's process.
+    """
+    try:
+        shard = Shard(addresses, bootstrap, handler)
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+        return
+
+    conn.send((True, shard.stats()))
+    shard.serve(conn)
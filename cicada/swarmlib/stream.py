@@ -0,0 +1,241 @@
+""" Provides ordered, flow-controlled streams of data between swarm peers.
+
+Sending a large payload as a single message means buffering the whole thing at
+every hop along the way. Instead, a stream splits data into small, sequenced
+chunks that are sent one after another, so each hop can forward a chunk while
+the next one is still on its way. The receiver acknowledges chunks as they
+arrive in order and advertises how many more it's willing to buffer, which
+bounds the memory used on both ends to a fixed window of chunks.
+"""
+
+import threading
+import collections
+
+from ..chordlib  import L
+from ..chordlib  import clock
+from ..packetlib import cicada as cicadapkt
+
+
+class StreamError(Exception):
+    pass
+
+
+class SwarmStream(object):
+    """ One end of a reliable, ordered stream of data with another peer.
+
+    Either end can write to the stream and read from it; each direction has its
+    own sequence numbers and window. Writes block while the window is full, and
+    unacknowledged chunks are re-sent if the other end goes quiet.
+    """
+    CHUNK_SIZE  = 0x4000    # bytes of data per chunk
+    WINDOW      = 16        # the most chunks we'll have in-flight or buffered
+    RETRANSMIT  = 2         # seconds without progress before re-sending
+    MAX_RETRIES = 5         # re-sends without progress before giving up
+
+    def __init__(self, send, remote, stream_id=None):
+        """ Prepares a stream.
+
+        :send               a callable that sends packed data to the other end
+                            of the stream, which must not block:
+                                send(data)
+        :remote             the `Hash` of the peer on the other end
+        :stream_id[=None]   identifies the stream on both ends; a random one is
+                            chosen if it isn't set
+        """
+        self.remote = remote
+        self.stream_id = stream_id or clock.rng().randint(1, 2 ** 32 - 1)
+        self._send = send
+        self._lock = threading.Lock()
+        self._readable = threading.Event()  # set when data (or EOF) arrives
+        self._acks = threading.Event()      # set when an ack arrives
+
+        # The writing half: chunks in [acked, next_seq) are in-flight.
+        self._next_seq = 0
+        self._acked = 0
+        self._window = self.WINDOW      # as advertised by the other end
+        self._ack_count = 0             # acks received, even duplicate ones
+        self._unacked = collections.OrderedDict()   # { seq: packed chunk }
+        self._closed = False
+        self._fin_seq = None            # the sequence number of our FIN
+
+        # The reading half: chunks before `expected` have been received.
+        self._expected = 0
+        self._received = collections.deque()    # in-order data to be read
+        self._early = {}                        # { seq: StreamMessage }
+        self._eof = False
+
+    def write(self, data):
+        """ Sends data on the stream, blocking while the window is full.
+        """
+        if self._closed:
+            raise StreamError("cannot write to a closed stream")
+
+        for i in xrange(0, len(data), self.CHUNK_SIZE):
+            self._send_chunk(data[i : i + self.CHUNK_SIZE])
+
+    def read(self, timeout=None):
+        """ Reads the next chunk of data from the stream.
+
+        :timeout[=None] the number of seconds to wait for data, if any
+        :returns        the data, or an empty string if the other end closed
+                        the stream (or the timeout expired)
+        """
+        deadline = None if timeout is None else clock.time() + timeout
+        while True:
+            with self._lock:
+                if self._received or self._eof: break
+                self._readable.clear()
+
+            remaining = None if deadline is None else deadline - clock.time()
+            if remaining is not None and remaining <= 0: break
+            clock.wait(self._readable, remaining)
+
+        with self._lock:
+            if not self._received:
+                return ""
+
+            reopened = self._free_window() == 0
+            data = self._received.popleft()
+            ack = self._make_ack() if reopened else None
+
+        # If the other end has been waiting for us to make room, let them know.
+        if ack: self._send(ack)
+        return data
+
+    def close(self):
+        """ Closes the writing half of the stream.
+
+        This blocks until the other end acknowledges everything we've sent, or
+        until it stops responding altogether.
+        """
+        if self._closed: return
+        self._send_chunk("", cicadapkt.StreamMessage.FLAG_FIN)
+        self._closed = True
+        self._wait_for(lambda: self._acked >= self._next_seq)
+
+    def on_chunk(self, chunk):
+        """ Processes an incoming `StreamMessage`, acknowledging it.
+        """
+        with self._lock:
+            if self._expected <= chunk.seq < self._expected + self.WINDOW:
+                self._early[chunk.seq] = chunk
+
+            while self._expected in self._early:
+                chunk = self._early.pop(self._expected)
+                self._expected += 1
+                if chunk.is_fin:
+                    self._eof = True
+                else:
+                    self._received.append(chunk.data)
+
+            ack = self._make_ack()
+            self._readable.set()
+
+        self._send(ack)
+
+    def on_ack(self, ack):
+        """ Processes an incoming `StreamAckMessage`, opening up the window.
+        """
+        with self._lock:
+            self._ack_count += 1
+            if ack.next_seq < self._acked:  # stale
+                return
+
+            for seq in xrange(self._acked, ack.next_seq):
+                self._unacked.pop(seq, None)
+
+            self._acked = ack.next_seq
+            self._window = ack.window
+            self._acks.set()
+
+    def _send_chunk(self, data, flags=0):
+        self._wait_for(lambda: self._next_seq < self._acked + self._window)
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            if flags & cicadapkt.StreamMessage.FLAG_FIN: self._fin_seq = seq
+            packed = cicadapkt.StreamMessage.make_packet(
+                self.stream_id, seq, data, flags).pack()
+            self._unacked[seq] = packed
+
+        self._send(packed)
+
+    def _wait_for(self, ready):
+        """ Blocks until `ready()` holds, re-sending chunks if we stall.
+
+        We only give up if the other end stops acknowledging anything at all; a
+        reader that is merely slow keeps answering our probes.
+        """
+        retries = 0
+        while True:
+            with self._lock:
+                if ready(): return
+
+                progress = (self._acked, self._window)
+                acks = self._ack_count
+                self._acks.clear()
+
+            clock.wait(self._acks, self.RETRANSMIT)
+            with self._lock:
+                if ready(): return
+
+                stalled = progress == (self._acked, self._window)
+                silent = acks == self._ack_count
+                resend = self._unacked.values() if stalled else []
+
+                # If nothing is in-flight, we're waiting on a window update,
+                # which may have been lost, so we probe with a duplicate.
+                if stalled and not resend and self._acked:
+                    resend = [ cicadapkt.StreamMessage.make_packet(
+                        self.stream_id, self._acked - 1, "").pack() ]
+
+            if not stalled:
+                retries = 0
+                continue
+
+            retries = retries + 1 if silent else 0
+            if retries > self.MAX_RETRIES:
+                raise StreamError("stream %d stalled" % self.stream_id)
+
+            L.warning("Stream %d stalled, re-sending %d chunks.",
+                      self.stream_id, len(resend))
+            for packed in resend:
+                self._send(packed)
+
+    def _make_ack(self):
+        return cicadapkt.StreamAckMessage.make_packet(
+            self.stream_id, self._expected, self._free_window()).pack()
+
+    def _free_window(self):
+        return max(0, self.WINDOW - len(self._received) - len(self._early))
+
+    @property
+    def done(self):
+        """ Whether or not both halves of the stream are finished.
+
+        A half that was never written to counts as finished, so a stream that
+        only goes one way is done once its writer closes it.
+        """
+        with self._lock:
+            sent = not self._next_seq or \
+                   (self._fin_seq is not None and self._acked > self._fin_seq)
+            return sent and (self._eof or not self._expected)
+
+    @property
+    def eof(self):
+        """ Whether or not the other end has finished writing.
+        """
+        return self._eof and not self._received
+
+    def __iter__(self):
+        """ Iterates over the chunks of data until the other end closes.
+        """
+        while True:
+            data = self.read()
+            if not data and self.eof: return
+            if data: yield data
+
+    def __repr__(self):
+        return "<SwarmStream %d | sent=%d/%d,recv=%d%s>" % (self.stream_id,
+               self._acked, self._next_seq, self._expected,
+               ",eof" if self._eof else "")
@@ -7,7 +7,12 @@ import functools
 from .. import chordlib
 from .. import packetlib
 
+from ..chordlib  import L
 from ..chordlib  import localnode
+from ..chordlib  import utils     as chutils
+from ..chordlib  import transport as chtransport
+from ..swarmlib  import stream as swarmstream
+from ..swarmlib  import workers as swarmworkers
 from ..packetlib import message as pktmsg
 from ..packetlib import chord   as chordpkt
 from ..packetlib import utils   as pktutils
@@ -34,11 +39,33 @@ class SwarmPeer(object):
     interface, though, `bind` is _required_, since every peer in the swarm acts
     like a server for all others.
     """
-    NOOP_RESPONSE = lambda *args: None
-
-    def __init__(self, hooks={}):
+    NOOP_RESPONSE = staticmethod(lambda *args: None)
+    RECV_POLL = 1   # seconds between checks on whether we've closed
+
+    def __init__(self, hooks={}, workers=None, transport=chtransport.TCP):
+        """ Prepares a peer; nothing happens on the network until `bind()`.
+
+        :hooks[={}]     application callbacks for various events:
+                            send(peer_socket, data)
+                            new_peer(address)
+        :workers[=None] the `WorkerPool` to run hooks and data handling on,
+                        so that they never hold up the network thread; one is
+                        created for this peer by default (and stopped when it
+                        closes), but several peers can share one
+        :transport[=TCP] the `chordlib.transport.Transport` to communicate
+                         over; peers on a `LoopbackTransport` can only reach
+                         other peers in the same process
+        """
         self.peer = None    # the peer in the network, established on `bind()`
+        self.workers = workers or swarmworkers.WorkerPool()
+        self._own_workers = workers is None
+        self.transport = transport
         self._read_queue = pktutils.ConditionQueue()
+        self._direct_routes = {}    # { int(Hash): ChordNode }
+        self._streams = {}          # { stream id: SwarmStream }
+        self._unbound = set()       # ids of our streams nobody's answered yet
+        self._finished = chutils.FixedStack(32)     # [ SwarmStream ]
+        self._new_streams = pktutils.ConditionQueue()
         self.hooks = {
             "send":     hooks.get("send", self.NOOP_RESPONSE),
             "recv":     hooks.get("recv", self.NOOP_RESPONSE),
@@ -52,9 +79,21 @@ class SwarmPeer(object):
 
         data = "%s:%d" % (external_ip, external_port)
         self.peer = localnode.LocalNode(data, (hostname, port),
-                                        on_send=self.hooks["send"],
-                                        on_data=self._on_data,
-                                        on_peer=self.hooks["new_peer"])
+                                        on_send=self._offload_hook("send"),
+                                        on_data=self._offload_data,
+                                        on_peer=self._offload_hook("new_peer"),
+                                        transport=self.transport)
+
+        registry = self.peer.metrics
+        self._sent = registry.counter("data_sent_total",
+            "Data messages sent, by how they were sent.", ("kind", ))
+        self._received = registry.counter("data_received_total",
+            "Data messages received.")
+        registry.gauge("recv_queue_depth",
+            "Data messages waiting to be received.", fn=self._queued)
+        registry.gauge("worker_queue_depth",
+            "Callbacks waiting to run on the worker pool.",
+            fn=lambda: self.workers.pending)
 
     @bind_first
     def connect(self, network_host, network_port, timeout=10):
@@ -72,12 +111,16 @@ class SwarmPeer(object):
         pkt = cicadapkt.BroadcastMessage.make_packet(data,
             map(lambda x: x.hash, peers), visited=visited)
 
+        self._sent.labels("broadcast").inc()
+
+        # The same packet goes to everyone, so it only needs compressing once.
+        data, compressed = self.peer.compress(pkt.pack())
         for peer in filter(lambda p: p.hash not in visited, peers):
             self.peer.lookup(peer.hash, self.NOOP_RESPONSE, None,
-                             data=pkt.pack())
+                             data=data, compressed=compressed)
 
     @bind_first
-    def send(self, target, data, duplicates=0):
+    def send(self, target, data, duplicates=0, direct=False):
         """ Sends a data packet into the Cicada network.
 
         We wrap the data into a special routing packet and send it through the
@@ -87,64 +130,118 @@ class SwarmPeer(object):
                         or another `SwarmPeer` instance
         :data           the raw data to pack and send
         :duplicates[=0] the amount of extra peers to route the message through
+        :direct[=False] once a send resolves the peer responsible for the
+                        target, send any further data for it over a direct
+                        connection instead of through the network. if that
+                        connection can't be made, the data goes through the
+                        network instead; if it goes down after the data is
+                        written, the data may be lost (but it's never
+                        delivered twice), and the route is forgotten
         """
-        if isinstance(target, tuple) and len(target) == 2:
-            dest = "%s:%d" % target
-            dest = chordlib.routing.Hash(value=dest)
-
-        elif isinstance(target, chordlib.routing.Hash):
-            dest = target
-
-        elif isinstance(target, SwarmPeer) and target.peer:
-            dest = target.peer.hash
-
-        else:
-            raise TypeError("expected (host, port), Hash, or SwarmPeer, "
-                            " got: %s" % type(target))
-
+        dest = self._target_hash(target)
         pkt = cicadapkt.DataMessage.make_packet(data)
-        peer = self.peer.lookup(dest, self.NOOP_RESPONSE, None, data=pkt.pack())
+        self._sent.labels("send").inc()
+        data, compressed = self.peer.compress(pkt.pack())
+        peer = self._route(dest, data, direct, timeout=None,
+                           compressed=compressed)
+        if peer is None: return     # sent directly
+
         exclusion = set((peer, ))
         for i in xrange(duplicates):
             try:
                 peer = self.peer.lookup(dest, self.NOOP_RESPONSE, None,
-                                        data=pkt.pack(), exclude=exclusion)
+                                        data=data, compressed=compressed,
+                                        exclude=exclusion)
                 exclusion.add(peer)
             except: break
 
     @bind_first
-    def recv(self):
+    def open_stream(self, target, direct=False):
+        """ Opens an ordered, flow-controlled stream of data to a peer.
+
+        Large payloads should be sent this way rather than via `send()`, since
+        they're split into chunks that are never buffered in their entirety.
+
+        :target         see `send()`
+        :direct[=False] see `send()`
+        :returns        a `SwarmStream` to write to (and read from)
+        """
+        dest = self._target_hash(target)
+        stream = swarmstream.SwarmStream(
+            functools.partial(self._route, dest, direct=direct), dest)
+
+        # The target may be a key (or an address that hashes differently than
+        # its peer does), so we only learn who's on the other end once they
+        # answer; see `_on_stream_data()`.
+        self._unbound.add(stream.stream_id)
+        self._streams[stream.stream_id] = stream
+        return stream
+
+    @bind_first
+    def accept_stream(self):
+        """ Blocks until another peer opens a stream to us.
+
+        :returns    the new `SwarmStream`
+        """
+        with self._new_streams:
+            self._new_streams.wait()
+            return self._new_streams.pop()
+
+    @bind_first
+    def recv(self, timeout=None):
         """ Blocks until a data message is received from the Cicada network.
 
         This blocks the current thread, waiting for a signal to be triggered by
         the internal message processing thread. If there are already pending
-        messages, this will return immediately.
-
-        :returns    a 3-tuple of the source peer that the message came from,
-                    the (unpacked) data message we received, and whether or not
-                    there are more messages waiting to be popped
+        messages, this will return immediately. Any number of threads can wait
+        on messages at once; each message goes to exactly one of them.
+
+        :timeout[=None] the most seconds to wait for a message, if at all
+        :returns        a 3-tuple of the source peer that the message came from,
+                        the (unpacked) data message we received, and whether or
+                        not there are more messages waiting to be popped; or
+                        `None` if the timeout expired first
         """
         with self._read_queue:
-            self._read_queue.wait()
+            if not self._read_queue.wait(timeout):
+                return None
+
             source, data = self._read_queue.pop()    # unpacked
+            more = self._read_queue.ready
+
+        return source, self._unwrap(source, data), more
 
-            # Process Cicada messages first.
-            # TODO: put this in a more sensible place.
-            msg_type, = struct.unpack("!H", data[:2])
-            if msg_type == cicadapkt.BroadcastMessage.CI_TYPE:
-                pkt = cicadapkt.BroadcastMessage.unpack(data)
-                pkt.visited.append(source.hash)     # sender has been visited
-                self.broadcast(pkt.data, pkt.visited)
-                data = pkt.data
+    @bind_first
+    def recv_many(self, max_n=None, timeout=None):
+        """ Blocks until data messages are received, then returns a batch.
+
+        This is like `recv()`, but drains up to `max_n` messages on a single
+        wakeup, which is much cheaper for consumers that handle a high rate of
+        messages.
+
+        :max_n[=None]   the most messages to return; by default, every message
+                        that's pending is returned
+        :timeout[=None] the most seconds to wait for a message, if at all
+        :returns        a list of 2-tuples of the source peer and the data
+                        message, oldest first, which is empty if the timeout
+                        expired first (or if every message was malformed)
+        """
+        with self._read_queue:
+            if not self._read_queue.wait(timeout):
+                return []
 
-            elif msg_type == cicadapkt.DataMessage.CI_TYPE:
-                pkt = cicadapkt.DataMessage.unpack(data)
-                data = pkt.data
+            batch = self._read_queue.pop_many(max_n)
 
-            else:
-                raise ValueError("Received unknown data packet.")
+        # One malformed message shouldn't cost us the rest of the batch.
+        messages = []
+        for source, data in batch:
+            try:
+                messages.append((source, self._unwrap(source, data)))
+            except (ValueError, struct.error, pktmsg.UnpackException), e:
+                L.error("Dropped a malformed message from %s: %s",
+                        source, str(e))
 
-            return source, data, self._read_queue.ready
+        return messages
 
     @bind_first
     def get_route(self, value, on_result):
@@ -154,19 +251,46 @@ class SwarmPeer(object):
         """
         return self.peer.lookup(value, on_result, None)
 
+    @bind_first
+    def stats(self, prometheus=False):
+        """ Describes what this peer has been doing.
+
+        Every metric is kept by our `LocalNode` (see `chordlib.metrics`): the
+        messages and bytes sent and received of each type, lookup counts,
+        latencies, and hops, pending requests and timeouts, peers coming and
+        going, and queue depths.
+
+        :prometheus[=False] whether to return the Prometheus text exposition
+                            format instead of a dictionary
+        :returns    a dictionary of { metric name: value }, or a string
+        """
+        if prometheus:
+            return self.peer.metrics.prometheus()
+        return self.peer.metrics.snapshot()
+
     @bind_first
     def close(self):
         """ Closes all background tasks and shuts down the peer.
-        """
-        self.peer.stable.stop_running()
-        self.peer.router.stop_running()
-        self.peer.processor.stop_running()
-        self.peer.listen_thread.stop_running()
 
-        self.peer.stable.join(5)
-        self.peer.router.join(5)
-        self.peer.processor.join(5)
-        self.peer.listen_thread.join(5)
+        This doesn't tell the swarm that we're leaving (see `disconnect()`), but
+        it does close every socket, so the address can be bound again.
+        """
+        node = self.peer
+        for thread in (node.stable, node.router, node.heartbeat,
+                       node.processor, node.listen_thread):
+            thread.stop_running()
+
+        # The maintenance threads only notice that they've been stopped after
+        # pausing for several seconds, so they're left to exit on their own.
+        # The sockets can't be closed while these are still using them, though.
+        for thread in (node.processor, node.listen_thread):
+            if thread.is_alive(): thread.join(5)
+
+        for sock in node.processor.sockets:
+            if sock.valid: sock.close()
+        node.listener.close()
+
+        if self._own_workers: self.workers.stop(5)
         self.peer = None
 
     @property
@@ -186,10 +310,174 @@ class SwarmPeer(object):
 
     @property
     def peek(self):
-        self._read_queue.ready
+        return self._read_queue.ready
+
+    def _queued(self):
+        """ The number of data messages waiting to be received. """
+        return len(self._read_queue)
+
+    def _unwrap(self, source, data):
+        """ Unpacks a Cicada data message, handling any side-effects it has.
+        """
+        msg_type, = struct.unpack("!H", data[:2])
+        if msg_type == cicadapkt.BroadcastMessage.CI_TYPE:
+            pkt = cicadapkt.BroadcastMessage.unpack(data)
+            pkt.visited.append(source.hash)     # sender has been visited
+            self.broadcast(pkt.data, pkt.visited)
+            return pkt.data
+
+        elif msg_type == cicadapkt.DataMessage.CI_TYPE:
+            return cicadapkt.DataMessage.unpack(data).data
+
+        raise ValueError("Received unknown data packet.")
+
+    def _target_hash(self, target):
+        """ Converts any of the supported target types into a `Hash`.
+        """
+        if isinstance(target, tuple) and len(target) == 2:
+            return chordlib.routing.Hash(value="%s:%d" % target)
+
+        elif isinstance(target, chordlib.routing.Hash):
+            return target
+
+        elif isinstance(target, SwarmPeer) and target.peer:
+            return target.peer.hash
+
+        raise TypeError("expected (host, port), Hash, or SwarmPeer, "
+                        " got: %s" % type(target))
+
+    def _route(self, dest, data, direct=False, timeout=0, compressed=False):
+        """ Sends packed Cicada data to the peer responsible for a value.
+
+        :dest           the `Hash` that the data is addressed to
+        :data           the raw data to send
+        :direct[=False] whether or not to use (and learn) a direct route
+        :timeout[=0]    how long to wait for the routing response; by default,
+                        this doesn't block at all
+        :compressed[=False] whether or not `data` is already compressed
+        :returns        the nearest hop the data was routed through, or `None`
+                        if it was sent directly
+        """
+        on_route = self.NOOP_RESPONSE
+        if direct:
+            owner = self._direct_routes.get(int(dest))
+            fallback = functools.partial(self._on_direct_failure, dest)
+            if owner and self.peer.send_direct(owner, dest, data, fallback,
+                                               compressed):
+                return None
+
+            self._direct_routes.pop(int(dest), None)
+            on_route = functools.partial(self._on_route, dest)
+
+        return self.peer.lookup(dest, on_route, timeout, data=data,
+                                compressed=compressed)
+
+    def _on_stream_data(self, source_peer, msg_type, data):
+        """ Hands stream chunks and acks to their stream, creating it if needed.
+        """
+        if msg_type == cicadapkt.StreamMessage.CI_TYPE:
+            pkt = cicadapkt.StreamMessage.unpack(data)
+        else:
+            pkt = cicadapkt.StreamAckMessage.unpack(data)
+
+        stream_id = pkt.stream_id
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            # Finished streams linger for a bit, so that re-sent chunks (whose
+            # acks were lost) are still acknowledged.
+            for stream in reversed(self._finished.list):
+                if stream.stream_id == stream_id: break
+            else:
+                stream = None
+
+        if stream is None:
+            if msg_type != cicadapkt.StreamMessage.CI_TYPE:
+                return  # an ack for a stream we don't know about
+
+            stream = swarmstream.SwarmStream(
+                functools.partial(self._route, source_peer.hash),
+                source_peer.hash, stream_id)
+            self._streams[stream_id] = stream
+            self._new_streams.push(stream)
+
+        elif stream_id in self._unbound:
+            self._unbound.discard(stream_id)
+            stream.remote = source_peer.hash
+
+        elif int(stream.remote) != int(source_peer.hash):
+            return  # somebody else's stream that happens to share the id
+
+        if msg_type == cicadapkt.StreamMessage.CI_TYPE:
+            stream.on_chunk(pkt)
+        else:
+            stream.on_ack(pkt)
+
+        if stream.done and self._streams.pop(stream_id, None) is not None:
+            self._finished.append(stream)
+
+    def _on_route(self, dest, result, response):
+        """ Remembers the peer responsible for a destination.
+        """
+        if result is not None and result.hash != self.peer.hash:
+            self._direct_routes[int(dest)] = result
+
+    def _on_direct_failure(self, dest):
+        """ Forgets a direct route once its connection goes down.
+
+        The data that was in flight isn't re-sent: the connection may have died
+        after it was delivered but before it was acknowledged, and sending it
+        again would deliver it twice.
+        """
+        self._direct_routes.pop(int(dest), None)
+
+    def _offload_hook(self, name):
+        """ Creates a callback that runs a hook on the worker pool.
+
+        The hook is looked up when the callback runs, so hooks can be replaced
+        at any time. Callbacks are ordered by their first argument (the socket
+        or address that they concern), and the no-op default never bothers the
+        workers at all.
+        """
+        def offload(key, *args):
+            hook = self.hooks[name]
+            if hook is not self.NOOP_RESPONSE:
+                self.workers.submit(key, hook, key, *args)
+        return offload
+
+    def _offload_data(self, source_peer, data):
+        """ Handles routed data on the worker pool, in order for each source.
+        """
+        self.workers.submit(int(source_peer.hash), self._on_data,
+                            source_peer, data)
 
     def _on_data(self, source_peer, data):
+        msg_type, = struct.unpack("!H", data[:2])
+        if msg_type in (cicadapkt.StreamMessage.CI_TYPE,
+                        cicadapkt.StreamAckMessage.CI_TYPE):
+            self._on_stream_data(source_peer, msg_type, data)
+            return
+
+        self._deliver(source_peer, data)
+
+    def _deliver(self, source_peer, data):
+        """ Makes a (packed) data message available to `recv()`.
+        """
+        self._received.inc()
         self._read_queue.push((source_peer, data))
 
+    def __iter__(self):
+        """ Iterates over the data messages we receive until the peer closes.
+
+        :returns    2-tuples of the source peer and the data message
+        """
+        while self.peer is not None:
+            try:
+                result = self.recv(self.RECV_POLL)
+            except SwarmException:  # closed while we were waiting
+                return
+
+            if result is not None:
+                yield result[:2]
+
     def __repr__(self):
         return repr(self.peer)
@@ -0,0 +1,144 @@
+""" Runs application callbacks on a pool of threads, off of the network thread.
+
+Everything a peer receives is processed by a single thread. If that thread ran
+application code (hooks, data handlers, and so on) directly, then one slow
+callback would hold up every other message the peer has to process, including
+the ones that keep it in the ring. Instead, callbacks are queued up for a fixed
+set of worker threads.
+
+Every callback is submitted with a key, such as the peer it concerns, and
+callbacks with the same key always run in the order they were submitted. This
+is done by giving each worker its own queue and always sending a key to the
+same worker, so callbacks for _different_ keys can still run concurrently.
+"""
+
+import threading
+import collections
+
+from ..chordlib import L
+from ..chordlib import utils as chutils
+
+
+class WorkerPool(object):
+    """ A bounded pool of threads that runs callbacks in per-key order.
+
+    Each worker's queue holds a limited number of callbacks. When a queue is
+    full, the pool's overflow policy decides what happens to new ones:
+
+        - `DROP`: the callback is discarded (and counted in `dropped`). This
+          is the default, since it keeps both memory use and the submitting
+          thread bounded.
+        - `BLOCK`: the caller waits until there's room. This pushes back on
+          whoever is submitting, which is usually the network thread, so it
+          should only be used when callbacks are known to be quick.
+        - `SPILL`: the callback is queued anyway, past the limit. Nothing is
+          lost and nobody waits, but memory use is only bounded by how far
+          behind the workers fall.
+    """
+    DROP  = "drop"
+    BLOCK = "block"
+    SPILL = "spill"
+
+    WORKERS  = 4
+    CAPACITY = 0x400    # callbacks per worker before the policy applies
+
+    class Worker(chutils.InfiniteThread):
+        """ Runs the callbacks in its own queue, one after another.
+        """
+        POLL = 1    # seconds between checks on whether we've been stopped
+
+        def __init__(self, pool, **kwargs):
+            super(WorkerPool.Worker, self).__init__(**kwargs)
+            self.pool = pool
+            self.queue = collections.deque()
+            self.cond = threading.Condition(threading.Lock())
+            self.spilling = False
+
+        def _loop_method(self):
+            with self.cond:
+                if not self.queue:
+                    self.cond.wait(self.POLL)
+                    if not self.queue: return
+
+                fn, args = self.queue.popleft()
+                self.cond.notify_all()      # wakes blocked producers
+
+            try:
+                fn(*args)
+            except Exception:
+                L.exception("Callback %s failed.", repr(fn))
+
+    def __init__(self, workers=WORKERS, capacity=CAPACITY, overflow=DROP):
+        """ Starts the worker threads.
+
+        :workers[=WORKERS]      the number of threads to run callbacks on
+        :capacity[=CAPACITY]    how many callbacks each thread can have queued
+                                before the overflow policy applies
+        :overflow[=DROP]        one of `DROP`, `BLOCK`, or `SPILL`
+        """
+        if overflow not in (self.DROP, self.BLOCK, self.SPILL):
+            raise ValueError("unknown overflow policy: %s" % overflow)
+
+        self.capacity = capacity
+        self.overflow = overflow
+        self.dropped = 0
+        self._workers = [
+            WorkerPool.Worker(self, name="WorkerPool-%d" % i)
+            for i in xrange(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, key, fn, *args):
+        """ Queues up a callback to run on a worker thread.
+
+        :key        callbacks with equal keys run in the order they were
+                    submitted; the key must be hashable, and equal keys must
+                    have equal hashes
+        :fn         the callback, which is called with the remaining arguments
+        :returns    whether or not the callback was queued
+        """
+        worker = self._workers[hash(key) % len(self._workers)]
+        with worker.cond:
+            if len(worker.queue) >= self.capacity:
+                if self.overflow == self.DROP:
+                    self.dropped += 1
+                    L.warning("Worker queue is full, dropped %s.", repr(fn))
+                    return False
+
+                elif self.overflow == self.BLOCK:
+                    while len(worker.queue) >= self.capacity and \
+                          worker.running:
+                        worker.cond.wait(worker.POLL)
+
+                elif not worker.spilling:
+                    L.warning("Worker queue is full, spilling past %d "
+                              "callbacks.", self.capacity)
+                    worker.spilling = True
+
+            else:
+                worker.spilling = False
+
+            worker.queue.append((fn, args))
+            worker.cond.notify_all()
+        return True
+
+    def stop(self, timeout=None):
+        """ Stops the workers once they finish their current callbacks.
+
+        Callbacks that are still queued are discarded.
+        """
+        for worker in self._workers:
+            worker.stop_running()
+            with worker.cond:
+                worker.cond.notify_all()
+
+        for worker in self._workers:
+            if worker is not threading.current_thread():
+                worker.join(timeout)
+
+    @property
+    def pending(self):
+        """ The number of callbacks waiting to run.
+        """
+        return sum([ len(worker.queue) for worker in self._workers ])
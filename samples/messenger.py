@@ -49,7 +49,7 @@ def send_message(config, peer, sender, content, to=""):
         peer.broadcast(json.dumps(message))
     else:
         peer.send(message["to"], json.dumps(message),
-                  duplicates=config.duplicates)
+                  duplicates=config.duplicates, direct=True)
 
 def parse_message(raw):
     """ Parses a raw JSON string into a 3-tuple: (from, to, data).
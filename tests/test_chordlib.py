@@ -1,5 +1,7 @@
 import os
+import time
 import random
+import threading
 import string
 import unittest
 import sys
@@ -8,8 +10,15 @@ sys.path.append(".")
 from cicada.packetlib import debug
 from cicada.packetlib import chord
 from cicada.packetlib import message
+from cicada.packetlib import compact
+from cicada.packetlib import compression
+from cicada.packetlib import cicada as cicadapkt
 from cicada.chordlib  import routing
 from cicada.chordlib  import chordnode
+from cicada.chordlib  import clock
+from cicada.chordlib  import convergence
+from cicada.chordlib  import metrics
+from cicada.chordlib  import utils as chutils
 
 
 class TestHashing(unittest.TestCase):
@@ -40,6 +49,26 @@ class TestMessagePacking(unittest.TestCase):
         # debug.dump_packet(n.pack(), n.full_format())
         self.assertEqual(n.pack(), self._repack(n.pack()))
 
+    def test_messagecontainer_with_extensions(self):
+        h = routing.Hash(value="sender")
+        ext = {
+            message.ExtensionType.EXT_APP_DATA: "app data\x00",
+            message.ExtensionType.EXT_LOAD:     "\x00\x00\x00\x05",
+            message.ExtensionType.EXT_SUCCESSORS: "",
+        }
+        n = message.MessageContainer(message.MessageType.MSG_CH_NOTIFY, h,
+                                     data="hey babes\x77hey", sequence=2884,
+                                     extensions=ext)
+        self.assertEqual(n.pack(), self._repack(n.pack()))
+
+        unpacked = message.MessageContainer.unpack(n.pack())
+        self.assertEqual(unpacked.data, "hey babes\x77hey")
+        self.assertEqual(unpacked.extensions, ext)
+
+        # Extensions work on regular messages, too.
+        pkt = chord.InfoRequest.make_packet(h, extensions=ext)
+        self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
+
     def test_inforequest(self):
         sender = routing.Hash(value="sender")
         pkt = chord.InfoRequest.make_packet(sender)
@@ -76,6 +105,25 @@ class TestMessagePacking(unittest.TestCase):
                                              original=req)
         self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
 
+    def test_inforesponse_with_successor_list(self):
+        sender = routing.Hash(value="sender")
+        send_node = chordnode.ChordNode(sender, ("localhost", 0xB00B))
+        successors = [
+            chordnode.ChordNode(routing.Hash(value=str(i)), ("127.0.0.1", i))
+            for i in xrange(1, 5)
+        ]
+
+        req = chord.InfoRequest.make_packet(sender)
+        req.pack()     # need to pack for checksum injection
+        pkt = chord.InfoResponse.make_packet(sender, send_node, send_node,
+                                             send_node, successors,
+                                             original=req)
+        self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
+
+        info = chord.InfoResponse.unpack(pkt.data)
+        self.assertEqual([ n.chord_addr for n in info.successors ],
+                         [ n.chord_addr for n in successors ])
+
     def test_joinrequest(self):
         sender = routing.Hash(value="sender")
         pkt = chord.JoinRequest.make_packet(sender, ("127.0.0.1", 0xB00B))
@@ -91,6 +139,26 @@ class TestMessagePacking(unittest.TestCase):
                                              None, original=req)
         self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
 
+    def test_joinresponse_with_fingers(self):
+        sender = routing.Hash(value="sender")
+        send_node = chordnode.ChordNode(sender, ("localhost", 0xB00B))
+        fingers = [
+            chordnode.ChordNode(routing.Hash(value=str(i)), ("127.0.0.1", i))
+            for i in xrange(1, 10)
+        ]
+
+        req = chord.JoinRequest.make_packet(sender, ("127.0.0.1", 0xB00B))
+        req.pack()     # need to pack for checksum injection
+        pkt = chord.JoinResponse.make_packet(sender, send_node, send_node, None,
+                                             None, fingers[:4], fingers,
+                                             original=req)
+        self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
+
+        join = chord.JoinResponse.unpack(pkt.data)
+        self.assertEqual(len(join.successors), 4)
+        self.assertEqual([ int(n.hash) for n in join.fingers ],
+                         [ int(n.hash) for n in fingers ])
+
     def test_notifyrequest(self):
         self.test_inforequest()
 
@@ -125,6 +193,48 @@ class TestMessagePacking(unittest.TestCase):
             pkt = chord.LookupRequest.make_packet(sender, lookup, data)
             self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
 
+    def test_lookuprequest_with_origin(self):
+        sender = routing.Hash(value="sender")
+        lookup = routing.Hash(value="lookup")
+        origin = chordnode.ChordNode(routing.Hash(value="origin"),
+                                     ("127.0.0.1", 0xB00B))
+
+        pkt = chord.LookupRequest.make_packet(sender, lookup, "data", origin)
+        self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
+
+        req = chord.LookupRequest.unpack(pkt.data)
+        self.assertEqual(req.data, "data")
+        self.assertEqual(req.origin.hash, origin.hash)
+        self.assertEqual(req.origin.chord_addr, origin.chord_addr)
+
+        value, has_origin, data_at = chord.LookupRequest.peek(pkt.data)
+        self.assertEqual(value, lookup)
+        self.assertTrue(has_origin)
+        self.assertEqual(pkt.data[data_at:], "data")
+
+    def test_lookuprequest_compressed(self):
+        sender = routing.Hash(value="sender")
+        lookup = routing.Hash(value="lookup")
+        data = '{"message": "%s"}' % ("hello " * 100)
+
+        blob = compression.compress(data)
+        self.assertLess(len(blob), len(data))
+        self.assertIsNone(compression.compress(data, codecs=[]))
+
+        pkt = chord.LookupRequest.make_packet(sender, lookup, blob,
+                                              compressed=True)
+        self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
+
+        unpacked = message.MessageContainer.unpack(pkt.pack())
+        self.assertTrue(unpacked.compressed)
+
+        req = chord.LookupRequest.unpack(unpacked.data)
+        self.assertEqual(compression.decompress(req.data), data)
+
+        for corrupt in ("", blob[:1], blob[:-8], "\xff" + blob[1:]):
+            self.assertRaises(compression.CompressionException,
+                              compression.decompress, corrupt)
+
     def test_lookupresponse(self):
         sender = routing.Hash(value="sender")
         lookup = routing.Hash(value="lookup")
@@ -135,9 +245,263 @@ class TestMessagePacking(unittest.TestCase):
                                                original=req)
         self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
 
+    def test_quit(self):
+        sender = routing.Hash(value="sender")
+        send_node = chordnode.ChordNode(sender, ("localhost", 0xB00B))
+
+        req = chord.QuitRequest.make_packet(sender, send_node, send_node,
+                                            send_node, [ send_node ])
+        self.assertEqual(req.pack(), self._repack(req.pack()))
+
+        pkt = chord.QuitResponse.make_packet(sender, original=req)
+        self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
+
+    def test_ping(self):
+        sender = routing.Hash(value="sender")
+        req = chord.PingMessage.make_packet(sender, 0xC1CADA)
+        self.assertEqual(req.pack(), self._repack(req.pack()))
+
+        pkt = chord.PongMessage.make_packet(sender, 0xC1CADA, original=req)
+        self.assertEqual(pkt.pack(), self._repack(pkt.pack()))
+
+        unpacked = message.MessageContainer.unpack(pkt.pack())
+        self.assertEqual(chord.generic_unpacker(unpacked).value, 0xC1CADA)
+
+    def test_unpack_from(self):
+        sender = routing.Hash(value="sender")
+        send_node = chordnode.ChordNode(sender, ("localhost", 0xB00B))
+        fingers = [
+            chordnode.ChordNode(routing.Hash(value=str(i)), ("127.0.0.1", i))
+            for i in xrange(1, 10)
+        ]
+
+        # Messages can be decoded from the middle of a buffer without copying.
+        data = chord.JoinResponse(send_node, send_node, send_node, None,
+                                  fingers[:4], fingers).pack()
+        buf = memoryview("junk" + data + "more junk")
+        join, offset = chord.JoinResponse.unpack_from(buf, 4)
+        self.assertEqual(offset, 4 + len(data))
+        self.assertEqual(join.req_succ_addr, send_node.chord_addr)
+        self.assertEqual([ int(n.hash) for n in join.fingers ],
+                         [ int(n.hash) for n in fingers ])
+
+        bcast = cicadapkt.BroadcastMessage.make_packet(
+            "some data", [ n.hash for n in fingers ])
+        data = bcast.pack()
+        unpacked, offset = cicadapkt.BroadcastMessage.unpack_from(
+            memoryview(data))
+        self.assertEqual(offset, len(data))
+        self.assertEqual(unpacked.data, "some data")
+        self.assertEqual(set([ int(h) for h in unpacked.visited ]),
+                         set([ int(n.hash) for n in fingers ]))
+
     def _repack(self, bs):
         return message.MessageContainer.unpack(bs).pack()
 
 
+class TestCompactFormat(unittest.TestCase):
+    """ Tests that messages survive being transcoded to the compact format.
+    """
+    def test_compact(self):
+        sender = routing.Hash(value="sender")
+        node = chordnode.ChordNode(sender, ("127.0.0.1", 0xB00B))
+        others = [
+            chordnode.ChordNode(routing.Hash(value=str(i)), ("127.0.0.1", i))
+            for i in xrange(1, 6)
+        ]
+
+        req = chord.InfoRequest.make_packet(sender); req.pack()
+        hints = {
+            message.ExtensionType.EXT_KNOWN_NODES:
+                message.PackedNodeList(others).pack(),
+            message.ExtensionType.EXT_LOAD: "\x00\x00\x00\x05",
+        }
+        pkts = [
+            chord.JoinRequest.make_packet(sender, ("127.0.0.1", 0xB00B)),
+            chord.JoinResponse.make_packet(sender, node, node, None, node,
+                                           others[:4], others, original=req),
+            chord.InfoRequest.make_packet(sender, extensions=hints),
+            chord.InfoResponse.make_packet(sender, node, node, others[0],
+                                           others[:4], original=req),
+            chord.NotifyRequest.make_packet(sender, node, others[1], None,
+                                            others[:4]),
+            chord.NotifyResponse.make_packet(sender, True, original=req),
+            chord.LookupRequest.make_packet(sender, routing.Hash(value="x"),
+                                            os.urandom(1000), node,
+                                            compressed=True),
+            chord.LookupResponse.make_packet(sender, routing.Hash(value="x"),
+                                             sender, ("127.0.0.1", 5), 3,
+                                             original=req),
+            chord.PingMessage.make_packet(sender, 0xC1CADA),
+        ]
+
+        # The second time around, every node is known by its handle.
+        outgoing, incoming = compact.Session(), compact.Session()
+        for _ in xrange(2):
+            for pkt in pkts:
+                full = pkt.pack()
+                packed = compact.pack(pkt, outgoing)
+                self.assertEqual(compact.frame_length(packed), len(packed))
+                self.assertLess(len(packed), len(full))
+
+                unpacked = compact.unpack(packed, incoming)
+                self.assertEqual(unpacked.data, pkt.data)
+                self.assertEqual(unpacked.extensions, pkt.extensions)
+                self.assertEqual(unpacked.compressed, pkt.compressed)
+                self.assertEqual(unpacked.sender, pkt.sender)
+                self.assertEqual(unpacked.seq, pkt.seq)
+                self.assertEqual(unpacked.is_response, pkt.is_response)
+
+    def test_varints(self):
+        for value in (0, 1, 0x7F, 0x80, 0x3FFF, 0x4000, 2 ** 32 - 1):
+            packed = compact.pack_varint(value)
+            self.assertEqual(compact.unpack_varint(packed),
+                             (value, len(packed)))
+
+        self.assertRaises(message.UnpackException, compact.unpack_varint,
+                          compact.pack_varint(0x4000)[:-1])
+
+    def test_malformed(self):
+        sender = routing.Hash(value="sender")
+        node = chordnode.ChordNode(sender, ("127.0.0.1", 0xB00B))
+        req = chord.InfoRequest.make_packet(sender); req.pack()
+        pkt = chord.InfoResponse.make_packet(sender, node, node, None, [],
+                                             original=req)
+
+        # A handle to a node that was never sent on this connection.
+        outgoing = compact.Session()
+        compact.pack(pkt, outgoing)
+        packed = compact.pack(pkt, outgoing)
+        self.assertRaises(message.UnpackException, compact.unpack, packed,
+                          compact.Session())
+
+        # A message cut short, but otherwise consistent.
+        packed = compact.pack(chord.PingMessage.make_packet(sender, 1),
+                              compact.Session())
+        self.assertRaises(message.UnpackException, compact.unpack,
+                          packed[:compact.PREFIX_LEN - 1], compact.Session())
+        self.assertIsNone(compact.frame_length(packed[:compact.PREFIX_LEN]))
+
+
+class TestVirtualClock(unittest.TestCase):
+    """ Tests that virtual time only passes once everyone is asleep.
+    """
+    def test_sleeping(self):
+        timer = clock.VirtualClock(seed=1)
+        woken = []
+
+        class Sleeper(chutils.InfiniteThread):
+            def __init__(self, name, pause):
+                super(Sleeper, self).__init__(name=name, pause=pause)
+
+            def _loop_method(self):
+                woken.append((self.name, timer.time()))
+                if len(woken) >= 6: self.stop_running()
+
+        wallclock = clock.install(timer)
+        try:
+            start = time.time()
+            threads = [ Sleeper("slow", 100), Sleeper("fast", 40) ]
+
+            # Hold time still until both threads are running.
+            timer.enter()
+            for thread in threads: thread.start()
+            timer.leave()
+
+            for thread in threads: thread.join(5)
+        finally:
+            clock.install(wallclock)
+
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([ t for n, t in woken if n == "fast" ][:3],
+                         [ 0, 40, 80 ])
+        self.assertEqual([ t for n, t in woken if n == "slow" ][:2],
+                         [ 0, 100 ])
+
+    def test_waiting(self):
+        timer = clock.VirtualClock()
+        event = threading.Event()
+        self.assertFalse(timer.wait(event, 30))
+        self.assertGreaterEqual(timer.time(), 30)
+
+        event.set()
+        self.assertTrue(timer.wait(event))
+        self.assertEqual(clock.VirtualClock(seed=7).random.random(),
+                         clock.VirtualClock(seed=7).random.random())
+
+
+
+class TestConvergence(unittest.TestCase):
+    """ Tests that broken rings are caught.
+    """
+    def test_check_ring(self):
+        nodes = sorted([
+            chordnode.ChordNode(routing.Hash(value=str(i)), ("localhost", i))
+            for i in xrange(10)
+        ], key=lambda n: int(n.hash))
+
+        self.assertFalse(convergence.check_ring(nodes))
+        for i, node in enumerate(nodes):
+            node.successor = nodes[(i + 1) % len(nodes)]
+            node.predecessor = nodes[i - 1]
+
+        self.assertTrue(convergence.check_ring(nodes))
+        state = convergence.wait_until_converged(nodes, 0)
+        self.assertTrue(state.converged)
+
+        # Only the node that skips over its successor is wrong.
+        nodes[2].successor = nodes[4]
+        state = convergence.check_ring(nodes)
+        self.assertEqual(state.bad_successors, [ nodes[2] ])
+        self.assertEqual(state.bad_predecessors, [])
+        self.assertFalse(convergence.wait_until_converged(nodes, 0))
+        self.assertIn("fingers=n/a", str(state))
+
+
+class TestMetrics(unittest.TestCase):
+    """ Tests that metrics add up and export properly.
+    """
+    def test_registry(self):
+        registry = metrics.Registry(labels={ "node": "a" })
+        sent = registry.counter("sent_total", "Sent.", ("type", ))
+        sent.labels("PING").inc()
+        sent.labels("PING").inc(2)
+        sent.labels("LOOKUP").inc()
+        self.assertIs(registry.counter("sent_total", "Sent."), sent)
+        self.assertRaises(ValueError, registry.gauge, "sent_total", "")
+        self.assertRaises(ValueError, sent.labels, "PING", "extra")
+
+        depth = []
+        registry.gauge("depth", "Depth.", fn=lambda: len(depth))
+        depth.extend([ 1, 2 ])
+
+        hops = registry.histogram("hops", "Hops.", metrics.HOP_BUCKETS)
+        for value in (1, 1, 2, 3, 40):
+            hops.observe(value)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot["sent_total"], { "PING": 3, "LOOKUP": 1 })
+        self.assertEqual(snapshot["depth"], 2)
+        self.assertEqual(snapshot["hops"]["count"], 5)
+        self.assertEqual(snapshot["hops"]["sum"], 47)
+        self.assertEqual(hops.percentile(40), 1)
+        self.assertEqual(hops.percentile(100), 40)
+
+        text = registry.prometheus()
+        self.assertIn("# TYPE cicada_sent_total counter\n", text)
+        self.assertIn('cicada_sent_total{node="a",type="PING"} 3\n', text)
+        self.assertIn('cicada_depth{node="a"} 2\n', text)
+        self.assertIn('cicada_hops_bucket{node="a",le="2"} 3\n', text)
+        self.assertIn('cicada_hops_bucket{node="a",le="+Inf"} 5\n', text)
+        self.assertIn('cicada_hops_count{node="a"} 5\n', text)
+
+        # Nodes' metrics are grouped together when exported at once.
+        other = metrics.Registry(labels={ "node": "b" })
+        other.counter("sent_total", "Sent.", ("type", )).labels("PING").inc()
+        text = metrics.prometheus([ registry, other ])
+        self.assertEqual(text.count("# TYPE cicada_sent_total"), 1)
+        self.assertIn('cicada_sent_total{node="b",type="PING"} 1\n', text)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -9,6 +9,7 @@ import unittest
 from   cicada.chordlib.peersocket import *
 from   cicada.chordlib.routing    import *
 from   cicada.packetlib.message   import *
+from   cicada.packetlib           import compact
 
 
 class TestPacketFunctions(unittest.TestCase):
@@ -76,6 +77,85 @@ class TestPacketFunctions(unittest.TestCase):
         self.assertEqual(data, pkt.pack())
         self.assertFalse(queue.ready)
 
+    def test_readqueue_compact(self):
+        sender = Hash(value="sender")
+        session = compact.Session()
+        queue = ReadQueue(compact.Session())
+
+        # A regular message tells the queue that the other end speaks compact.
+        first = MessageContainer(MessageType.MSG_CH_INFO, sender, data="first")
+        queue.read(first.pack())
+        self.assertTrue(queue.session.enabled)
+        self.assertEqual(queue.pop().data, "first")
+
+        # Compact messages can arrive in arbitrary pieces, too.
+        msgs = [
+            MessageContainer(MessageType.MSG_CH_INFO, sender,
+                             data=os.urandom(random.randint(40, 400)))
+            for _ in xrange(10)
+        ]
+        stream = ''.join([ compact.pack(msg, session) for msg in msgs ])
+        while stream:
+            size = random.randint(1, 50)
+            queue.read(stream[:size])
+            stream = stream[size:]
+
+        for msg in msgs:
+            self.assertTrue(queue.ready)
+            pkt = queue.pop()
+            self.assertEqual(pkt.data, msg.data)
+            self.assertEqual(pkt.sender, sender)
+        self.assertFalse(queue.ready)
+
+    def test_readqueue_lazy(self):
+        sender = Hash(value="sender")
+        msg = MessageContainer(MessageType.MSG_CH_LOOKUP, sender,
+                               data="some data.", sequence=42)
+
+        # Corrupting the payload only matters once somebody reads it.
+        data = msg.pack()
+        data = data[:-1] + chr(ord(data[-1]) ^ 0xFF)
+
+        queue = ReadQueue()
+        queue.read(data)
+        pkt = queue.pop()
+
+        self.assertEqual(pkt.seq, 42)
+        self.assertEqual(pkt.sender, sender)
+        self.assertEqual(pkt.extensions, {})
+        self.assertEqual(pkt.payload.tobytes(), data[-len("some data."):])
+        self.assertRaises(UnpackException, lambda: pkt.data)
+        self.assertRaises(UnpackException, MessageContainer.unpack, data)
+
+        pkt = MessageContainer.unpack(msg.pack(), lazy=True)
+        self.assertEqual(pkt.length, msg.length)
+        self.assertEqual(pkt.data, "some data.")
+        self.assertEqual(pkt.pack(), msg.pack())
+
+    def test_old_version(self):
+        msg = MessageContainer(MessageType.MSG_CH_INFO, Hash(value="sender"))
+        data = msg.pack()
+        old = data[:2] + "\x00\x05" + data[4:]  # v0.5 payloads are different
+        self.assertRaises(UnpackException, MessageContainer.unpack, old)
+
+    def test_bad_extensions(self):
+        msg = MessageContainer(MessageType.MSG_CH_LOOKUP, Hash(value="sender"),
+                               data="some data.", extensions={ 1: "abc" })
+        data = msg.pack()
+        self.assertEqual(MessageContainer.unpack(data).extensions, { 1: "abc" })
+
+        # Forwarding only needs the payload and extensions, not verification.
+        pkt = MessageContainer.unpack(data, lazy=True)
+        self.assertEqual(pkt.extensions, { 1: "abc" })
+        self.assertEqual(pkt.payload.tobytes(), "some data.")
+        self.assertIsNotNone(pkt._packet)
+
+        # Claim that the entry's value runs past the end of the section.
+        length_at = len(data) - 2 - len("abc") - 2
+        for length in ("\x00\x04", "\xff\xff"):
+            bad = data[:length_at] + length + data[length_at + 2:]
+            self.assertRaises(UnpackException, MessageContainer.unpack, bad)
+
     def test_readqueue_many(self):
         sender = Hash(value="sender")
 
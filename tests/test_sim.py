@@ -0,0 +1,251 @@
+import unittest
+import sys
+sys.path.append(".")
+
+from cicada.chordlib import clock, heartbeat, remotenode, routing
+from cicada.packetlib import message
+from cicada.sim      import EventLoop, Simulator
+
+
+class TestSimulator(unittest.TestCase):
+    """ Runs small rings through the simulator, end to end.
+    """
+    def test_converging(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(25, over=10)
+            sim.run(10)
+
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+            self.assertEqual(len(sim.nodes), 25)
+
+            sim.lookups(100, over=5)
+            sim.run(15)
+
+        report = sim.report()
+        self.assertEqual(report["lookups"], 100)
+        self.assertEqual(report["correct"], 100)
+        self.assertGreater(report["messages"], 0)
+        self.assertLessEqual(report["hops_p50"], report["hops_p99"])
+        self.assertNotIsInstance(clock.get(), EventLoop)
+
+    def test_bootstrap(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.bootstrap(128)
+            self.assertTrue(sim.converged())
+            self.assertEqual(sim.converged(fingers=True).finger_accuracy, 1.0)
+
+            sim.add_node()
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+            sim.lookups(100, over=5)
+            sim.run(15)
+
+        # Lookups should take O(log n) hops, rather than walking the ring.
+        report = sim.report()
+        self.assertEqual(report["correct"], 100)
+        self.assertLessEqual(report["hops_p99"], 8)
+
+    def test_churn(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(20, over=10)
+            sim.run(10)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+            sim.churn(joins=5, leaves=5, duration=30)
+            sim.run(30)
+            self.assertEqual(len(sim.nodes), 20)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+    def test_leaving(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(10, over=5)
+            sim.run(10)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+            ring = [ node for _, node in sim._ring() ]
+            before, leaving, after = ring[2:5]
+            sim.remove_node(leaving.chord_addr, graceful=True)
+
+            # The neighbors are told right away, so they're patched up by the
+            # time they next stabilize (which connects to handed-off nodes),
+            # well before they'd have found out by missing PINGs.
+            sim.run(10)
+            self.assertEqual(before.successor.hash, after.hash)
+            self.assertEqual(after.predecessor.hash, before.hash)
+            self.assertNotIn(leaving.hash, [
+                n.hash for n in before.successor_list
+            ])
+            for node in (before, after):
+                removed = node.metrics.snapshot()["peers_removed_total"]
+                self.assertEqual(removed.get("quit"), 1)
+
+    def test_failover(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(10, over=5)
+            sim.run(10)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+            ring = [ node for _, node in sim._ring() ]
+            before, crashed, after = ring[2:5]
+            self.assertEqual(before.successor_list[1].hash, after.hash)
+            sim.remove_node(crashed.chord_addr)
+
+            # The closed connection gives the crash away right away, and the
+            # backup takes over by the time we next stabilize, well before the
+            # heartbeat would have given up on the crashed node.
+            sim.run(1)
+            self.assertIn(before.successor and before.successor.hash,
+                          (None, after.hash))
+            sim.run(10)
+            self.assertEqual(before.successor.hash, after.hash)
+            self.assertNotIn(crashed.hash, [
+                n.hash for n in before.successor_list
+            ])
+            removed = before.metrics.snapshot()["peers_removed_total"]
+            self.assertEqual(removed.get("shutdown"), 1)
+
+    def test_seeded_routes(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(10, over=5)
+            sim.run(10)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+            address = sim.add_node()
+            joiner, seeds = sim.nodes[address], []
+            seed_routes = joiner._seed_routes
+            def on_seeds(nodes):
+                seeds.extend(nodes)
+                return seed_routes(nodes)
+            joiner._seed_routes = on_seeds
+
+            # The JOIN response arrives well before we'd first fix a route.
+            sim.run(1)
+            self.assertIsNotNone(joiner.successor)
+            self.assertGreater(len(seeds), joiner.SUCCESSOR_COUNT)
+            self.assertEqual(len(joiner.successor_list),
+                             joiner.SUCCESSOR_COUNT)
+
+            def routes():
+                return set([ int(route.peer.hash)
+                             for route in joiner.routing_table.iter(0)
+                             if route.peer ])
+
+            # Only our successor is routed to until the seeds are connected to,
+            # and then every route is filled in from nothing but the response.
+            self.assertEqual(routes(), set([ int(joiner.successor.hash) ]))
+            sim._act(address, joiner._adopt_hints)
+            self.assertTrue(all([
+                route.peer for route in joiner.routing_table.iter(0)
+            ]))
+            self.assertGreater(len(routes()), 1)
+            self.assertLessEqual(routes(), set([
+                int(node.hash) for node in seeds + [ joiner.successor ]
+            ]))
+
+    def test_silent_peer(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(10, over=5)
+            sim.run(10)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+            # The node stops responding, but its connections stay open, so
+            # only the heartbeat can tell that it's gone (to the nodes that
+            # route through it, and so keep pinging it).
+            ring = [ node for _, node in sim._ring() ]
+            def watchers_of(silent):
+                return [
+                    node for node in ring if node is not silent and
+                    node.successor.hash != silent.hash and
+                    silent.hash in [ p.hash for p in
+                                     node.routing_table.unique_iter(0) ]
+                ]
+
+            silent = max(ring, key=lambda node: len(watchers_of(node)))
+            watchers = watchers_of(silent)
+            self.assertGreater(len(watchers), 1)
+            del sim.nodes[silent.chord_addr]
+
+            def evicted():
+                return [ node for node in watchers
+                         if not node._peerlist_contains(silent.hash) ]
+
+            interval = heartbeat.HeartbeatManager.PingThread.INTERVAL
+            sim.run(remotenode.RemoteNode.PEER_TIMEOUT - interval)
+            self.assertEqual(evicted(), [])
+
+            # It's purged within a round of the purge thread after timing out.
+            sim.run(interval + 30)
+            self.assertEqual(evicted(), watchers)
+            for node in watchers:
+                removed = node.metrics.snapshot()["peers_removed_total"]
+                self.assertGreaterEqual(removed.get("purged"), 1)
+
+    def test_piggybacking(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(10, over=5)
+            sim.run(10)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+            ring = [ node for _, node in sim._ring() ]
+            sender, receiver = ring[2:4]
+            received, hinted = [], []
+            receiver.on_data_packet = lambda node, data: \
+                received.append((node.hash, data))
+
+            learn_routes = receiver._learn_routes
+            def on_hints(nodes):
+                hinted.extend(nodes)
+                return learn_routes(nodes)
+            receiver._learn_routes = on_hints
+
+            sender.piggyback(sender.successor, "hello")
+            self.assertRaises(ValueError, sender.piggyback, sender.successor,
+                              "x" * (message.ExtensionType.MAX_APP_DATA + 1))
+
+            # Stabilizing sends something to our successor often enough.
+            sim.run(15)
+            self.assertEqual(received, [ (sender.hash, "hello") ])
+            self.assertTrue(hinted)
+            for node in hinted:
+                self.assertIn(node.chord_addr, sim.nodes)
+
+            # Whatever the sender last said about its successors stuck, too.
+            remote = receiver._peerlist_contains(sender.hash)
+            self.assertEqual([ n.hash for n in remote.successor_list ],
+                             [ n.hash for n in sender.successor_list ])
+
+    def test_forwarding_metrics(self):
+        with Simulator(seed=0xC1CA) as sim:
+            sim.grow(10, over=5)
+            sim.run(10)
+            self.assertIsNotNone(sim.run_until_converged(600, 5))
+
+            def forwarded(node):
+                return node.metrics.snapshot()["lookups_forwarded_total"]
+
+            ring = [ node for _, node in sim._ring() ]
+            sender, owner, far = ring[2], ring[3], ring[8]
+            counts = [ forwarded(node) for node in ring ]
+            results = []
+            def on_result(result, response):
+                results.append((result.hash, response and response.hops))
+
+            # Our successor answers for its own hash without forwarding.
+            sim._act(sender.chord_addr, sender.lookup,
+                     routing.Hash(hashed=owner.hash), on_result, 0)
+            sim.run(1)
+            self.assertEqual(results, [ (owner.hash, 1) ])
+            self.assertEqual(forwarded(owner), counts[3])
+
+            # A value further away is forwarded by every hop in between (each
+            # of which adds to the count of hops, as does the owner).
+            sim._act(sender.chord_addr, sender.lookup,
+                     routing.Hash(hashed=far.hash), on_result, 0)
+            sim.run(1)
+            self.assertEqual(results[-1][0], far.hash)
+            self.assertGreaterEqual(
+                sum([ forwarded(node) for node in ring ]) - sum(counts),
+                results[-1][1] - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
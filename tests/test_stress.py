@@ -5,7 +5,10 @@ import unittest
 import sys
 sys.path.append(".")
 
+from cicada.chordlib import clock
+from cicada.chordlib import convergence
 from cicada.chordlib import localnode
+from cicada.chordlib import transport
 
 
 PEER_COUNT = 25
@@ -19,6 +22,16 @@ class TestStressStabilization(unittest.TestCase):
       - Ensure that after some time, each one's successor pointer is as close as
         it can be, and likewise for the predecessor pointer.
     """
+    def setUp(self):
+        # Stabilization takes minutes of idling, which takes no time at all
+        # on a virtual clock.
+        self.seed = random.randint(0, 2 ** 32)
+        self.wallclock = clock.install(clock.VirtualClock(self.seed))
+        random.seed(self.seed)
+
+    def tearDown(self):
+        clock.install(self.wallclock)
+
     def test_stress(self):
         peers = self._join_all()
         self._stabilize(peers)
@@ -31,11 +44,14 @@ class TestStressStabilization(unittest.TestCase):
             peer.listener.close()
 
     def _join_all(self):
+        # The peers talk in-memory, so we don't need to find free ports.
+        network = transport.LoopbackTransport()
         start_port = random.randint(10000, (2 ** 16) - PEER_COUNT - 1)
         peers = []
         for i in xrange(PEER_COUNT):
             address = ("localhost", start_port + i)
-            peer = localnode.LocalNode("%s:%d" % address, address)
+            peer = localnode.LocalNode("%s:%d" % address, address,
+                                       transport=network)
 
             # def pred(n, o, p):
             #     print "  Peer", n, "predecessor: %s -> %s" % (
@@ -74,58 +90,13 @@ class TestStressStabilization(unittest.TestCase):
         return peers
 
     def _stabilize(self, peers):
-        time.sleep(PEER_COUNT * 10)
-
-        peermap = {int(n.hash): n for n in peers}
-        all_loops = []
-
-        while set(sum(map(list, all_loops), [])) != set(peermap.keys()):
-            viable, seen = [
-                node for node in peers \
-                if int(node.hash) not in sum(map(list, all_loops), [])
-            ], []
-
-            loops = set()
-            stack = [random.choice(viable)]
-            while stack:
-                def find(n):
-                    self.assertTrue(int(n.hash) in peermap)
-                    return peermap[int(n.hash)]
-
-                node = stack.pop(0)
-                loops.add(int(node.hash))
-                if node.successor:
-                    loops.add(int(node.successor.hash))
-                    if node.successor.hash not in seen:
-                        stack.append(find(node.successor))
-                        seen.append(node.successor.hash)
-
-                if node.predecessor:
-                    loops.add(int(node.predecessor.hash))
-                    if node.predecessor.hash not in seen:
-                        stack.append(find(node.predecessor))
-                        seen.append(node.predecessor.hash)
-
-            all_loops.append(loops)
-
-        if len(all_loops) > 1:
-            print "  FAILED! Found multiple network loops:"
-            for n, loop in enumerate(all_loops):
-                print "    - Loop %d" % n
-                for peer in loop:
-                    print "      %s" % peermap[peer]
-                print "    ========="
-
-        self.assertEqual(len(all_loops), 1)
-
-        for peer in peers:
-            calc_successor = peer._find_closest_peer_moddist(int(peer.hash), set([peer]))
-            if not peer.successor or calc_successor.hash != peer.successor.hash:
-                print "  FAILED! Expected %d, got %d: %s" % (calc_successor.hash,
-                      peer.successor.hash if peer.successor else 0, peer)
+        state = convergence.wait_until_converged(peers, PEER_COUNT * 10, 5)
+        if not state:
+            print "  FAILED! The ring didn't converge: %s" % state
+            for peer in state.bad_successors:
+                print "    - %s -> %s" % (peer, peer.successor)
 
-            self.assertTrue(peer.successor)
-            self.assertEqual(calc_successor.hash, peer.successor.hash)
+        self.assertTrue(state.converged, "%s (seed=%d)" % (state, self.seed))
 
 
 if __name__ == '__main__':
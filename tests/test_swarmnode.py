@@ -1,15 +1,53 @@
 #! /usr/bin/env python2
+import os
 import sys
 import time
+import socket
+import threading
 import unittest
 sys.path.append(".")
 
-from cicada import swarmlib
+from cicada import chordlib, swarmlib
+from cicada.chordlib import clock, convergence, transport
+from cicada.packetlib import chord as chordpkt, message
 
 
 class TestSwarmPeer(unittest.TestCase):
+    def setUp(self):
+        self.network = transport.LoopbackTransport()
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            if peer.peer is not None: peer.close()
+
+    def _bound(self, count, cls=swarmlib.SwarmPeer):
+        """ Binds `count` peers on the in-memory network, without joining. """
+        peers = [ cls(transport=self.network) for _ in xrange(count) ]
+        for peer in peers:
+            peer.bind("10.0.0.%d" % (len(self.peers) + 1), 0xC1CA)
+            self.peers.append(peer)
+        return peers
+
+    def _ring(self, count):
+        """ Binds `count` peers and waits for them to form a ring. """
+        peers = self._bound(count)
+        for peer in peers[1:]:
+            peer.connect(*peers[0].listener)
+
+        # Routed data only reaches its owner once the ring has formed.
+        nodes = [ peer.peer for peer in peers ]
+        deadline = time.time() + 10
+        while not convergence.check_ring(nodes) and time.time() < deadline:
+            for node in nodes: node.stabilize()
+            time.sleep(0.1)
+
+        self.assertTrue(convergence.check_ring(nodes))
+        return peers
+
     def test_swarmpeer(self):
         a, b = swarmlib.SwarmPeer(), swarmlib.SwarmPeer()
+        self.peers.extend([ a, b ])
         a.bind("localhost", 0xC1CADA & 0xFF00)
         b.bind("localhost", 0xC1CADA & 0xFFFE)
 
@@ -19,5 +57,327 @@ class TestSwarmPeer(unittest.TestCase):
         b.send(a, d[::-1])
         a.recv()
 
+    def test_direct_send(self):
+        peers = self._ring(4)
+
+        src, dst = peers[0], peers[-1]
+        for i in xrange(3):
+            src.send(dst, "DIRECT %d" % i, direct=True)
+            source, d, _ = dst.recv(timeout=5)
+            self.assertEqual(d, "DIRECT %d" % i)
+            self.assertEqual(source.hash, src.hash)
+
+        self.assertIn(int(dst.hash), src._direct_routes)
+
+        # If the connection dies before the owner acknowledges, the data may
+        # or may not have arrived, so the route is dropped but nothing is
+        # sent again.
+        dst.peer.processor.stop_running()
+        dst.peer.processor.join(5)
+        src.send(dst, "LOST", direct=True)
+        sent = src.stats()["messages_sent_total"]["LOOKUP"]
+
+        for sock in dst.peer.processor.sockets: sock.close()
+        for _ in xrange(50):
+            if int(dst.hash) not in src._direct_routes: break
+            time.sleep(0.1)
+
+        self.assertNotIn(int(dst.hash), src._direct_routes)
+        self.assertEqual(src.stats()["messages_sent_total"]["LOOKUP"], sent)
+
+    def test_stream(self):
+        peers = self._ring(3)
+
+        # More than a whole window, so the writer has to wait on the reader.
+        payload = os.urandom(swarmlib.SwarmStream.CHUNK_SIZE * 20 + 123)
+
+        def write():
+            out = peers[0].open_stream(peers[-1])
+            out.write(payload)
+            out.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        stream = peers[-1].accept_stream()
+        self.assertEqual(stream.remote, peers[0].hash)
+        self.assertEqual("".join(stream), payload)
+        self.assertTrue(stream.eof)
+        writer.join()
+
+    def test_stream_to_key(self):
+        peers = self._ring(3)
+        src = peers[0]
+
+        # Acks come from the key's owner, not from the key, which the stream
+        # has to tell apart from streams that other peers open to us.
+        key = chordlib.routing.Hash(value="some key")
+        ring = sorted(peers, key=lambda p: int(p.hash))
+        owner = ([ p for p in ring if int(p.hash) >= int(key) ] + ring)[0]
+        if owner is src: src = peers[1]
+
+        payload = os.urandom(swarmlib.SwarmStream.CHUNK_SIZE * 20)
+        out = src.open_stream(key)
+        writer = threading.Thread(target=lambda: (out.write(payload),
+                                                  out.close()))
+        writer.start()
+
+        # Without acks, the writer would stall after a window's worth.
+        stream, received = owner.accept_stream(), []
+        while not stream.eof:
+            received.append(stream.read(timeout=5))
+            self.assertTrue(received[-1] or stream.eof)
+
+        writer.join()
+        self.assertEqual("".join(received), payload)
+        self.assertEqual(out.remote, owner.hash)
+
+        # Finished streams are forgotten on both ends.
+        for _ in xrange(50):
+            if not src._streams and not owner._streams: break
+            time.sleep(0.1)
+        self.assertEqual(src._streams, {})
+        self.assertEqual(owner._streams, {})
+
+    def test_custom_handler(self):
+        a, b = self._bound(2)
+        b.connect(*a.listener)
+
+        # Upper layers can send their own message types straight to a peer.
+        MSG_CUSTOM = message.MessageType.MSG_CH_MAX + 0x10
+        received, arrived = [], threading.Event()
+        def on_custom(sock, msg):
+            received.append(msg.data)
+            arrived.set()
+        a.peer.register_handler(MSG_CUSTOM, on_custom)
+
+        sock = list(b.peer.peers)[0].peer_sock
+        msg = message.MessageContainer(MSG_CUSTOM, b.hash, data="custom")
+        b.peer.processor.request(sock, msg, None, wait_time=0)
+
+        self.assertTrue(arrived.wait(5))
+        self.assertEqual(received, [ "custom" ])
+
+    def test_corrupt_data(self):
+        a, b = self._bound(2)
+        b.connect(*a.listener)
+
+        # Data that doesn't decompress is dropped, rather than taking down the
+        # thread that processes the rest of the peer's messages.
+        sock = list(b.peer.peers)[0].peer_sock
+        msg = chordpkt.LookupRequest.make_packet(b.hash, a.hash, "\x01bogus",
+                                                 b.peer, compressed=True)
+        b.peer.processor.request(sock, msg, None, wait_time=0)
+
+        b.send(a, "STILL HERE")
+        self.assertEqual(a.recv(timeout=5)[1], "STILL HERE")
+        self.assertTrue(a.peer.processor.is_alive())
+
+    def test_recv_many(self):
+        a, b = self._bound(2)
+        b.connect(*a.listener)
+
+        for i in xrange(50):
+            a.send(b, "BATCH %d" % i)
+            if i == 25:     # a malformed one doesn't spoil its batch
+                b._read_queue.push((a.peer, "\xff\xffbogus"))
+
+        received = []
+        while len(received) < 50:
+            batch = b.recv_many(max_n=20, timeout=5)
+            self.assertTrue(batch)
+            self.assertLessEqual(len(batch), 20)
+            received.extend([ data for _, data in batch ])
+
+        self.assertEqual(received, [ "BATCH %d" % i for i in xrange(50) ])
+        self.assertIsNone(b.recv(timeout=0.1))
+        self.assertEqual(b.recv_many(timeout=0.1), [])
+
+    def test_async(self):
+        a, b = self._bound(2, swarmlib.AsyncSwarmPeer)
+        self.assertTrue(b.connect(*a.listener).result(5))
+
+        first = a.recv()
+        self.assertFalse(first.done())
+
+        sends = [ b.send(a, "ASYNC %d" % i) for i in xrange(100) ]
+        for owner in swarmlib.gather(sends, timeout=5):
+            self.assertEqual(owner.hash, a.hash)
+
+        source, data = first.result(5)
+        self.assertEqual(source.hash, b.hash)
+        received = [ data ]
+        while len(received) < 100:
+            received.extend([ d for _, d in a.recv_many().result(5) ])
+
+        self.assertEqual(sorted(received),
+                         sorted([ "ASYNC %d" % i for i in xrange(100) ]))
+        self.assertEqual(a.lookup(b).result(5).hash, b.hash)
+        self.assertRaises(swarmlib.FutureTimeout, a.recv().result, 0.1)
+
+    def test_async_timeout(self):
+        silent, lonely = self._bound(2, swarmlib.AsyncSwarmPeer)
+        silent.peer.processor.stop_running()
+        silent.peer.processor.join(5)
+
+        # A peer that never answers can't leave requests pending forever.
+        joined = lonely.connect(*silent.listener, timeout=0.5)
+        self.assertRaises(swarmlib.FutureTimeout, joined.result, 5)
+
+        stats = lonely.stats()
+        self.assertEqual(stats["requests_pending"], 0)
+        self.assertEqual(stats["request_timeouts_total"], 1)
+
+    def test_loopback(self):
+        peers = self._ring(8)
+
+        for src in peers:
+            dst = peers[-1] if src is peers[0] else peers[0]
+            src.send(dst, "LOOPBACK")
+            source, data, _ = dst.recv(timeout=5)
+            self.assertEqual(data, "LOOPBACK")
+            self.assertEqual(source.hash, src.hash)
+
+        # Only addresses bound on this transport are reachable through it.
+        self.assertRaises(socket.error, self.network.socket().connect,
+                          ("localhost", 0xC1CA))
+
+    def test_stats(self):
+        peers = self._ring(3)
+
+        peers[1].send(peers[2], "COUNT ME")
+        self.assertEqual(peers[2].recv(timeout=5)[1], "COUNT ME")
+
+        stats = peers[1].stats()
+        self.assertEqual(stats["data_sent_total"], { "send": 1 })
+        # Route maintenance looks things up in the background, too, but those
+        # are counted separately.
+        self.assertEqual(stats["lookups_total"]["app"], 1)
+        self.assertEqual(stats["lookup_latency_seconds"]["app"]["count"], 1)
+        self.assertEqual(stats["peers"], len(peers[1].peers))
+        self.assertEqual(stats["requests_pending"], 0)
+        self.assertGreater(stats["messages_sent_total"]["JOIN"], 0)
+        self.assertGreater(stats["bytes_received_total"]["INFO"], 0)
+        self.assertEqual(peers[2].stats()["data_received_total"], 1)
+
+        text = peers[1].stats(prometheus=True)
+        self.assertIn('cicada_lookups_total{node="10.0.0.2:%d",origin="app"} '
+                      '1\n' % 0xC1CA, text)
+
+    def test_sharding(self):
+        host = swarmlib.ShardedHost(6, shards=2,
+                                    port=(0xC1CADA & 0xFF00) + 0x20)
+        started = host.start()
+        try:
+            self.assertEqual([ s["peers"] for s in started ], [ 3, 3 ])
+            self.assertNotEqual(started[0]["pid"], started[1]["pid"])
+
+            for _ in xrange(10):
+                host.call(stabilize_all)
+                time.sleep(0.3)
+
+            # Each shard sends one message to a peer in the other shard.
+            host.call(send_to, (host.addresses[0], host.addresses[-1]))
+            for _ in xrange(50):
+                stats = host.stats()
+                if stats["received"] >= 2: break
+                time.sleep(0.1)
+
+            self.assertEqual(stats["peers"], 6)
+            self.assertEqual(stats["joined"], 6)
+            self.assertEqual(stats["received"], 2)
+            self.assertGreater(stats["local_connections"], 0)
+            self.assertGreater(stats["remote_connections"], 0)
+
+            # Peers in a shard share their worker threads.
+            self.assertEqual(host.call(count_pools), [ 1, 1 ])
+
+        finally:
+            host.stop()
+
+
+def stabilize_all(peers):
+    for peer in peers: peer.peer.stabilize()
+
+def count_pools(peers):
+    return len(set([ id(peer.workers) for peer in peers ]))
+
+def send_to(peers, addresses):
+    ours = [ p.listener for p in peers ]
+    for address in addresses:
+        if address not in ours:
+            peers[0].send(address, "SHARDED")
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_ordering(self):
+        pool = swarmlib.WorkerPool(workers=3)
+        self.addCleanup(pool.stop)
+        results = {}
+
+        def record(key, value):
+            time.sleep(0.001)
+            results.setdefault(key, []).append(value)
+
+        for i in xrange(100):
+            for key in xrange(5):
+                pool.submit(key, record, key, i)
+
+        for _ in xrange(100):
+            if not pool.pending: break
+            time.sleep(0.1)
+        pool.stop()
+
+        for key in xrange(5):
+            self.assertEqual(results[key], range(100))
+
+    def test_overflow(self):
+        started, release = threading.Event(), threading.Event()
+        def stall():
+            started.set()
+            release.wait()
+
+        pool = swarmlib.WorkerPool(workers=1, capacity=2)
+        self.addCleanup(pool.stop)
+        self.addCleanup(release.set)
+        self.assertEqual(pool.overflow, swarmlib.WorkerPool.DROP)
+
+        pool.submit(0, stall)
+        started.wait()
+        self.assertTrue(pool.submit(0, stall))
+        self.assertTrue(pool.submit(0, stall))
+        self.assertFalse(pool.submit(0, stall))
+        self.assertEqual(pool.dropped, 1)
+
+        pool.overflow = swarmlib.WorkerPool.SPILL
+        self.assertTrue(pool.submit(0, stall))
+        self.assertEqual(pool.pending, 3)
+
+
+class TestSwarmStream(unittest.TestCase):
+    def test_stalled(self):
+        timer = clock.VirtualClock(seed=1)
+        wallclock = clock.install(timer)
+        try:
+            sent = []
+            stream = swarmlib.SwarmStream(sent.append, chordlib.routing.Hash(
+                value="remote"))
+            self.assertEqual(stream.stream_id,
+                             clock.VirtualClock(seed=1).random.randint(
+                                 1, 2 ** 32 - 1))
+
+            # Nobody ever acknowledges anything, so the writer re-sends until
+            # it gives up, all without any real time passing.
+            start = time.time()
+            stream.write("lost")
+            self.assertRaises(swarmlib.StreamError, stream.close)
+            self.assertLess(time.time() - start, 5)
+            self.assertGreaterEqual(timer.time(), stream.RETRANSMIT *
+                                    stream.MAX_RETRIES)
+            self.assertGreater(len(sent), 2)
+            self.assertEqual(stream.read(timeout=1), "")
+        finally:
+            clock.install(wallclock)
+
 if __name__ == '__main__':
     unittest.main()
@@ -455,7 +455,10 @@ if __name__ == "__main__":
                 if sock.remote == peer:
                     wrapped = functools.partial(VisualNode.Dot.from_bytes,
                                                 sprite.peer)
-                    sock.hooks["send"] = wrapped
+
+                    # Unpacking is slow, so keep it off of the network thread.
+                    sock.hooks["send"] = functools.partial(
+                        sprite.peer.workers.submit, sock, wrapped)
 
     RuntimePatchHack.peer_association = staticmethod(peer_association_callback)
 